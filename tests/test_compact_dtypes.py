@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from shapely.geometry import Point
+
+from tomorrowcities.backend.engine import create_tally, generate_metrics
+from tomorrowcities.backend.utils import compact_dtypes, restore_dtypes
+
+
+def make_exposure():
+    landuse = gpd.GeoDataFrame({'zoneid': [1, 2], 'avgincome': ['lowIncomeA', 'highIncome'], 'luf': ['a', 'b']},
+                               geometry=[Point(0, 0), Point(1, 1)], crs='EPSG:4326')
+    buildings = gpd.GeoDataFrame({'bldid': [10, 11, 12, 13], 'zoneid': [1, 1, 2, 2],
+                                  'occupancy': ['Res', 'Hea', 'Com', 'Res'], 'ds': [0, 4, 2, 1],
+                                  'casualty': [0, 1, 0, 0], 'has_power': [True, False, True, True],
+                                  'expstr': ['RCi+LC+3s+Res', 'URM+MC+1s+Hea', 'RCi+LC+3s+Com', 'RCi+LC+3s+Res'],
+                                  'note': ['a', 'a', 'a', 'b']},
+                                 geometry=[Point(0, 0)] * 4, crs='EPSG:4326')
+    household = pd.DataFrame({'hhid': [1, 2, 3], 'bldid': [10, 11, 13], 'commfacid': [11, 11, -1],
+                              'income': ['lowIncomeA', 'midIncome', 'highIncome'], 'hospital_access': True,
+                              'has_power': True, 'hospital_has_power': True})
+    individual = pd.DataFrame({'individ': np.arange(6), 'hhid': [1, 1, 2, 2, 3, 3], 'gender': 1, 'age': 3,
+                               'head': [1, 0, 1, 0, 1, 0], 'eduattstat': 1, 'indivfacid': [12, -1, 11, -1, 13, -1],
+                               'facility_access': [True, True, False, True, True, True]})
+    return landuse, buildings, household, individual
+
+
+def test_only_taxonomy_strings_become_categoricals():
+    _, buildings, _, _ = make_exposure()
+    compact = compact_dtypes(buildings.copy())
+    assert isinstance(compact['occupancy'].dtype, pd.CategoricalDtype)
+    assert compact['note'].dtype == object
+    assert compact['ds'].dtype == np.int8 and compact['bldid'].dtype == np.int32
+
+
+def test_restore_dtypes():
+    frame = pd.DataFrame({'a': [1.0, np.nan], 'b': [1, 2], 'c': [1, 2]})
+    restored = restore_dtypes(frame, {'a': np.dtype('int8'), 'b': np.dtype('int32'), 'c': np.dtype('int64')})
+    assert restored['a'].dtype == np.float32
+    assert restored['b'].dtype == np.int32
+    assert restored['c'].dtype == np.int64
+
+
+def test_create_tally_keeps_compact_dtypes():
+    layers = make_exposure()
+    np.random.seed(0)
+    tally, _ = create_tally(*layers)
+    np.random.seed(0)
+    compact_tally, _ = create_tally(*[compact_dtypes(layer.copy()) for layer in layers])
+    assert compact_tally['ds'].dtype == np.int8
+    assert compact_tally['ds_facility'].dtype == np.float32
+    assert compact_tally['bldid'].dtype == np.int32
+    assert compact_tally.memory_usage(deep=True).sum() < tally.memory_usage(deep=True).sum()
+    for hazard in ['earthquake', 'flood']:
+        assert generate_metrics(tally, tally, hazard, 2) == generate_metrics(compact_tally, compact_tally, hazard, 2)
@@ -0,0 +1,27 @@
+import numpy as np
+
+from tomorrowcities.backend.engine import sample_damage_states
+
+
+def make_probabilities(n=3000, seed=0):
+    # exceedance probabilities P(DS >= k) decreasing in k
+    rng = np.random.default_rng(seed)
+    return -np.sort(-rng.random((n, 4)), axis=1)
+
+
+def test_split_does_not_change_realizations():
+    prob_ds = make_probabilities()
+    whole = sample_damage_states(prob_ds, 20, seed=11)
+    # any split of the rows, in any order and chunk size, draws the same states
+    order = np.random.default_rng(1).permutation(len(prob_ds))
+    for part in np.array_split(order, 7):
+        np.testing.assert_array_equal(sample_damage_states(prob_ds[part], 20, seed=11, positions=part, chunk_size=50),
+                                      whole[part])
+    assert not (sample_damage_states(prob_ds, 20, seed=12) == whole).all()
+
+
+def test_damage_state_frequencies():
+    prob_ds = make_probabilities(200)
+    ds = sample_damage_states(prob_ds, 5000, seed=3)
+    for k in range(1, 5):
+        np.testing.assert_allclose((ds >= k).mean(axis=1), prob_ds[:, k - 1], atol=0.03)
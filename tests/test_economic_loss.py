@@ -0,0 +1,73 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pytest
+from shapely.geometry import Point
+
+from tomorrowcities.backend.engine import compute_economic_loss
+from tomorrowcities.backend.utils import building_preprocess
+
+IMLS = np.array([0.1, 0.5, 1.0, 2.0])
+
+
+def vulnerability_model(dist):
+    functions = [{'id': 'RCi+LC+3s+Res', 'imt': 'PGA', 'dist': dist, 'imls': IMLS,
+                  'meanLRs': np.array([0.01, 0.1, 0.4, 0.8]), 'covLRs': np.array([0.3, 0.3, 0.3, 0.3])},
+                 {'id': 'URM+MC+1s+Com', 'imt': 'PGA', 'dist': dist, 'imls': IMLS,
+                  'meanLRs': np.array([0.05, 0.3, 0.6, 0.9]), 'covLRs': np.array([0.2, 0.2, 0.2, 0.2])}]
+    return {'vulnerabilityFunctions': functions}
+
+
+def make_layers(n=3000, seed=0):
+    # buildings sit on their intensity points; the last taxonomy has no function
+    rng = np.random.default_rng(seed)
+    points = [Point(28.9 + 0.0005 * (i % 60), 41.0 + 0.0005 * (i // 60)) for i in range(n)]
+    expstr = rng.choice(['RCi+LC+3s+Res', 'URM+MC+1s+Com', 'S+W+HC+6s+Ind'], n, p=[0.45, 0.45, 0.1])
+    buildings = gpd.GeoDataFrame({'bldid': np.arange(n), 'expstr': expstr, 'residents': 1, 'nhouse': 1,
+                                  'zoneid': rng.integers(0, 2, n), 'specialfac': 0,
+                                  'repvalue': rng.uniform(1e4, 1e5, n), 'fptarea': 50.0},
+                                 geometry=points, crs='EPSG:4326')
+    buildings = building_preprocess(buildings, {'freqincome': 'lowIncomeA', 'ds': 0})
+    intensity = gpd.GeoDataFrame({'im': rng.choice([0.3, 0.75, 1.5], n)}, geometry=points, crs='EPSG:4326')
+    landuse = gpd.GeoDataFrame({'zoneid': [0, 1], 'avgincome': ['lowIncomeA', 'highIncome']},
+                               geometry=[Point(0, 0)] * 2, crs='EPSG:4326')
+    return landuse, buildings, intensity
+
+
+def expected_mean_loss_ratio(buildings, intensity, model):
+    functions = {f['id']: f for f in model['vulnerabilityFunctions']}
+    return np.array([np.interp(im, functions[e]['imls'], functions[e]['meanLRs']) if e in functions else 0
+                     for e, im in zip(buildings['expstr'], intensity['im'])])
+
+
+def test_mean_loss_ratio_matches_vulnerability_table():
+    landuse, buildings, intensity = make_layers(300)
+    model = vulnerability_model('LN')
+    with pytest.warns(UserWarning, match='S\\+W\\+HC\\+6s\\+Ind'):
+        bld_loss, zone_loss = compute_economic_loss(landuse, buildings, intensity, model, earthquake_intensity_unit='g')
+    bld_loss = bld_loss.set_index('bldid').loc[buildings['bldid']]
+    expected = expected_mean_loss_ratio(buildings, intensity, model)
+    np.testing.assert_allclose(bld_loss['loss_ratio'], expected)
+    np.testing.assert_allclose(bld_loss['loss'], expected * buildings['repvalue'].to_numpy())
+    np.testing.assert_allclose(zone_loss['loss'].sum(), (expected * buildings['repvalue'].to_numpy()).sum())
+
+
+@pytest.mark.parametrize('dist', ['LN', 'BT'])
+def test_sampled_loss_ratios_average_to_the_mean(dist):
+    landuse, buildings, intensity = make_layers()
+    model = vulnerability_model(dist)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        bld_loss, _ = compute_economic_loss(landuse, buildings, intensity, model, earthquake_intensity_unit='g',
+                                            sample_uncertainty=True, seed=1)
+    bld_loss = bld_loss.set_index('bldid').loc[buildings['bldid']]
+    expected = expected_mean_loss_ratio(buildings, intensity, model)
+    sampled = bld_loss['loss_ratio'].to_numpy()
+    assert ((sampled >= 0) & (sampled <= 1)).all()
+    assert not np.allclose(sampled, expected)
+    # mean over the buildings of every (taxonomy, intensity) group
+    groups = pd.DataFrame({'expstr': buildings['expstr'].to_numpy(), 'im': intensity['im'].to_numpy(),
+                           'sampled': sampled, 'expected': expected}).groupby(['expstr', 'im']).mean()
+    np.testing.assert_allclose(groups['sampled'], groups['expected'], rtol=0.05, atol=1e-3)
@@ -0,0 +1,32 @@
+import numpy as np
+import geopandas as gpd
+from shapely.geometry import Point, LineString
+
+from tomorrowcities.backend.engine import road_edge_intensity
+
+
+def make_layers():
+    # intensity points 100 m apart, in a projected CRS
+    points = gpd.GeoDataFrame({'im': [0.1, 2.0, 0.5]},
+                              geometry=[Point(0, 0), Point(100, 0), Point(200, 0)], crs='EPSG:3857')
+    edges = gpd.GeoDataFrame({'edge_id': [10, 11, 12]},
+                             geometry=[LineString([(-50, 5), (150, 5)]),    # passes both 0.1 and 2.0
+                                       LineString([(20, 60), (60, 60)]),    # nothing within 10 m
+                                       LineString([(190, -5), (195, -5)])], # next to 0.5
+                             crs='EPSG:3857')
+    return points, edges
+
+
+def test_max_within_distance():
+    points, edges = make_layers()
+    result = road_edge_intensity(edges, points, 10, 'max')
+    np.testing.assert_allclose(result['im'], [2.0, 0.1, 0.5])
+    np.testing.assert_array_equal(result['im_count'], [2, 0, 1])
+
+
+def test_unsampled_edges_take_the_nearest_point():
+    points, edges = make_layers()
+    result = road_edge_intensity(edges, points, 10, 'max')
+    nearest = road_edge_intensity(edges, points, 10, 'nearest')
+    unsampled = (result['im_count'] == 0).to_numpy()
+    np.testing.assert_allclose(result['im'].to_numpy()[unsampled], nearest['im'].to_numpy()[unsampled])
@@ -0,0 +1,84 @@
+import contextlib
+import io
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pytest
+from shapely.geometry import Point, LineString
+
+from tomorrowcities.backend.engine import compute_road_infra, compute_road_sensitivity, threshold_metrics, \
+    create_tally, generate_metrics
+from tomorrowcities.backend.utils import building_preprocess, identity_preprocess
+
+
+def make_layers(n_side=6, n=200, seed=0):
+    rng = np.random.default_rng(seed)
+    xs = np.linspace(28.9, 28.92, n_side)
+    ys = np.linspace(41.0, 41.02, n_side)
+    points = [Point(x, y) for x in xs for y in ys]
+    nodes = gpd.GeoDataFrame({'node_id': np.arange(len(points))}, geometry=points, crs='EPSG:4326')
+    edges = []
+    for i in range(n_side):
+        for j in range(n_side):
+            for di, dj in [(1, 0), (0, 1)]:
+                if i + di < n_side and j + dj < n_side:
+                    a, b = i * n_side + j, (i + di) * n_side + j + dj
+                    if rng.random() < 0.5:
+                        a, b = b, a
+                    edges.append({'from_node': a, 'to_node': b,
+                                  'bridge_type': rng.choice([None, 'culvert', 'HWB1'], p=[0.7, 0.2, 0.1]),
+                                  'geometry': LineString([points[a], points[b]])})
+    edges = gpd.GeoDataFrame(edges, crs='EPSG:4326')
+    edges['edge_id'] = np.arange(len(edges))
+    edges['ds'] = 0
+    edges['is_damaged'] = False
+
+    occupancy = rng.choice(['Res', 'Com', 'Hea'], n, p=[0.6, 0.3, 0.1])
+    buildings = gpd.GeoDataFrame({'bldid': np.arange(n), 'expstr': [f'RCi+LC+3s+{o}' for o in occupancy],
+                                  'residents': 2, 'nhouse': 1, 'zoneid': 0, 'specialfac': 0,
+                                  'repvalue': 1e5, 'fptarea': 50.0},
+                                 geometry=gpd.points_from_xy(28.9 + rng.random(n) * 0.02, 41.0 + rng.random(n) * 0.02),
+                                 crs='EPSG:4326')
+    buildings = building_preprocess(buildings, {'freqincome': 'lowIncomeA', 'ds': 0, 'node_id': None,
+                                                'hospital_access': True, 'has_power': True, 'casualty': 0})
+    hospitals = buildings.loc[occupancy == 'Hea', 'bldid'].to_numpy()
+    household = identity_preprocess(pd.DataFrame({'hhid': np.arange(n), 'bldid': np.arange(n), 'nind': 2,
+                                                  'income': 'lowIncomeA', 'commfacid': rng.choice(hospitals, n)}),
+                                    {'node_id': None, 'hospital_access': True, 'has_power': True,
+                                     'hospital_has_power': True})
+    individual = identity_preprocess(pd.DataFrame({'individ': np.arange(2 * n), 'hhid': np.repeat(np.arange(n), 2),
+                                                   'gender': 1, 'age': 1, 'eduattstat': 1, 'head': [1, 0] * n,
+                                                   'indivfacid': np.where(rng.random(2 * n) < 0.5, -1,
+                                                                          rng.integers(0, n, 2 * n))}),
+                                     {'facility_access': True})
+    intensity = gpd.GeoDataFrame({'im': rng.random(1000) * 2},
+                                 geometry=gpd.points_from_xy(28.9 + rng.random(1000) * 0.02,
+                                                             41.0 + rng.random(1000) * 0.02), crs='EPSG:4326')
+    landuse = gpd.GeoDataFrame({'zoneid': [0], 'avgincome': ['lowIncomeA']}, geometry=[Point(0, 0)], crs='EPSG:4326')
+    return landuse, buildings, household, individual, nodes, edges, intensity
+
+
+@pytest.mark.parametrize('directed', [False, True])
+@pytest.mark.parametrize('road_threshold, culvert_threshold', [(0.3, 1.5), (1.2, 0.4)])
+def test_road_sensitivity_matches_compute_road_infra(directed, road_threshold, culvert_threshold):
+    landuse, buildings, household, individual, nodes, edges, intensity = make_layers()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = compute_road_infra(buildings, household, individual, nodes, edges, intensity, None, 'flood',
+                                    road_threshold, culvert_threshold, 10, directed)
+        sensitivity = compute_road_sensitivity(edges, intensity, nodes=nodes, buildings=buildings,
+                                               household=household, individual=individual,
+                                               preserve_edge_directions=directed)
+        household_access, individual_access = sensitivity.access(road_threshold, culvert_threshold)
+        np.testing.assert_array_equal(household_access, result[5])
+        np.testing.assert_array_equal(individual_access, result[6])
+
+        # metrics at the thresholds equal those of the layers of the run
+        np.random.seed(0)
+        tally, _ = create_tally(landuse, buildings, household.assign(hospital_access=household_access),
+                                individual.assign(facility_access=individual_access))
+        metrics = generate_metrics(tally, tally, 'flood', 2)
+        row = threshold_metrics(None, landuse, buildings, household, individual,
+                                [(0.2, 10, road_threshold, culvert_threshold)], road_sensitivity=sensitivity).iloc[0]
+    for name, metric in metrics.items():
+        assert row[name] == metric['value'], name
@@ -0,0 +1,83 @@
+import contextlib
+import io
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pytest
+from shapely.geometry import Point, LineString
+
+from tomorrowcities.backend.engine import landslide_monte_carlo, create_tally, generate_metrics
+from tomorrowcities.backend.utils import building_preprocess, identity_preprocess
+
+
+def make_layers(n_side=6, n=150, seed=0):
+    rng = np.random.default_rng(seed)
+    xs = np.linspace(28.9, 28.92, n_side)
+    ys = np.linspace(41.0, 41.02, n_side)
+    points = [Point(x, y) for x in xs for y in ys]
+    nodes = gpd.GeoDataFrame({'node_id': np.arange(len(points))}, geometry=points, crs='EPSG:4326')
+    edges = []
+    for i in range(n_side):
+        for j in range(n_side):
+            for di, dj in [(1, 0), (0, 1)]:
+                if i + di < n_side and j + dj < n_side:
+                    a, b = i * n_side + j, (i + di) * n_side + j + dj
+                    edges.append({'from_node': a, 'to_node': b, 'geometry': LineString([points[a], points[b]])})
+    edges = gpd.GeoDataFrame(edges, crs='EPSG:4326')
+    edges['edge_id'] = np.arange(len(edges))
+    power_nodes = nodes.assign(pwr_plant=(np.arange(len(nodes)) % 12 == 0).astype(int), n_bldgs=5,
+                               ls_frgl='pole')
+    power_edges = edges.drop(columns=['edge_id'])
+
+    # every building holds one household of two individuals, who are its residents
+    occupancy = rng.choice(['Res', 'Com', 'Hea'], n, p=[0.6, 0.3, 0.1])
+    buildings = gpd.GeoDataFrame({'bldid': np.arange(n), 'expstr': [f'URM+LC+1s+{o}' for o in occupancy],
+                                  'residents': 2, 'nhouse': 1, 'zoneid': 0, 'specialfac': 0,
+                                  'repvalue': 1e5, 'fptarea': 50.0},
+                                 geometry=gpd.points_from_xy(28.9 + rng.random(n) * 0.02, 41.0 + rng.random(n) * 0.02),
+                                 crs='EPSG:4326')
+    buildings = building_preprocess(buildings, {'freqincome': 'lowIncomeA', 'ds': 0, 'node_id': None,
+                                                'hospital_access': True, 'has_power': True, 'casualty': 0})
+    hospitals = buildings.loc[occupancy == 'Hea', 'bldid'].to_numpy()
+    household = identity_preprocess(pd.DataFrame({'hhid': np.arange(n), 'bldid': np.arange(n), 'nind': 2,
+                                                  'income': 'lowIncomeA', 'commfacid': rng.choice(hospitals, n)}),
+                                    {'node_id': None, 'hospital_access': True, 'has_power': True,
+                                     'hospital_has_power': True})
+    individual = identity_preprocess(pd.DataFrame({'individ': np.arange(2 * n), 'hhid': np.repeat(np.arange(n), 2),
+                                                   'gender': 1, 'age': 1, 'eduattstat': 1, 'head': [1, 0] * n,
+                                                   'indivfacid': np.where(rng.random(2 * n) < 0.5, -1,
+                                                                          rng.integers(0, n, 2 * n))}),
+                                     {'facility_access': True})
+    intensity = gpd.GeoDataFrame({'im': rng.integers(1, 4, 1000)},
+                                 geometry=gpd.points_from_xy(28.9 + rng.random(1000) * 0.02,
+                                                             41.0 + rng.random(1000) * 0.02), crs='EPSG:4326')
+    landuse = gpd.GeoDataFrame({'zoneid': [0], 'avgincome': ['lowIncomeA']}, geometry=[Point(0, 0)], crs='EPSG:4326')
+    fragility = pd.DataFrame([{'expstr': expstr, 'susceptibility': susceptibility, 'collapse_probability': p}
+                              for expstr in ['URM+LC', 'roads', 'pole']
+                              for susceptibility, p in zip(['low', 'medium', 'high'], [0.05, 0.2, 0.4])])
+    return landuse, buildings, household, individual, intensity, fragility, nodes, edges, power_nodes, power_edges
+
+
+@pytest.mark.parametrize('directed', [False, True])
+def test_representative_trial_layers_give_its_metrics(directed):
+    landuse, buildings, household, individual, intensity, fragility, nodes, edges, power_nodes, power_edges = \
+        make_layers()
+    with contextlib.redirect_stdout(io.StringIO()):
+        trials, realization = landslide_monte_carlo(landuse, buildings, household, individual, intensity, fragility,
+                                                    20, road_nodes=nodes, road_edges=edges, power_nodes=power_nodes,
+                                                    power_edges=power_edges, preserve_edge_directions=directed,
+                                                    seed=1, representative=True)
+    metrics = trials.drop(columns='trial')
+    distances = ((metrics - metrics.mean()).abs() / metrics.std(ddof=0).replace(0, 1)).sum(axis=1)
+    assert distances.iloc[realization['trial'] - 1] == distances.min()
+    assert realization['road edges']['is_damaged'].any() and realization['power nodes']['is_damaged'].any()
+
+    layers = {'building': buildings.copy(), 'household': household.copy(), 'individual': individual.copy()}
+    for name, layer in layers.items():
+        for column in realization[name].columns[1:]:
+            layer[column] = realization[name][column].to_numpy()
+    tally, _ = create_tally(landuse, layers['building'], layers['household'], layers['individual'])
+    row = trials.iloc[realization['trial'] - 1]
+    for name, metric in generate_metrics(tally, tally, 'landslide', 2).items():
+        assert metric['value'] == row[name], name
@@ -0,0 +1,100 @@
+import networkx as nx
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pytest
+from shapely.geometry import Point, LineString
+
+from tomorrowcities.backend.engine import NetworkTopology, compute_hospital_distance
+
+
+def make_road_network(n_side=5, seed=0):
+    rng = np.random.default_rng(seed)
+    xs = np.linspace(28.9, 28.92, n_side)
+    ys = np.linspace(41.0, 41.02, n_side)
+    points = [Point(x, y) for x in xs for y in ys]
+    nodes = gpd.GeoDataFrame({'node_id': np.arange(len(points)) + 100}, geometry=points, crs='EPSG:4326')
+    edges = []
+    for i in range(n_side):
+        for j in range(n_side):
+            for di, dj in [(1, 0), (0, 1)]:
+                if i + di < n_side and j + dj < n_side:
+                    a, b = i * n_side + j, (i + di) * n_side + j + dj
+                    if rng.random() < 0.5:
+                        a, b = b, a
+                    edges.append({'from_node': a + 100, 'to_node': b + 100, 'length': rng.uniform(50, 500),
+                                  'is_damaged': rng.random() < 0.2,
+                                  'geometry': LineString([points[a], points[b]])})
+    edges = gpd.GeoDataFrame(edges, crs='EPSG:4326')
+    # a parallel edge that is longer than the original
+    edges = pd.concat([edges, edges.iloc[[0]].assign(length=1e6, is_damaged=False)], ignore_index=True)
+    edges['edge_id'] = np.arange(len(edges))
+    return nodes, edges
+
+
+def reference_distances(nodes, edges, sources, directed, damaged=True):
+    # networkx distances to the nearest source node. Parallel edges count
+    # with their shortest length, and a damaged edge removes the connection
+    # between its nodes as in the networkx version of compute_road_infra.
+    G = nx.DiGraph() if directed else nx.Graph()
+    G.add_nodes_from(nodes['node_id'])
+    for _, edge in edges.iterrows():
+        length = edge['length']
+        if G.has_edge(edge['from_node'], edge['to_node']):
+            length = min(length, G[edge['from_node']][edge['to_node']]['length'])
+        G.add_edge(edge['from_node'], edge['to_node'], length=length)
+    if damaged:
+        for _, edge in edges[edges['is_damaged']].iterrows():
+            if G.has_edge(edge['from_node'], edge['to_node']):
+                G.remove_edge(edge['from_node'], edge['to_node'])
+    if directed:
+        G = G.reverse()
+    if len(sources) == 0:
+        return {}
+    return nx.multi_source_dijkstra_path_length(G, set(sources), weight='length')
+
+
+@pytest.mark.parametrize('directed', [False, True])
+def test_distances_from_any(directed):
+    nodes, edges = make_road_network()
+    topology = NetworkTopology(nodes['node_id'], edges['from_node'], edges['to_node'])
+    alive = topology.alive_edges(edges['is_damaged'].to_numpy(), directed)
+    sources = [100, 112]
+    distances = topology.distances_from_any(alive, edges['length'].to_numpy(), topology.positions(sources),
+                                            directed, reverse=True)
+    expected = reference_distances(nodes, edges, sources, directed)
+    expected = np.array([expected.get(node_id, np.inf) for node_id in topology.node_index])
+    np.testing.assert_allclose(distances, expected)
+
+
+def test_distances_from_no_source():
+    nodes, edges = make_road_network()
+    topology = NetworkTopology(nodes['node_id'], edges['from_node'], edges['to_node'])
+    distances = topology.distances_from_any(np.ones(topology.n_edges, dtype=bool), edges['length'].to_numpy(),
+                                            np.array([], dtype=np.int64), False)
+    assert np.isinf(distances).all()
+
+
+@pytest.mark.parametrize('directed', [False, True])
+def test_compute_hospital_distance(directed):
+    nodes, edges = make_road_network()
+    # buildings sit on road nodes; hospital 1 is damaged, bldid 3 repeats
+    buildings = gpd.GeoDataFrame({'bldid': [0, 1, 2, 3, 3, 4],
+                                  'occupancy': ['Hea', 'Hea', 'Res', 'Res', 'Com', 'Res'],
+                                  'ds': [0, 3, 0, 0, 0, 0]},
+                                 geometry=nodes.geometry.iloc[[0, 12, 4, 20, 20, 24]].to_numpy(), crs='EPSG:4326')
+    building_nodes = nodes['node_id'].iloc[[0, 12, 4, 20, 20, 24]].to_numpy()
+    household = pd.DataFrame({'hhid': [0, 1, 2, 3], 'bldid': [2, 3, 4, 99]})
+
+    distance, increase, household_distance, household_increase = \
+        compute_hospital_distance(buildings, household, nodes, edges, 'earthquake', directed)
+
+    after = reference_distances(nodes, edges, [100], directed)
+    before = reference_distances(nodes, edges, [100, 112], directed, damaged=False)
+    expected = np.array([after.get(node_id, np.inf) for node_id in building_nodes])
+    expected_before = np.array([before.get(node_id, np.inf) for node_id in building_nodes])
+    np.testing.assert_allclose(distance.to_numpy(), expected)
+    with np.errstate(invalid='ignore'):
+        np.testing.assert_allclose(increase.to_numpy(), expected - expected_before)
+    np.testing.assert_allclose(household_distance.to_numpy(), [expected[2], expected[3], expected[5], np.nan])
+    np.testing.assert_allclose(household_increase.to_numpy()[:3], (expected - expected_before)[[2, 3, 5]])
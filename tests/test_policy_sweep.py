@@ -0,0 +1,91 @@
+import contextlib
+import io
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pytest
+from shapely.geometry import Point
+
+from tomorrowcities.backend.engine import sweep_policies, compute, create_tally, generate_metrics, FLOOD_CURVE_COLS
+from tomorrowcities.backend.utils import building_preprocess, identity_preprocess
+
+MATERIALS = ['RCi', 'URM', 'S+W']
+CODES = ['LC', 'MC', 'HC']
+STOREYS = ['1s', '3s', '6s']
+OCCUPANCIES = ['Res', 'Com', 'Hea']
+
+
+def make_layers(n=300, seed=0):
+    rng = np.random.default_rng(seed)
+    points = gpd.points_from_xy(28.9 + rng.random(n) * 0.02, 41.0 + rng.random(n) * 0.02)
+    expstr = ['+'.join([rng.choice(MATERIALS), rng.choice(CODES), rng.choice(STOREYS), rng.choice(OCCUPANCIES)])
+              for _ in range(n)]
+    buildings = gpd.GeoDataFrame({'bldid': np.arange(n), 'expstr': expstr, 'residents': rng.integers(0, 20, n),
+                                  'nhouse': 1, 'zoneid': rng.integers(0, 2, n), 'specialfac': rng.integers(0, 2, n),
+                                  'repvalue': 1e5, 'fptarea': 50.0}, geometry=points, crs='EPSG:4326')
+    buildings = building_preprocess(buildings, {'freqincome': 'lowIncomeA', 'ds': 0, 'node_id': None,
+                                                'hospital_access': True, 'has_power': True, 'casualty': 0})
+    intensity = gpd.GeoDataFrame({'im': rng.random(1000) * 3},
+                                 geometry=gpd.points_from_xy(28.9 + rng.random(1000) * 0.02,
+                                                             41.0 + rng.random(1000) * 0.02), crs='EPSG:4326')
+    landuse = gpd.GeoDataFrame({'zoneid': [0, 1], 'avgincome': ['lowIncomeA', 'highIncome']},
+                               geometry=[Point(0, 0)] * 2, crs='EPSG:4326')
+    hospitals = buildings.loc[buildings['expstr'].str.endswith('Hea'), 'bldid'].to_numpy()
+    household = identity_preprocess(pd.DataFrame({'hhid': np.arange(n), 'bldid': np.arange(n), 'nind': 2,
+                                                  'income': rng.choice(['lowIncomeA', 'highIncome'], n),
+                                                  'commfacid': rng.choice(hospitals, n)}),
+                                    {'node_id': None, 'hospital_access': True, 'has_power': True,
+                                     'hospital_has_power': True})
+    individual = identity_preprocess(pd.DataFrame({'individ': np.arange(2 * n), 'hhid': np.repeat(np.arange(n), 2),
+                                                   'gender': 1, 'age': 1, 'eduattstat': 1, 'head': [1, 0] * n,
+                                                   'indivfacid': -1}), {'facility_access': True})
+    return landuse, buildings, household, individual, intensity
+
+
+def make_hazard(hazard_type, seed=1):
+    rng = np.random.default_rng(seed)
+    rows = []
+    if hazard_type == 'earthquake':
+        for material in MATERIALS:
+            for code in CODES:
+                for height in ['LR', 'MR', 'HR']:
+                    medians = np.sort(rng.random(4)) * 0.8 + 0.05
+                    rows.append({'expstr': f'{material}+{code}+{height}',
+                                 **{f'muds{i + 1}_g': medians[i] for i in range(4)},
+                                 **{f'sigmads{i + 1}': 0.3 for i in range(4)}})
+    else:
+        for material in MATERIALS:
+            for code in CODES:
+                for storeys in STOREYS + ['2s', '4s', '7s']:
+                    for occupancy in OCCUPANCIES + ['Agri']:
+                        rows.append({'expstr': f'{material}+{code}+{storeys}+{occupancy}',
+                                     **dict(zip(FLOOD_CURVE_COLS, np.sort(rng.random(len(FLOOD_CURVE_COLS)))))})
+    return pd.DataFrame(rows)
+
+
+@pytest.mark.parametrize('hazard_type', ['earthquake', 'flood'])
+def test_sweep_matches_compute(hazard_type):
+    landuse, buildings, household, individual, intensity = make_layers()
+    hazard = make_hazard(hazard_type)
+    # building policies (7, 11, 18) change the taxonomy of some buildings
+    portfolios = [[], [1, 2, 5], [7, 11, 18, 6]]
+    with contextlib.redirect_stdout(io.StringIO()):
+        sweep = sweep_policies(landuse, buildings, household, individual, intensity, hazard.copy(), hazard_type,
+                               portfolios)
+        for row, policies in zip(sweep.to_dict('records'), portfolios):
+            damage = compute(landuse, buildings.copy(), household, individual, intensity, hazard.copy(),
+                             hazard_type, policies=policies)
+            tally, _ = create_tally(landuse, buildings.assign(ds=damage['ds'].to_numpy(), casualty=0),
+                                    household, individual)
+            metrics = generate_metrics(tally, tally, hazard_type, 2)
+            # casualties are spread over the individuals differently
+            for name in [f'metric{i}' for i in range(1, 8)]:
+                assert row[name] == metrics[name]['value'], (policies, name)
+
+
+def test_sweep_rejects_road_policies():
+    landuse, buildings, household, individual, intensity = make_layers(50)
+    with pytest.raises(ValueError, match='road network'):
+        sweep_policies(landuse, buildings, household, individual, intensity, make_hazard('flood'), 'flood',
+                       [[1], [1, 4]])
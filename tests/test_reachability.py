@@ -0,0 +1,63 @@
+import networkx as nx
+import numpy as np
+import pytest
+
+from tomorrowcities.backend.engine import ReachabilityIndex, NetworkTopology
+
+
+def make_network(n_nodes=60, n_edges=90, seed=0):
+    # sparse random network with cycles, parallel edges, a self loop and
+    # isolated nodes; node ids are not positions
+    rng = np.random.default_rng(seed)
+    node_ids = rng.permutation(n_nodes) * 10 + 7
+    from_nodes = node_ids[rng.integers(0, n_nodes - 5, n_edges)]
+    to_nodes = node_ids[rng.integers(0, n_nodes - 5, n_edges)]
+    from_nodes = np.concatenate([from_nodes, from_nodes[:3], [node_ids[0]]])
+    to_nodes = np.concatenate([to_nodes, to_nodes[:3], [node_ids[0]]])
+    damaged = rng.random(len(from_nodes)) < 0.2
+    return node_ids, from_nodes, to_nodes, damaged
+
+
+def reference_graph(node_ids, from_nodes, to_nodes, alive, directed):
+    G = nx.DiGraph() if directed else nx.Graph()
+    G.add_nodes_from(node_ids)
+    G.add_edges_from(zip(from_nodes[alive], to_nodes[alive]))
+    return G
+
+
+@pytest.mark.parametrize('directed', [False, True])
+def test_reachability_index(directed):
+    node_ids, from_nodes, to_nodes, damaged = make_network()
+    topology = NetworkTopology(node_ids, from_nodes, to_nodes)
+    alive = topology.alive_edges(damaged, directed)
+    index = topology.reachability(alive, directed)
+    assert isinstance(index, ReachabilityIndex)
+
+    G = reference_graph(node_ids, from_nodes, to_nodes, alive, directed)
+    rng = np.random.default_rng(1)
+    sources = rng.integers(0, len(node_ids), 2000)
+    targets = rng.integers(0, len(node_ids), 2000)
+    # -1 stands for a node that is not in the network
+    sources[:20] = -1
+    targets[10:30] = -1
+    expected = [s > -1 and t > -1 and nx.has_path(G, topology.node_index[s], topology.node_index[t])
+                for s, t in zip(sources, targets)]
+    np.testing.assert_array_equal(index.reachable(sources, targets), expected)
+
+
+@pytest.mark.parametrize('directed', [False, True])
+@pytest.mark.parametrize('reverse', [False, True])
+def test_reachable_from_any(directed, reverse):
+    node_ids, from_nodes, to_nodes, damaged = make_network()
+    topology = NetworkTopology(node_ids, from_nodes, to_nodes)
+    alive = topology.alive_edges(damaged, directed)
+    G = reference_graph(node_ids, from_nodes, to_nodes, alive, directed)
+    if reverse and directed:
+        G = G.reverse()
+    sources = node_ids[[0, 5, 17]]
+    expected = set(sources)
+    for source in sources:
+        expected |= nx.descendants(G, source)
+    reachable = topology.reachable_from_any(alive, topology.positions(sources), directed, reverse=reverse)
+    np.testing.assert_array_equal(reachable, np.isin(topology.node_index, list(expected)))
+    assert not topology.reachable_from_any(alive, np.array([], dtype=np.int64), directed).any()
@@ -0,0 +1,29 @@
+import numpy as np
+import geopandas as gpd
+from shapely.geometry import Point
+
+from tomorrowcities.backend.utils import SpatialJoinCache, cached_sjoin_nearest, geometry_fingerprint
+
+
+def make_layers():
+    left = gpd.GeoDataFrame({'bldid': [1, 2, 3]}, geometry=[Point(0, 0), Point(8, 0), Point(20, 0)], crs='EPSG:3857')
+    right = gpd.GeoDataFrame({'node_id': [7, 8]}, geometry=[Point(1, 0), Point(19, 0)], crs='EPSG:3857')
+    return left, right
+
+
+def test_in_place_edits_are_not_served_from_the_cache():
+    left, right = make_layers()
+    cache = SpatialJoinCache()
+    np.testing.assert_array_equal(cached_sjoin_nearest(left, right, cache=cache)['node_id'], [7, 7, 8])
+    left.loc[1, 'geometry'] = Point(15, 0)
+    np.testing.assert_array_equal(cached_sjoin_nearest(left, right, cache=cache)['node_id'], [7, 8, 8])
+
+
+def test_given_fingerprints_key_the_cache():
+    left, right = make_layers()
+    cache = SpatialJoinCache()
+    fingerprints = (geometry_fingerprint(left), geometry_fingerprint(right))
+    cached_sjoin_nearest(left, right, fingerprints=fingerprints, cache=cache)
+    joined = cached_sjoin_nearest(left.copy(), right.copy(), fingerprints=fingerprints, cache=cache)
+    assert cache.hits == 1 and cache.misses == 1
+    np.testing.assert_array_equal(joined['node_id'], [7, 7, 8])
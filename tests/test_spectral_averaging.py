@@ -0,0 +1,52 @@
+import numpy as np
+import pandas as pd
+
+from tomorrowcities.backend.engine import spectral_average_logim
+
+
+def reference_logim(df, sa_list, sa_cols, normalization_factor=1):
+    # Row by row spectral averaging as done before the batched version
+    logim = np.zeros(len(df))
+    for i, (_, row) in enumerate(df.iterrows()):
+        minp, maxp = row['minperiod'], row['maxperiod']
+        if minp > 0 and maxp > 0 and maxp > minp:
+            x_interp = np.log(np.concatenate(([0.001], sa_list)))
+            y_interp = np.log(row[sa_cols].to_numpy(dtype=np.float32))
+            step = 0.01
+            x_required = np.log(np.linspace(minp, maxp, int((maxp - minp) / step + 1)))
+            sa_interp = np.exp(np.interp(x_required, x_interp, y_interp))
+            sa_gmean = np.prod(sa_interp)**(1/len(sa_interp))
+            logim[i] = np.log(sa_gmean/normalization_factor)
+        else:
+            logim[i] = np.log(row['pga']/normalization_factor)
+    return logim
+
+
+def make_sites(n=50, seed=0):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({'pga': rng.uniform(0.1, 5, n),
+                       'sa 0.30': rng.uniform(0.1, 5, n),
+                       'sa 1.00': rng.uniform(0.1, 5, n),
+                       'sa 2.00': rng.uniform(0.1, 5, n)})
+    windows = [(0.3, 0.6), (0.5, 1.5), (1.0, 2.0), (0, 0)]
+    df['minperiod'] = [windows[k][0] for k in rng.integers(0, len(windows), n)]
+    df['maxperiod'] = [windows[k][1] for k in rng.integers(0, len(windows), n)]
+    return df, np.array([0.3, 1.0, 2.0]), ['pga', 'sa 0.30', 'sa 1.00', 'sa 2.00']
+
+
+def test_matches_row_by_row_averaging():
+    df, sa_list, sa_cols = make_sites()
+    np.testing.assert_allclose(spectral_average_logim(df, sa_list, sa_cols, 9.81),
+                               reference_logim(df, sa_list, sa_cols, 9.81), rtol=1e-5)
+
+
+def test_zero_band_outside_window():
+    # pga and sa 2.00 do not take part in the [0.3, 1.0] window
+    df, sa_list, sa_cols = make_sites(4)
+    df['minperiod'] = 0.3
+    df['maxperiod'] = 1.0
+    df.loc[0, 'pga'] = 0
+    df.loc[1, 'sa 2.00'] = 0
+    logim = spectral_average_logim(df, sa_list, sa_cols)
+    assert np.isfinite(logim).all()
+    np.testing.assert_allclose(logim, reference_logim(df, sa_list, sa_cols), rtol=1e-5)
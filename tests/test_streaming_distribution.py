@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+
+from tomorrowcities.backend.utils import StreamingDistribution, LossAggregator
+
+
+def make_stream(n=2000, seed=0):
+    rng = np.random.default_rng(seed)
+    values = np.where(rng.random(n) < 0.2, 0, rng.lognormal(3, 1, n))
+    weights = rng.uniform(0.1, 2, n)
+    return values, weights
+
+
+def test_moments_and_quantiles():
+    values, weights = make_stream()
+    d = StreamingDistribution()
+    for v, w in zip(values, weights):
+        d.add(v, w)
+    mean = np.average(values, weights=weights)
+    assert d.count == len(values)
+    np.testing.assert_allclose(d.total_weight, weights.sum())
+    np.testing.assert_allclose(d.weighted_sum, (values * weights).sum())
+    np.testing.assert_allclose(d.mean, mean)
+    np.testing.assert_allclose(d.std(), np.sqrt(np.average((values - mean)**2, weights=weights)))
+    assert d.min == values.min() and d.max == values.max()
+
+    # weighted quantiles, within the resolution of the sketch
+    order = np.argsort(values)
+    cumulative = np.cumsum(weights[order]) / weights.sum()
+    for q in [0.5, 0.9, 0.99]:
+        exact = values[order][np.searchsorted(cumulative, q)]
+        assert abs(d.quantile(q) - exact) <= 0.05 * exact
+
+
+def test_exceedance():
+    values, weights = make_stream()
+    d = StreamingDistribution()
+    for v, w in zip(values, weights):
+        d.add(v, w)
+    edges, weight_above = d.exceedance()
+    np.testing.assert_allclose(weight_above[0], weights[values > 0].sum())
+    # exact at the bin edges
+    for edge, above in zip(edges[1:], weight_above[1:]):
+        np.testing.assert_allclose(above, weights[values >= edge].sum())
+
+
+def test_zero_weight_values_are_ignored():
+    values, weights = make_stream(100)
+    d = StreamingDistribution()
+    reference = StreamingDistribution()
+    d.add(1000, 0)
+    for v, w in zip(values, weights):
+        d.add(v, w)
+        d.add(5000, 0)
+        reference.add(v, w)
+    assert d.count == reference.count
+    np.testing.assert_allclose([d.mean, d.std(), d.max, d.quantile(0.9)],
+                               [reference.mean, reference.std(), reference.max, reference.quantile(0.9)])
+
+
+def test_loss_aggregator_zero_rate_event():
+    aggregator = LossAggregator()
+    aggregator.add({'casualty': 10}, zone_metrics=pd.DataFrame({'casualty': [4, 6]}, index=[1, 2]), rate=0.0)
+    aggregator.add({'casualty': 20}, zone_metrics=pd.DataFrame({'casualty': [5, 15]}, index=[1, 2]), rate=0.01)
+    summary = aggregator.summary().set_index(['metric', 'zone'])
+    np.testing.assert_allclose(summary.loc[('casualty', None), 'average_annual'], 0.2)
+    np.testing.assert_allclose(summary.loc[('casualty', 2), 'average_annual'], 0.15)
+    curve = aggregator.exceedance_curve('casualty')
+    np.testing.assert_allclose(curve['exceedance'].iloc[0], 0.01)
@@ -4,10 +4,14 @@ import pandas as pd
 import geopandas as gpd
 import numpy as np
 from scipy.stats import norm
-from scipy.interpolate import interp1d
-import networkx as nx 
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components, breadth_first_order, dijkstra
+import shapely
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 import time
+import warnings
 import sys
 import uuid
 import os.path
@@ -16,8 +20,565 @@ from random import sample
 from numpy.random import multinomial, randint
 from math import ceil
 import math
-from itertools import repeat, chain
-from .utils import ParameterFile
+from itertools import repeat, chain, combinations
+from .utils import ParameterFile, taxonomy_dictionary, taxonomy_join, cached_sjoin_nearest, \
+    RasterIntensity, join_intensity, project_layer, storeys_to_height, height_to_storeys, \
+    network_fingerprint, network_topology_cache, sample_edge_intensity, restore_dtypes, projected_fingerprint
+
+GEM_LIMIT_STATES = ['slight','moderate','extensive','complete']
+
+def compile_gem_fragility(fragility_functions, limit_states=GEM_LIMIT_STATES):
+    # Dense imls and limit-state (poes) arrays per fragility function id.
+    # Compiled once per run instead of being carried row by row.
+    compiled = dict()
+    for f in fragility_functions:
+        imls = np.asarray(f['imls'], dtype=np.float64)
+        poes = np.vstack([np.asarray(f[ls], dtype=np.float64) for ls in limit_states])
+        compiled[f['id']] = (imls, poes)
+    return compiled
+
+def gem_damage_probabilities(df, compiled, id_col='id', imt_col='imt_2', normalization_factor=1):
+    # Evaluate discrete GEM fragility functions for all rows of df.
+    # Rows are grouped by (fragility id, intensity column) so that each group
+    # is interpolated with a single np.interp call per limit state.
+    # Returns an array of shape (len(df), number of limit states)
+    n_ls = len(next(iter(compiled.values()))[1]) if len(compiled) > 0 else len(GEM_LIMIT_STATES)
+    probs = np.full((len(df), n_ls), np.nan)
+    intensity_cache = dict()
+    groups = df.groupby([id_col, imt_col], sort=False).indices
+    for (frag_id, imt), idx in groups.items():
+        if imt not in intensity_cache:
+            intensity_cache[imt] = df[imt].to_numpy(dtype=np.float64) / normalization_factor
+        imls, poes = compiled[frag_id]
+        intensity_in_g = intensity_cache[imt][idx]
+        for k in range(len(poes)):
+            probs[idx, k] = np.interp(intensity_in_g, imls, poes[k])
+    return probs
+
+def compile_gem_vulnerability(vulnerability_functions):
+    # imls, mean loss ratios, their coefficients of variation and the loss
+    # ratio distribution per vulnerability function id
+    compiled = dict()
+    for f in vulnerability_functions:
+        compiled[f['id']] = (np.asarray(f['imls'], dtype=np.float64),
+                             np.asarray(f['meanLRs'], dtype=np.float64),
+                             np.asarray(f['covLRs'], dtype=np.float64),
+                             f.get('dist', 'LN'))
+    return compiled
+
+def sample_loss_ratios(mean, cov, dist, rng):
+    # Loss ratios drawn around their mean with the given coefficient of
+    # variation: lognormal ('LN') or beta ('BT'). Other distributions and
+    # rows without uncertainty keep the mean.
+    sampled = mean.copy()
+    uncertain = (mean > 0) & (cov > 0)
+    if dist == 'LN':
+        m, c = mean[uncertain], cov[uncertain]
+        sigma = np.sqrt(np.log(1 + c**2))
+        sampled[uncertain] = rng.lognormal(np.log(m) - sigma**2 / 2, sigma)
+    elif dist == 'BT':
+        uncertain = uncertain & (mean < 1)
+        m, c = mean[uncertain], cov[uncertain]
+        # the variance of a beta distribution is below mean*(1-mean)
+        variance = np.minimum((c * m)**2, m * (1 - m) * 0.999)
+        k = m * (1 - m) / variance - 1
+        sampled[uncertain] = rng.beta(m * k, (1 - m) * k)
+    return np.clip(sampled, 0, 1)
+
+def gem_loss_ratios(df, compiled, id_col='vulnerability_id', imt_col='imt_2', normalization_factor=1, rng=None):
+    # Loss ratios of all rows of df from discrete GEM vulnerability functions,
+    # grouped by (vulnerability id, intensity column) as in
+    # gem_damage_probabilities(). Mean loss ratios are returned unless rng is
+    # given, in which case they are sampled with their coefficient of variation.
+    loss_ratio = np.full(len(df), np.nan)
+    intensity_cache = dict()
+    groups = df.groupby([id_col, imt_col], sort=False).indices
+    for (vuln_id, imt), idx in groups.items():
+        if imt not in intensity_cache:
+            intensity_cache[imt] = df[imt].to_numpy(dtype=np.float64) / normalization_factor
+        imls, mean_lrs, cov_lrs, dist = compiled[vuln_id]
+        intensity_in_g = intensity_cache[imt][idx]
+        mean = np.interp(intensity_in_g, imls, mean_lrs)
+        if rng is None:
+            loss_ratio[idx] = mean
+        else:
+            loss_ratio[idx] = sample_loss_ratios(mean, np.interp(intensity_in_g, imls, cov_lrs), dist, rng)
+    return loss_ratio
+
+def spectral_averaging_weights(minp, maxp, x_interp, step=0.01):
+    # Interpolation is linear in the ordinates, so the mean of the interpolated
+    # log spectral accelerations over the period grid is a fixed weighted sum
+    # of the log band values. Interpolating unit vectors gives those weights.
+    x_required = np.log(np.linspace(minp, maxp, int((maxp - minp) / step + 1)))
+    unit = np.eye(len(x_interp))
+    return np.array([np.interp(x_required, x_interp, unit[j]).mean() for j in range(len(x_interp))])
+
+def spectral_average_logim(df, sa_list, sa_cols, normalization_factor=1, step=0.01):
+    # Geometric mean of spectral accelerations over each row's
+    # [minperiod, maxperiod] window, in log space. Weights are built once per
+    # unique period window and applied to the band matrix as a matrix product.
+    # Rows without a valid window fall back to pga.
+    minp = df['minperiod'].to_numpy(dtype=np.float64)
+    maxp = df['maxperiod'].to_numpy(dtype=np.float64)
+    # 0.001 corresponds to pga
+    x_interp = np.log(np.concatenate(([0.001],sa_list)))
+    log_sa = np.log(df[sa_cols].to_numpy(dtype=np.float32)).astype(np.float64)
+
+    logim = np.log(df['pga'].to_numpy(dtype=np.float64)/normalization_factor)
+    valid = (minp > 0) & (maxp > 0) & (maxp > minp)
+    if valid.any():
+        windows = pd.DataFrame({'minp': minp[valid], 'maxp': maxp[valid]})
+        codes, uniques = pd.MultiIndex.from_frame(windows).factorize()
+        weights = np.vstack([spectral_averaging_weights(lo, hi, x_interp, step) for lo, hi in uniques])[codes]
+        # Bands outside the window have weight 0 and must not contribute even
+        # if they are 0 (log 0 * 0 would be nan)
+        terms = np.where(weights > 0, log_sa[valid], 0.0)
+        logim[valid] = np.einsum('ij,ij->i', terms, weights) - np.log(normalization_factor)
+    return logim
+
+# Water depths (m) at which flood vulnerability curves are tabulated
+FLOOD_CURVE_DEPTHS = np.array([0,0.5,1,1.5,2,3,4,5,6])
+FLOOD_CURVE_COLS = ['hw0','hw0_5','hw1','hw1_5','hw2','hw3','hw4','hw5','hw6']
+FLOOD_CASUALTY_RATES = np.array([0,0,0,0.000976715,0.0105355,0.052184493,0.160744982,0.373769339,0.743830881])
+
+def interpolate_rowwise(x, y, xnew, fill_value=(0,1)):
+    # Piecewise-linear interpolation of row i of y at xnew[i], in O(N).
+    # y is either a (N, len(x)) matrix with one curve per row or a single
+    # curve shared by all rows. Values outside x take fill_value (below, above),
+    # matching interp1d(..., bounds_error=False, fill_value=fill_value).
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    xnew = np.asarray(xnew, dtype=np.float64)
+    if y.ndim == 1:
+        return np.interp(xnew, x, y, left=fill_value[0], right=fill_value[1])
+
+    j = np.clip(np.searchsorted(x, xnew, side='right') - 1, 0, len(x) - 2)
+    rows = np.arange(len(xnew))
+    y0 = y[rows, j]
+    y1 = y[rows, j + 1]
+    out = y0 + (xnew - x[j]) * (y1 - y0) / (x[j + 1] - x[j])
+    out[xnew < x[0]] = fill_value[0]
+    out[xnew > x[-1]] = fill_value[1]
+    return out
+
+def position_uniforms(seed, positions, n_realizations):
+    # Uniform float32 draws in [0, 1) of shape (positions, n_realizations).
+    # Counter-based: draw r of position p is the splitmix64 hash of the seed
+    # and the counter p * n_realizations + r, so the draws of a position are
+    # the same whichever other positions are drawn with it.
+    def mix(z):
+        # in place, z is a uint64 array
+        z ^= z >> np.uint64(30)
+        z *= np.uint64(0xBF58476D1CE4E5B9)
+        z ^= z >> np.uint64(27)
+        z *= np.uint64(0x94D049BB133111EB)
+        z ^= z >> np.uint64(31)
+        return z
+    key = mix(np.array([seed], dtype=np.uint64))
+    z = np.asarray(positions, dtype=np.uint64)[:, None] * np.uint64(n_realizations) + \
+        np.arange(1, n_realizations + 1, dtype=np.uint64)
+    z *= np.uint64(0x9E3779B97F4A7C15)
+    z += key
+    z = mix(z)
+    z >>= np.uint64(40)
+    u = z.astype(np.float32)
+    u *= np.float32(2.0**-24)
+    return u
+
+def sample_damage_states(prob_ds, n_realizations, rng=None, chunk_size=100_000, seed=None, positions=None):
+    # Stochastic damage states for many realizations at once.
+    # prob_ds holds exceedance probabilities P(DS >= k) for k = 1..n as columns.
+    # A uniform matrix (elements x realizations) is mapped through the
+    # thresholds in one vectorized step: the damage state is the number of
+    # limit states whose exceedance probability is above the uniform draw.
+    # Rows are processed in chunks to bound the size of the uniform matrix.
+    # If seed is given, the uniforms of row i come from position_uniforms()
+    # at positions[i] (default: i) instead of rng.
+    prob_ds = np.nan_to_num(np.asarray(prob_ds, dtype=np.float32), nan=0)
+    if prob_ds.ndim == 1:
+        prob_ds = prob_ds[:, None]
+    if rng is None:
+        rng = np.random.default_rng()
+    n = len(prob_ds)
+    if seed is not None and positions is None:
+        positions = np.arange(n)
+    ds = np.zeros((n, n_realizations), dtype=np.uint8)
+    for start in range(0, n, chunk_size):
+        stop = min(start + chunk_size, n)
+        if seed is None:
+            u = rng.random((stop - start, n_realizations), dtype=np.float32)
+        else:
+            u = position_uniforms(seed, positions[start:stop], n_realizations)
+        for k in range(prob_ds.shape[1]):
+            ds[start:stop] += u < prob_ds[start:stop, k, None]
+    return ds
+
+def modal_damage_states(prob_ds):
+    # Most likely damage state from exceedance probabilities of shape
+    # (..., limit states): the state with the largest probability, ties going
+    # to the lower state as with idxmax over the ds_1..ds_5 columns
+    shape = prob_ds.shape[:-1]
+    prob = np.concatenate([np.ones(shape + (1,)), prob_ds, np.zeros(shape + (1,))], axis=-1)
+    diff = np.abs(prob[..., :-1] - prob[..., 1:])
+    diff[np.isnan(diff)] = -np.inf
+    return np.argmax(diff, axis=-1).astype(np.uint8)
+
+def lognormal_damage_probabilities(logim, log_medians, sigmas):
+    # Exceedance probabilities (elements x limit states) of lognormal
+    # fragility curves and the modal damage state. Elements sharing their
+    # fragility parameters and intensity, such as buildings of one taxonomy
+    # next to the same intensity point or pixel, are evaluated once: the
+    # (parameters, intensity) rows are factorized and the results broadcast
+    # back by code. sigmas is one dispersion per element or per limit state.
+    logim = np.asarray(logim, dtype=np.float64)
+    log_medians = np.asarray(log_medians, dtype=np.float64)
+    sigmas = np.broadcast_to(np.asarray(sigmas, dtype=np.float64).reshape(len(logim), -1), log_medians.shape)
+    # mixed-radix code of the per-column codes, compacted only when it
+    # would overflow
+    codes = np.zeros(len(logim), dtype=np.int64)
+    n_codes = 1
+    for column in [*log_medians.T, *sigmas.T, logim]:
+        column_codes, column_uniques = pd.factorize(column)
+        radix = len(column_uniques) + 1
+        if n_codes * radix >= 2**62:
+            codes, uniques = pd.factorize(codes)
+            n_codes = len(uniques)
+        codes = codes * radix + column_codes + 1
+        n_codes *= radix
+    codes, uniques = pd.factorize(codes)
+    first = np.zeros(len(uniques), dtype=np.int64)
+    first[codes[::-1]] = np.arange(len(codes))[::-1]
+    prob_ds = norm.cdf(logim[first, None], log_medians[first], sigmas[first])
+    ds = modal_damage_states(prob_ds).astype(np.int64)
+    return prob_ds[codes], ds[codes]
+
+# Policies are declarative transformation specs. Each spec has:
+#   policy:    policy id as listed in the app state
+#   stage:     pipeline step it belongs to (see below)
+#   hazards:   hazard types for which it is active, None means all
+#   mask:      list of mask terms combined with AND. A term is the name of an
+#              entry in POLICY_MASKS, ('rnd_below', p) for the building's
+#              'rnd' column, or ('random_below', p) for a fresh uniform draw
+#              shared by all specs of the same policy
+#   columns:   target columns, or the name of a column group supplied at apply time
+#   operation: 'set', 'multiply', 'add', 'add_capped' (add, capped at the
+#              column's maximum) or 'upgrade' (code level, LC -> MC -> HC)
+#   value:     constant or function of the policy parameters
+# Stages:
+#   building:           building attributes before the taxonomy is assembled
+#   fragility:          lognormal earthquake fragility medians
+#   gem_fragility:      intensity columns used by GEM discrete fragilities
+#   flood_vulnerability: water depth (intensity_columns) and flood damage curves
+#   road_fragility:     road/bridge earthquake fragility medians
+#   road_thresholds:    scalar water height thresholds of the road network
+# Specs of a stage are stacked in the order they appear in this list.
+# Each mask lists the columns it reads so that a pending change to one of
+# them is written before the mask is evaluated.
+POLICY_MASKS = {
+    'residential': (['occupancy'], lambda df: (df['occupancy'] == 'Res').to_numpy()),
+    'non_residential': (['occupancy'], lambda df: (df['occupancy'] != 'Res').to_numpy()),
+    'low_income': (['freqincome'], lambda df: ((df['freqincome'] == 'lowIncomeA') | (df['freqincome'] == 'lowIncomeB')).to_numpy()),
+    'special_facility': (['specialfac'], lambda df: (df['specialfac'] != 0).to_numpy()),
+    'education_or_health': (['occupancy'], lambda df: ((df['occupancy'] == 'Edu') | (df['occupancy'] == 'Hea')).to_numpy()),
+    'low_income_zone': (['avgincome'], lambda df: (df['avgincome'] == 'lowIncomeA').to_numpy()),
+}
+
+CODE_LEVELS = ['LC','MC','HC']
+
+def code_upgrade_specs(policy, fraction):
+    # A random fraction of buildings is upgraded by one code level and,
+    # for flood and debris, gains one storey
+    return [{'policy': policy, 'stage': 'building', 'hazards': None, 'mask': [('random_below', fraction)],
+             'columns': ['code_level'], 'operation': 'upgrade', 'value': 1},
+            {'policy': policy, 'stage': 'building', 'hazards': ['flood','debris'], 'mask': [('random_below', fraction)],
+             'columns': ['height'], 'operation': 'add_capped', 'value': 1}]
+
+def increase_cdf_median(p):
+    return 1 + p['cdf_median_increase_in_percent']
+
+def decrease_gem_intensity(p):
+    # In GEM data we use, we have a discretized CDF so less means more robust to damage
+    return 1 - p['cdf_median_increase_in_percent']
+
+def reduce_flood_depth(p):
+    return -p['flood_depth_reduction']
+
+def suppress_damage_curve(p):
+    return p['damage_curve_suppress_factor']
+
+POLICY_SPECS = [
+    {'policy': 7, 'stage': 'building', 'hazards': ['flood','debris'], 'mask': [('rnd_below', 0.70), 'residential'],
+     'columns': ['occupancy'], 'operation': 'set', 'value': 'Agri'},
+    {'policy': 10, 'stage': 'building', 'hazards': ['flood','debris'], 'mask': [('rnd_below', 0.80)],
+     'columns': ['occupancy'], 'operation': 'set', 'value': 'Agri'},
+    *code_upgrade_specs(11, 0.50),
+    *code_upgrade_specs(12, 0.50),
+    *code_upgrade_specs(19, 0.50),
+    *code_upgrade_specs(14, 0.10),
+    *code_upgrade_specs(15, 0.10),
+    *code_upgrade_specs(20, 0.10),
+    # Policies 16 and 17 do not change code_level, only the number of storeys
+    {'policy': 16, 'stage': 'building', 'hazards': ['flood','debris'], 'mask': ['special_facility'],
+     'columns': ['height'], 'operation': 'add_capped', 'value': 6},
+    {'policy': 17, 'stage': 'building', 'hazards': ['flood','debris'], 'mask': ['education_or_health'],
+     'columns': ['height'], 'operation': 'add_capped', 'value': 6},
+    {'policy': 18, 'stage': 'building', 'hazards': None, 'mask': ['low_income_zone'],
+     'columns': ['code_level'], 'operation': 'upgrade', 'value': 1},
+    {'policy': 18, 'stage': 'building', 'hazards': ['flood','debris'], 'mask': ['low_income_zone'],
+     'columns': ['height'], 'operation': 'add_capped', 'value': 1},
+
+    {'policy': 1, 'stage': 'fragility', 'hazards': None, 'mask': ['residential'],
+     'columns': 'median_columns', 'operation': 'multiply', 'value': increase_cdf_median},
+    {'policy': 2, 'stage': 'fragility', 'hazards': None, 'mask': ['residential', 'low_income'],
+     'columns': 'median_columns', 'operation': 'multiply', 'value': increase_cdf_median},
+    # Special buildings are immune to damage
+    {'policy': 5, 'stage': 'fragility', 'hazards': None, 'mask': ['non_residential'],
+     'columns': 'median_columns', 'operation': 'set', 'value': 99999},
+    {'policy': 6, 'stage': 'fragility', 'hazards': None, 'mask': ['residential'],
+     'columns': 'median_columns', 'operation': 'multiply', 'value': increase_cdf_median},
+    {'policy': 8, 'stage': 'fragility', 'hazards': None, 'mask': ['residential'],
+     'columns': 'median_columns', 'operation': 'multiply', 'value': increase_cdf_median},
+
+    {'policy': 1, 'stage': 'gem_fragility', 'hazards': None, 'mask': ['residential'],
+     'columns': 'intensity_columns', 'operation': 'multiply', 'value': decrease_gem_intensity},
+    {'policy': 2, 'stage': 'gem_fragility', 'hazards': None, 'mask': ['residential', 'low_income'],
+     'columns': 'intensity_columns', 'operation': 'multiply', 'value': decrease_gem_intensity},
+    {'policy': 5, 'stage': 'gem_fragility', 'hazards': None, 'mask': ['non_residential'],
+     'columns': 'intensity_columns', 'operation': 'set', 'value': 0},
+    {'policy': 6, 'stage': 'gem_fragility', 'hazards': None, 'mask': ['residential'],
+     'columns': 'intensity_columns', 'operation': 'multiply', 'value': decrease_gem_intensity},
+    {'policy': 8, 'stage': 'gem_fragility', 'hazards': None, 'mask': ['residential'],
+     'columns': 'intensity_columns', 'operation': 'multiply', 'value': decrease_gem_intensity},
+
+    {'policy': 1, 'stage': 'flood_vulnerability', 'hazards': None, 'mask': [],
+     'columns': 'intensity_columns', 'operation': 'add', 'value': reduce_flood_depth},
+    {'policy': 2, 'stage': 'flood_vulnerability', 'hazards': None, 'mask': ['residential', 'low_income'],
+     'columns': 'intensity_columns', 'operation': 'add', 'value': reduce_flood_depth},
+    {'policy': 3, 'stage': 'flood_vulnerability', 'hazards': None, 'mask': [],
+     'columns': 'intensity_columns', 'operation': 'add', 'value': reduce_flood_depth},
+    {'policy': 5, 'stage': 'flood_vulnerability', 'hazards': None, 'mask': ['non_residential'],
+     'columns': 'intensity_columns', 'operation': 'set', 'value': 0},
+    {'policy': 6, 'stage': 'flood_vulnerability', 'hazards': None, 'mask': ['residential'],
+     'columns': 'intensity_columns', 'operation': 'add', 'value': reduce_flood_depth},
+    {'policy': 8, 'stage': 'flood_vulnerability', 'hazards': None, 'mask': ['residential'],
+     'columns': 'damage_curve_columns', 'operation': 'multiply', 'value': suppress_damage_curve},
+    {'policy': 9, 'stage': 'flood_vulnerability', 'hazards': None, 'mask': [],
+     'columns': 'damage_curve_columns', 'operation': 'multiply', 'value': suppress_damage_curve},
+
+    {'policy': 4, 'stage': 'road_fragility', 'hazards': None, 'mask': [],
+     'columns': 'median_columns', 'operation': 'multiply', 'value': increase_cdf_median},
+    {'policy': 4, 'stage': 'road_thresholds', 'hazards': None, 'mask': [],
+     'columns': ['road_water_height_threshold'], 'operation': 'add',
+     'value': lambda p: p['threshold_increase_road_water_height']},
+    {'policy': 4, 'stage': 'road_thresholds', 'hazards': None, 'mask': [],
+     'columns': ['culvert_water_height_threshold'], 'operation': 'add',
+     'value': lambda p: p['threshold_increase_culvert_water_height']},
+]
+
+def compile_policies(policies, stage, hazard_type, params={}):
+    # Resolve the specs of the selected policies for one stage into a list
+    # of steps, in stacking order, with parameter-dependent values evaluated
+    steps = []
+    for spec in POLICY_SPECS:
+        if spec['policy'] not in policies or spec['stage'] != stage:
+            continue
+        if spec['hazards'] is not None and hazard_type not in spec['hazards']:
+            continue
+        value = spec['value'](params) if callable(spec['value']) else spec['value']
+        steps.append({**spec, 'value': value})
+    return steps
+
+def policy_mask_columns(term):
+    if isinstance(term, tuple):
+        return ['rnd'] if term[0] == 'rnd_below' else []
+    return POLICY_MASKS[term][0]
+
+def evaluate_policy_mask(df, step, cache, random_draws):
+    mask = np.ones(len(df), dtype=bool)
+    for term in step['mask']:
+        if isinstance(term, tuple) and term[0] == 'random_below':
+            # one draw per policy, in stacking order, shared by its specs
+            if step['policy'] not in random_draws:
+                random_draws[step['policy']] = np.random.random(len(df))
+            term_mask = random_draws[step['policy']] < term[1]
+        else:
+            if term not in cache:
+                if isinstance(term, tuple) and term[0] == 'rnd_below':
+                    cache[term] = df['rnd'].to_numpy() < term[1]
+                else:
+                    cache[term] = POLICY_MASKS[term][1](df)
+            term_mask = cache[term]
+        mask = mask & term_mask
+    return mask
+
+def write_policy_column(df, col, s):
+    # Write the accumulated effect of the policy steps on one column
+    if s['kind'] == 'categorical':
+        values = df[col].astype(object).to_numpy()
+        overridden = np.array([v is not None for v in s['override']], dtype=bool)
+        values = np.where(overridden, s['override'], values)
+        upgraded = s['upgrades'] > 0
+        if upgraded.any():
+            level = pd.Index(CODE_LEVELS).get_indexer(values)
+            on_ladder = upgraded & (level >= 0)
+            new_level = np.minimum(level + s['upgrades'], len(CODE_LEVELS) - 1)
+            values[on_ladder] = np.array(CODE_LEVELS, dtype=object)[new_level[on_ladder]]
+        df[col] = values
+    else:
+        original = df[col]
+        values = original.to_numpy(dtype=np.float64) * s['scale'] + s['offset']
+        if s['cap'] is not None:
+            values = np.minimum(values, s['cap'])
+        if pd.api.types.is_integer_dtype(original.dtype):
+            values = values.astype(original.dtype)
+        df[col] = values
+
+def apply_policies(df, steps, column_groups={}, random_draws=None, caps=None):
+    # Fused application of compiled policy steps. Every mask is evaluated once
+    # and the effect of all steps on a column is accumulated before the column
+    # is written, so the cost stays flat in the number of selected policies.
+    # Numeric operations compose exactly as affine maps (scale, offset) per
+    # row; 'set' on a categorical column overrides the value and 'upgrade'
+    # counts code level steps applied after the last override. A column is
+    # written early only if a later mask reads it.
+    # random_draws (policy -> array aligned with df) and caps (column -> cap of
+    # add_capped steps) replace the draws and column maxima taken from df, for
+    # callers that apply the policies to one part of a larger frame.
+    if len(steps) == 0:
+        return df
+    cache = dict()
+    random_draws = dict() if random_draws is None else dict(random_draws)
+    state = dict()
+    for step in steps:
+        for term in step['mask']:
+            for col in policy_mask_columns(term):
+                if col in state:
+                    write_policy_column(df, col, state.pop(col))
+                    for cached_term in [t for t in cache if col in policy_mask_columns(t)]:
+                        del cache[cached_term]
+        mask = evaluate_policy_mask(df, step, cache, random_draws)
+        columns = column_groups[step['columns']] if isinstance(step['columns'], str) else step['columns']
+        op, value = step['operation'], step['value']
+        for col in columns:
+            categorical = op == 'upgrade' or (op == 'set' and isinstance(value, str))
+            if col not in state:
+                if categorical:
+                    state[col] = {'kind': 'categorical', 'override': np.full(len(df), None, dtype=object),
+                                  'upgrades': np.zeros(len(df), dtype=np.int64)}
+                else:
+                    state[col] = {'kind': 'numeric', 'scale': np.ones(len(df)), 'offset': np.zeros(len(df)), 'cap': None}
+            s = state[col]
+            if s['kind'] == 'categorical':
+                if op == 'set':
+                    s['override'][mask] = value
+                    s['upgrades'][mask] = 0
+                elif op == 'upgrade':
+                    s['upgrades'][mask] += value
+                else:
+                    raise ValueError(f'Operation {op} is not supported on categorical column {col}')
+            else:
+                if op == 'multiply':
+                    s['scale'][mask] *= value
+                    s['offset'][mask] *= value
+                elif op == 'add':
+                    s['offset'][mask] += value
+                elif op == 'add_capped':
+                    # capped additions must be non-negative so that a single cap at
+                    # the end is the same as capping after every step
+                    s['offset'][mask] += value
+                    s['cap'] = caps[col] if caps is not None and col in caps else df[col].max()
+                elif op == 'set':
+                    s['scale'][mask] = 0
+                    s['offset'][mask] = value
+                else:
+                    raise ValueError(f'Operation {op} is not supported on numeric column {col}')
+
+    for col, s in state.items():
+        write_policy_column(df, col, s)
+    return df
+
+def apply_policies_to_values(values, steps):
+    # Same as apply_policies, for scalar parameters
+    values = dict(values)
+    for step in steps:
+        for col in step['columns']:
+            if step['operation'] == 'add':
+                values[col] += step['value']
+            elif step['operation'] == 'multiply':
+                values[col] *= step['value']
+            elif step['operation'] == 'set':
+                values[col] = step['value']
+            else:
+                raise ValueError(f"Operation {step['operation']} is not supported on scalar {col}")
+    return values
+
+def landslide_susceptibility(im):
+    # Landslide intensity maps hold susceptibility classes: 2 is medium, 3 is high, anything else low
+    susceptibility = pd.Series('low', index=im.index, dtype=object)
+    susceptibility[im == 2.0] = 'medium'
+    susceptibility[im == 3.0] = 'high'
+    return susceptibility
+
+def building_landslide_fragility(gdf_building_intensity, df_hazard):
+    # Collapse probability of every building, joined on integer-coded
+    # material+code_level+susceptibility keys
+    gdf_building_intensity['susceptibility'] = landslide_susceptibility(gdf_building_intensity['im'])
+    hazard_keys = taxonomy_dictionary.composite_key_from_strings(df_hazard['expstr'], ['material','code_level'],
+                                    extra_components=[('susceptibility', df_hazard['susceptibility'])])
+    building_keys = taxonomy_dictionary.composite_key([('material', gdf_building_intensity['material']),
+                                                       ('code_level', gdf_building_intensity['code_level']),
+                                                       ('susceptibility', gdf_building_intensity['susceptibility'])])
+    return taxonomy_join(gdf_building_intensity.reset_index(drop=True), df_hazard,
+                         taxonomy_dictionary.lookup(hazard_keys, building_keys))
+
+def road_landslide_fragility(gdf_edges, fragility):
+    # Collapse probability of every road edge, joined on integer-coded
+    # (expstr, susceptibility) keys where expstr is always 'roads'
+    gdf_edges['susceptibility'] = landslide_susceptibility(gdf_edges['im'])
+    fragility_keys = taxonomy_dictionary.composite_key([('expstr', fragility['expstr']),
+                                                        ('susceptibility', fragility['susceptibility'])])
+    edge_keys = taxonomy_dictionary.composite_key([('expstr', np.full(len(gdf_edges), 'roads', dtype=object)),
+                                                   ('susceptibility', gdf_edges['susceptibility'])])
+    return taxonomy_join(gdf_edges, fragility, taxonomy_dictionary.lookup(fragility_keys, edge_keys))
+
+def power_landslide_fragility(gdf_nodes, fragility):
+    # Collapse probability of every power node, joined on integer-coded
+    # (ls_frgl, susceptibility) keys. A given ls_susceptibility overrides the map.
+    if 'ls_susceptibility' in gdf_nodes.columns:
+        gdf_nodes['susceptibility'] = gdf_nodes['ls_susceptibility']
+    else:
+        gdf_nodes['susceptibility'] = landslide_susceptibility(gdf_nodes['im'])
+    fragility_keys = taxonomy_dictionary.composite_key([('expstr', fragility['expstr']),
+                                                        ('susceptibility', fragility['susceptibility'])])
+    node_keys = taxonomy_dictionary.composite_key([('expstr', gdf_nodes['ls_frgl']),
+                                                   ('susceptibility', gdf_nodes['susceptibility'])])
+    return taxonomy_join(gdf_nodes, fragility, taxonomy_dictionary.lookup(fragility_keys, node_keys))
+
+def road_edge_intensity(gdf_edges, gdf_intensity, distance, sampling='max', fingerprints=(None, None)):
+    # Intensity of every road edge for flood, debris and landslide.
+    # 'max': the maximum intensity within distance of the edge (pixels
+    # crossed by the edge for raster intensity), with its mean and the number
+    # of samples as im_mean and im_count. Edges without samples, such as
+    # edges between the points of a grid coarser than distance, take the
+    # intensity of the nearest point as with 'nearest'.
+    # 'nearest': the intensity point nearest to the whole edge.
+    # fingerprints are the geometry fingerprints of the edges and intensity if known.
+    if sampling == 'nearest':
+        gdf_edges = join_intensity(gdf_edges, gdf_intensity, rsuffix='intensity', distance_col='distance',
+                                   fingerprints=fingerprints)
+        return gdf_edges.drop_duplicates(subset=['edge_id'], keep='first')
+    stats = sample_edge_intensity(gdf_edges, gdf_intensity, distance, fingerprints=fingerprints)
+    unsampled = (stats['im_count'] == 0).to_numpy()
+    if unsampled.any():
+        nearest = join_intensity(gdf_edges[unsampled][['edge_id', 'geometry']], gdf_intensity, rsuffix='intensity',
+                                 fingerprints=(None, fingerprints[1]))
+        nearest = nearest.drop_duplicates(subset=['edge_id'], keep='first').set_index('edge_id')['im']
+        stats.loc[unsampled, 'im'] = nearest.reindex(gdf_edges['edge_id'][unsampled]).to_numpy()
+        stats.loc[unsampled, 'im_mean'] = stats.loc[unsampled, 'im']
+    gdf_edges = gdf_edges.drop(columns=stats.columns, errors='ignore')
+    for col in stats.columns:
+        gdf_edges[col] = stats[col].to_numpy()
+    return gdf_edges
 
 def compute_road_infra(buildings, household, individual,
                         nodes, edges, intensity, fragility, hazard, 
@@ -30,13 +591,28 @@ def compute_road_infra(buildings, household, individual,
                         cdf_median_increase_in_percent = 0.2,
                         threshold_increase_culvert_water_height = 0.2,
                         threshold_increase_road_water_height = 0.2,
+                        edge_intensity_sampling = None,
+                        fingerprints = None,
                         ):
-
-    if 4 in policies:
-        road_water_height_threshold += threshold_increase_road_water_height
-        culvert_water_height_threshold += threshold_increase_culvert_water_height
-        print(f'road_water_height_threshold is increased to {road_water_height_threshold} by {threshold_increase_road_water_height} by policy 4')
-        print(f'culvert_water_height_threshold is increased to {culvert_water_height_threshold} by {threshold_increase_culvert_water_height} by policy 4')
+    # edge_intensity_sampling is passed on to road_edge_intensity(); by default
+    # 'nearest' for landslide, whose susceptibility classes are not maxed
+    # along the edge, and 'max' for flood and debris. fingerprints are the
+    # geometry fingerprints of the layers, see compute().
+    if edge_intensity_sampling is None:
+        edge_intensity_sampling = 'nearest' if hazard == 'landslide' else 'max'
+
+    policy_params = {'cdf_median_increase_in_percent': cdf_median_increase_in_percent,
+                     'threshold_increase_culvert_water_height': threshold_increase_culvert_water_height,
+                     'threshold_increase_road_water_height': threshold_increase_road_water_height}
+    threshold_steps = compile_policies(policies, 'road_thresholds', hazard, policy_params)
+    if len(threshold_steps) > 0:
+        thresholds = apply_policies_to_values({'road_water_height_threshold': road_water_height_threshold,
+                                               'culvert_water_height_threshold': culvert_water_height_threshold},
+                                              threshold_steps)
+        road_water_height_threshold = thresholds['road_water_height_threshold']
+        culvert_water_height_threshold = thresholds['culvert_water_height_threshold']
+        print(f'road_water_height_threshold is increased to {road_water_height_threshold} by policies {policies}')
+        print(f'culvert_water_height_threshold is increased to {culvert_water_height_threshold} by policies {policies}')
 
     earthquake_intensity_normalization_factor = 1
     if earthquake_intensity_unit == 'm/s2':
@@ -52,65 +628,32 @@ def compute_road_infra(buildings, household, individual,
     # we consider the associated node as dead.
     threshold = DS_SLIGHT
 
-    gdf_buildings = buildings.set_crs("EPSG:4326",allow_override=True)
-    gdf_intensity = intensity.set_crs("EPSG:4326",allow_override=True)
-    gdf_nodes = nodes.set_crs("EPSG:4326",allow_override=True)
-    gdf_edges = edges.set_crs("EPSG:4326",allow_override=True)
-
+    # Projected layers are cached until their geometries change.
+    # Raster intensity layers are sampled in their own CRS
     epsg = 3857 
-    gdf_buildings = gdf_buildings.to_crs(f"EPSG:{epsg}")
-    gdf_intensity = gdf_intensity.to_crs(f"EPSG:{epsg}")
-    gdf_nodes = gdf_nodes.to_crs(f"EPSG:{epsg}")
-    gdf_edges = gdf_edges.to_crs(f"EPSG:{epsg}")
-
-
-    G = nx.DiGraph()
-    for _, node in gdf_nodes.iterrows():
-        G.add_node(node.node_id, pos=(node.geometry.x, node.geometry.y))
-        
-    for _, edge in gdf_edges.iterrows():
-        G.add_edge(*(edge.from_node, edge.to_node))  
-
-    # If the directions are not important, convert to undirected graph 
-    if not preserve_edge_directions:
-        G = nx.Graph(G)
+    fingerprints = dict() if fingerprints is None else fingerprints
+    gdf_buildings = project_layer(buildings, epsg, fingerprints.get('building'))
+    gdf_intensity = intensity if isinstance(intensity, RasterIntensity) else \
+        project_layer(intensity, epsg, fingerprints.get('intensity'))
+    gdf_nodes = project_layer(nodes, epsg, fingerprints.get('road nodes'))
+    gdf_edges = project_layer(edges, epsg, fingerprints.get('road edges'))
+    projected = {name: projected_fingerprint(f, epsg) for name, f in fingerprints.items()}
 
     gdf_buildings = gdf_buildings.drop(columns=['node_id'])
-    gdf_buildings = gpd.sjoin_nearest(gdf_buildings,gdf_nodes, 
-                how='left', rsuffix='road_node',distance_col='road_node_distance')
+    gdf_buildings = cached_sjoin_nearest(gdf_buildings,gdf_nodes, 
+                how='left', rsuffix='road_node',distance_col='road_node_distance',
+                fingerprints=(projected.get('building'), projected.get('road nodes')))
 
     if hazard in ['flood', 'debris','landslide']:
-        gdf_edges = gpd.sjoin_nearest(gdf_edges, gdf_intensity, how='left',
-                                          rsuffix='intensity',distance_col='distance')
-        gdf_edges = gdf_edges.drop_duplicates(subset=['edge_id'], keep='first')
-        # TODO: sjoin_nearest or the approach below: compare
-        #roads_with_width = gdf_edges['geometry'].buffer(threshold_flood_distance)
-        #for i, road in enumerate(roads_with_width):
-        #    print(i)
-        #    within_ims = gdf_intensity.clip(road)
-        #    if len(within_ims) > 0:
-        #        max_im = within_ims['im'].max()
-        #    else:
-        #        max_im = 0
-        #    gdf_edges.loc[i,'im'] = max_im
+        gdf_edges = road_edge_intensity(gdf_edges, gdf_intensity, threshold_flood_distance, edge_intensity_sampling,
+                                        fingerprints=(projected.get('road edges'), projected.get('intensity')))
         if hazard == 'landslide':
-            print('before')
-            print(gdf_edges.loc[0])
-            gdf_edges['susceptibility'] = 'low'
-            gdf_edges.loc[gdf_edges['im'] == 2.0, 'susceptibility'] = 'medium'
-            gdf_edges.loc[gdf_edges['im'] == 3.0, 'susceptibility'] = 'high'
-
-            fragility['landslide_expstr'] = fragility['expstr'].astype(str) + "+"+ fragility["susceptibility"].astype(str) 
-            gdf_edges['landslide_expstr'] = 'roads' 
-            gdf_edges['landslide_expstr'] = gdf_edges['landslide_expstr'] + "+" + gdf_edges['susceptibility'].astype(str)
-            gdf_edges = gdf_edges.merge(fragility, on='landslide_expstr', how='left')
+            gdf_edges = road_landslide_fragility(gdf_edges, fragility)
             gdf_edges['ds'] = DS_NO
             gdf_edges['rnd'] = np.random.random((len(gdf_edges),1))
             collapsed_idx = (gdf_edges['rnd'] < gdf_edges['collapse_probability']) 
             gdf_edges.loc[collapsed_idx, 'ds'] = DS_COMPLETE
             gdf_edges.loc[collapsed_idx, 'is_damaged'] = True
-            print('after')
-            print(gdf_edges.loc[0])
         else:
             non_bridges = gdf_edges['bridge_type'].isna()
             culverts = gdf_edges['bridge_type'] == "culvert"
@@ -130,20 +673,20 @@ def compute_road_infra(buildings, household, individual,
 
         gdf_edges_centroids = gdf_edges.copy()
         gdf_edges_centroids['geometry'] = gdf_edges_centroids.geometry.centroid
-        gdf_edges = gpd.sjoin_nearest(gdf_edges_centroids, gdf_intensity,how='left',rsuffix='intensity',distance_col='intensity_distance')
+        gdf_edges = join_intensity(gdf_edges_centroids, gdf_intensity,rsuffix='intensity',distance_col='intensity_distance')
         
         gdf_edges = gdf_edges.merge(fragility, how='left',left_on='bridge_type',right_on='vuln_string')
 
+        # Increase medians *cdf_median_increase_in_percent* (policy 4).
+        # Applied before the defaults below so that only known medians change.
+        med_cols = ['med_ds1','med_ds2','med_ds3','med_ds4']
+        gdf_edges = apply_policies(gdf_edges, compile_policies(policies, 'road_fragility', hazard, policy_params),
+                                   column_groups={'median_columns': med_cols})
+
         nulls = gdf_edges['med_ds1'].isna()
-        notnulls = gdf_edges['med_ds1'].notna()
         gdf_edges.loc[nulls, ['med_ds1','med_ds2','med_ds3','med_ds4']] = [99999,99999,99999,99999]
         gdf_edges.loc[nulls, ['dispersion']] = [1]
 
-        med_cols = ['med_ds1','med_ds2','med_ds3','med_ds4']
-        if 4 in policies:
-            # Increase medians *cdf_median_increase_in_percent*
-            gdf_edges.loc[notnulls, med_cols] = gdf_edges.loc[notnulls, med_cols] * ( 1 + cdf_median_increase_in_percent )
-
         #gdf_edges['log_im'] = np.log(gdf_edges['im'])
         if 'im' in gdf_edges.columns:
             gdf_edges['log_im'] = np.log(gdf_edges['im']/earthquake_intensity_normalization_factor)
@@ -153,13 +696,9 @@ def compute_road_infra(buildings, household, individual,
         for m in ['med_ds1','med_ds2','med_ds3','med_ds4']:
             gdf_edges[m] = np.log(gdf_edges[m])
 
-        for i in [1,2,3,4]: 
-            gdf_edges[f'prob_ds{i}'] = norm.cdf(gdf_edges['log_im'],gdf_edges[f'med_ds{i}'],gdf_edges['dispersion'])
-        gdf_edges[['prob_ds0','prob_ds5']] = [1,0]
-        for i in [1,2,3,4,5]:
-            gdf_edges[f'ds_{i}'] = np.abs(gdf_edges[f'prob_ds{i-1}'] - gdf_edges[f'prob_ds{i}'])
-        df_ds = gdf_edges[['ds_1','ds_2','ds_3','ds_4','ds_5']]
-        gdf_edges['ds'] = df_ds.idxmax(axis='columns').str.extract(r'ds_([0-9]+)').astype('int') - 1
+        prob_ds, ds = lognormal_damage_probabilities(gdf_edges['log_im'], gdf_edges[med_cols], gdf_edges['dispersion'])
+        gdf_edges[['prob_ds1','prob_ds2','prob_ds3','prob_ds4']] = prob_ds
+        gdf_edges['ds'] = ds
 
         gdf_edges.loc[gdf_edges['ds'] > threshold,'is_damaged'] = True
 
@@ -172,38 +711,30 @@ def compute_road_infra(buildings, household, individual,
     hospital_nodes = set(building_count_on_nodes[(building_count_on_nodes['occupancy'] == 'Hea') & (building_count_on_nodes['buildings'] > 0)]['node_id'])
     source_nodes = non_empty_nodes - hospital_nodes
 
-    # Remove damaged roads/bridges
-    G_dmg = G.copy()
-    for i, edge in gdf_edges.iterrows():
-        if edge['is_damaged']:
-            try:
-                G_dmg.remove_edge(*(edge.from_node, edge.to_node))
-            except:
-                # when remove an edge multiple times, ignore error
-                pass
-
-    print('network before ', G)
-    print('network after  ', G_dmg)
-
     household_w_node_id = household.drop(columns=['node_id']).merge(gdf_buildings[['bldid','node_id']], on='bldid', how='left')
     household_w_node_id['hospital_access'] = False
 
-    # For each node which at least one hospital assigned to
-    for hospital_node in hospital_nodes:
-        # every node that can reach to hospital_node
-        for node_with_hospital_access in nx.ancestors(G_dmg, hospital_node) | {hospital_node}:
-            # find the buildings associated with node_with_hospital_access
-            idx = gdf_buildings['node_id'] == node_with_hospital_access
-            # these buildings have access to hospital_node
-            gdf_buildings.loc[idx, 'hospital_access'] = True
-
-            # for each hospital connected to hospital_node
-            for hospital_bld in gdf_buildings[(gdf_buildings['node_id'] == hospital_node) & (gdf_buildings['occupancy'] == 'Hea')]['bldid']:
-                # find the households satisfying:
-                #  - if the hospital is the household's community hospital
-                #  - and household's building is reachable from that hospital
-                idx = (household_w_node_id['commfacid'] == hospital_bld) & (household_w_node_id['node_id'] == node_with_hospital_access)
-                household_w_node_id.loc[idx, 'hospital_access'] = True
+    # Remove damaged roads/bridges by masking the edges of the compiled network
+    topology = network_topology(gdf_nodes['node_id'], gdf_edges['from_node'], gdf_edges['to_node'])
+    alive = topology.alive_edges(gdf_edges['is_damaged'].astype(bool).to_numpy(), preserve_edge_directions)
+
+    # Buildings whose node can reach a node with a hospital: one traversal
+    # of the reversed network from all hospital nodes
+    hospital_pos = topology.positions(pd.Series(list(hospital_nodes), dtype=object))
+    reaches_hospital = topology.reachable_from_any(alive, hospital_pos[hospital_pos > -1], preserve_edge_directions,
+                                                   reverse=True)
+    building_node = topology.positions(gdf_buildings['node_id'])
+    gdf_buildings.loc[gather(reaches_hospital, building_node, False).astype(bool), 'hospital_access'] = True
+
+    # Households whose node can reach the node of their community hospital
+    hospitals = gdf_buildings.loc[gdf_buildings['occupancy'] == 'Hea', ['bldid','node_id']]
+    pairs = household_w_node_id[['commfacid','node_id']].reset_index(drop=True).reset_index()\
+            .merge(hospitals, left_on='commfacid', right_on='bldid', suffixes=('','_hospital'))
+    reachability = topology.reachability(alive, preserve_edge_directions)
+    access = reachability.reachable(topology.positions(pairs['node_id']), topology.positions(pairs['node_id_hospital']))
+    household_access = np.zeros(len(household_w_node_id), dtype=bool)
+    household_access[pairs['index'].to_numpy()[access]] = True
+    household_w_node_id['hospital_access'] = household_access
 
     # Workplace/School (facility) connectivity analysis
     # For each individual, find the closest road node (closest) of the
@@ -221,27 +752,86 @@ def compute_road_infra(buildings, household, individual,
                         .rename(columns={'node_id':'facility_node_id'})
     print('individual_w_nodes')
     print(individual_w_nodes)
-    # Calculate distances between all nodes in the damaged network
-    # If graph is directed, shortest path calculation obeys the directions
-    shortest_distance = nx.shortest_path_length(G_dmg)
-
-    # Create a dictionary to store all open connections
-    connection_dict = dict()
-    for source, targets in shortest_distance:
-        connection_dict[source] = dict()
-        for target, hop in targets.items():
-            connection_dict[source][target] = True
 
     # Based on connectivity, fill-in facillity_access attribute in the individual layer
-    print(individual_w_nodes)
-    individual_w_nodes['facility_access'] = individual_w_nodes.apply(lambda x: x['facility_node_id'] in connection_dict[x['household_node_id']].keys(),axis=1)
+    # If graph is directed, reachability obeys the directions
+    individual_w_nodes['facility_access'] = reachability.reachable(topology.positions(individual_w_nodes['household_node_id']),
+                                                                   topology.positions(individual_w_nodes['facility_node_id']))
 
     return gdf_edges['ds'], gdf_edges['is_damaged'], gdf_buildings['node_id'], gdf_buildings['hospital_access'], household_w_node_id['node_id'], household_w_node_id['hospital_access'], individual_w_nodes['facility_access']
 
+def compute_hospital_distance(buildings, household, nodes, edges, hazard, preserve_edge_directions, fingerprints=None):
+    # Road network distance from every building and household to the nearest
+    # operational hospital after the event, and its increase over the
+    # pre-event distance. Damaged roads/bridges are read from edges['is_damaged']
+    # as computed by compute_road_infra, and hospitals whose buildings['ds']
+    # is above the metric threshold are not operational, so building damage
+    # of the same event must be computed first. Edge lengths come from the length
+    # attribute, or from the projected geometry where it is missing.
+    # Each network state costs one multi-source Dijkstra, whatever the number
+    # of buildings. fingerprints are the geometry fingerprints of the layers,
+    # see compute().
+    DS_NO = 0
+    DS_SLIGHT = 1
+    threshold = DS_SLIGHT if hazard == 'earthquake' else DS_NO
+
+    epsg = 3857
+    fingerprints = dict() if fingerprints is None else fingerprints
+    gdf_buildings = project_layer(buildings, epsg, fingerprints.get('building'))
+    gdf_nodes = project_layer(nodes, epsg, fingerprints.get('road nodes'))
+    gdf_edges = project_layer(edges, epsg, fingerprints.get('road edges'))
+
+    topology = network_topology(gdf_nodes['node_id'], gdf_edges['from_node'], gdf_edges['to_node'])
+    lengths = gdf_edges.geometry.length.to_numpy(dtype=np.float64)
+    if 'length' in gdf_edges.columns:
+        given = pd.to_numeric(gdf_edges['length'], errors='coerce').to_numpy(dtype=np.float64)
+        lengths = np.where(np.isnan(given), lengths, given)
+    damaged = np.zeros(topology.n_edges, dtype=bool)
+    if 'is_damaged' in gdf_edges.columns:
+        damaged = gdf_edges['is_damaged'].fillna(False).astype(bool).to_numpy()
+    alive = topology.alive_edges(damaged, preserve_edge_directions)
+
+    # Nearest road node of every building, first match on ties
+    nearest = cached_sjoin_nearest(gdf_buildings.drop(columns=['node_id'], errors='ignore'), gdf_nodes,
+                how='left', rsuffix='road_node', distance_col='road_node_distance',
+                fingerprints=(projected_fingerprint(fingerprints.get('building'), epsg),
+                              projected_fingerprint(fingerprints.get('road nodes'), epsg)))
+    nearest = nearest[~nearest.index.duplicated(keep='first')]
+    building_node = topology.positions(nearest['node_id'])
+
+    hospitals = (gdf_buildings['occupancy'] == 'Hea').to_numpy()
+    operational = hospitals.copy()
+    if 'ds' in gdf_buildings.columns:
+        operational &= ~(gdf_buildings['ds'] > threshold).to_numpy()
+    hospital_node = building_node[hospitals]
+    operational_node = building_node[operational]
+
+    # Travel is from the buildings to the hospitals, so directed networks are
+    # traversed backwards from the hospital nodes
+    before = topology.distances_from_any(np.ones(topology.n_edges, dtype=bool), lengths,
+                                         hospital_node[hospital_node > -1], preserve_edge_directions, reverse=True)
+    after = topology.distances_from_any(alive, lengths, operational_node[operational_node > -1],
+                                        preserve_edge_directions, reverse=True)
+
+    building_distance = gather(after, building_node)
+    with np.errstate(invalid='ignore'):
+        # nan if the building had no access before the event either
+        building_increase = building_distance - gather(before, building_node)
+
+    # Households take the values of their building, the first one if bldids repeat
+    by_bldid = pd.DataFrame({'distance': building_distance, 'increase': building_increase},
+                            index=gdf_buildings['bldid'].to_numpy())
+    by_bldid = by_bldid[~by_bldid.index.duplicated(keep='first')]
+
+    return pd.Series(building_distance, index=buildings.index), pd.Series(building_increase, index=buildings.index), \
+           household['bldid'].map(by_bldid['distance']), household['bldid'].map(by_bldid['increase'])
+
 def compute_power_infra(buildings, household, nodes,edges,intensity,fragility,hazard,
                         threshold_flood, threshold_flood_distance, preserve_edge_directions,
                         earthquake_intensity_unit = 'm/s2',
+                        fingerprints = None,
                         ):
+    # fingerprints are the geometry fingerprints of the layers, see compute()
     earthquake_intensity_normalization_factor = 1
     if earthquake_intensity_unit == 'm/s2':
         earthquake_intensity_normalization_factor = 9.81
@@ -249,7 +839,8 @@ def compute_power_infra(buildings, household, nodes,edges,intensity,fragility,ha
     print(nodes.head())
     print(edges.head())
     print(fragility.head())
-    print(intensity.head())
+    if not isinstance(intensity, RasterIntensity):
+        print(intensity.head())
 
     DS_NO = 0
     DS_SLIGHT = 1
@@ -261,31 +852,24 @@ def compute_power_infra(buildings, household, nodes,edges,intensity,fragility,ha
     # we consider the associated node as dead.
     threshold = DS_MODERATE
 
-    gdf_buildings = buildings.set_crs("EPSG:4326",allow_override=True)
-    gdf_intensity = intensity.set_crs("EPSG:4326",allow_override=True)
-    gdf_nodes = nodes.set_crs("EPSG:4326",allow_override=True)
-    gdf_edges = edges.set_crs("EPSG:4326",allow_override=True)
-
+    # Projected layers are cached until their geometries change.
+    # Raster intensity layers are sampled in their own CRS
     epsg = 3857 
-    gdf_buildings = gdf_buildings.to_crs(f"EPSG:{epsg}")
-    gdf_intensity = gdf_intensity.to_crs(f"EPSG:{epsg}")
-    gdf_nodes = gdf_nodes.to_crs(f"EPSG:{epsg}")
-    gdf_edges = gdf_edges.to_crs(f"EPSG:{epsg}")
-
-    G_power = nx.DiGraph()
-    for _, node in gdf_nodes.iterrows():
-        G_power.add_node(node.node_id, pos=(node.geometry.x, node.geometry.y))
-        
-    for _, edge in edges.iterrows():
-        G_power.add_edge(*(edge.from_node, edge.to_node))  
-    
-    # If the directions are not important, convert to undirected graph 
-    if not preserve_edge_directions:
-        G_power = nx.Graph(G_power)
+    fingerprints = dict() if fingerprints is None else fingerprints
+    gdf_buildings = project_layer(buildings, epsg, fingerprints.get('building'))
+    gdf_intensity = intensity if isinstance(intensity, RasterIntensity) else \
+        project_layer(intensity, epsg, fingerprints.get('intensity'))
+    gdf_nodes = project_layer(nodes, epsg, fingerprints.get('power nodes'))
+    gdf_edges = project_layer(edges, epsg, fingerprints.get('power edges'))
+    projected = {name: projected_fingerprint(f, epsg) for name, f in fingerprints.items()}
+
+    # Compiled power network, cached until its nodes or edges change
+    topology = network_topology(gdf_nodes['node_id'], edges['from_node'], edges['to_node'])
 
     # Assign nearest intensity to power nodes
-    gdf_nodes = gpd.sjoin_nearest(gdf_nodes,gdf_intensity, 
-                how='left', rsuffix='intensity',distance_col='distance')
+    gdf_nodes = join_intensity(gdf_nodes,gdf_intensity, 
+                rsuffix='intensity',distance_col='distance',
+                fingerprints=(projected.get('power nodes'), projected.get('intensity')))
 
     if hazard == 'earthquake':
         fragility = fragility.rename(columns={"med_slight": "med_ds1", 
@@ -313,26 +897,14 @@ def compute_power_infra(buildings, household, nodes,edges,intensity,fragility,ha
         for m in ['med_ds1','med_ds2','med_ds3','med_ds4']:
             gdf_nodes[m] = np.log(gdf_nodes[m])
 
-        for i in [1,2,3,4]: 
-            gdf_nodes[f'prob_ds{i}'] = norm.cdf(gdf_nodes['logim'],gdf_nodes[f'med_ds{i}'],gdf_nodes[f'beta_ds{i}'])
-        gdf_nodes[['prob_ds0','prob_ds5']] = [1,0]
-        for i in [1,2,3,4,5]:
-            gdf_nodes[f'ds_{i}'] = np.abs(gdf_nodes[f'prob_ds{i-1}'] - gdf_nodes[f'prob_ds{i}'])
-        df_ds = gdf_nodes[['ds_1','ds_2','ds_3','ds_4','ds_5']]
-        gdf_nodes['ds'] = df_ds.idxmax(axis='columns').str.extract(r'ds_([0-9]+)').astype('int') - 1
+        prob_ds, ds = lognormal_damage_probabilities(gdf_nodes['logim'], gdf_nodes[['med_ds1','med_ds2','med_ds3','med_ds4']],
+                                                     gdf_nodes[['beta_ds1','beta_ds2','beta_ds3','beta_ds4']])
+        gdf_nodes[['prob_ds1','prob_ds2','prob_ds3','prob_ds4']] = prob_ds
+        gdf_nodes['ds'] = ds
     elif hazard == 'landslide':
         print(gdf_nodes.loc[0])
         gdf_nodes['rnd'] = np.random.random((len(gdf_nodes),1))
-        if 'ls_susceptibility' in gdf_nodes.columns:
-            gdf_nodes['susceptibility'] = gdf_nodes['ls_susceptibility']
-        else:
-            gdf_nodes['susceptibility'] = 'low'
-            gdf_nodes.loc[gdf_nodes['im'] == 2.0, 'susceptibility'] = 'medium'
-            gdf_nodes.loc[gdf_nodes['im'] == 3.0, 'susceptibility'] = 'high'
-        fragility['landslide_expstr'] = fragility['expstr'].astype(str) + "+"+ fragility["susceptibility"].astype(str) 
-        gdf_nodes['landslide_expstr'] = gdf_nodes['ls_frgl'].astype(str) + "+" \
-                                                   + gdf_nodes['susceptibility'].astype(str)
-        gdf_nodes = gdf_nodes.merge(fragility, on='landslide_expstr', how='left')
+        gdf_nodes = power_landslide_fragility(gdf_nodes, fragility)
         gdf_nodes['ds'] = DS_NO
         collapsed_idx = (gdf_nodes['rnd'] < gdf_nodes['collapse_probability']) 
         gdf_nodes.loc[collapsed_idx, 'ds'] = DS_COMPLETE
@@ -349,12 +921,9 @@ def compute_power_infra(buildings, household, nodes,edges,intensity,fragility,ha
             gdf_nodes.loc[idx, 'im'] = gdf_nodes['fl_water_depth']
 
         gdf_nodes = gdf_nodes.merge(fragility, left_on='fl_vuln', right_on='expstr', how='left')
-        x = np.array([0,0.5,1,1.5,2,3,4,5,6])
-        y = gdf_nodes[['hw0','hw0_5','hw1','hw1_5','hw2','hw3','hw4','hw5','hw6']].to_numpy()
+        y = gdf_nodes[FLOOD_CURVE_COLS].to_numpy(dtype=np.float64)
         xnew = gdf_nodes['im'].to_numpy(dtype=np.float64)
-        flood_mapping = interp1d(x,y,axis=1,kind='linear',bounds_error=False, fill_value=(0,1))
-        # TODO: find another way for vectorized interpolate
-        gdf_nodes['fl_prob'] = np.diag(flood_mapping(xnew))
+        gdf_nodes['fl_prob'] = interpolate_rowwise(FLOOD_CURVE_DEPTHS, y, xnew, fill_value=(0,1))
         gdf_nodes['ds'] = 0
         gdf_nodes.loc[gdf_nodes['fl_prob'] > threshold_flood,'ds'] = 1
         
@@ -379,21 +948,17 @@ def compute_power_infra(buildings, household, nodes,edges,intensity,fragility,ha
     # Operational power plants
     operating_power_plants = power_plants - damaged_nodes
 
-    # Damaged power network
-    G_power_dmg = G_power.copy()
-    G_power_dmg.remove_nodes_from(damaged_nodes)
-
-    print('Power network before earthquake ', G_power)
-    print('Power network after  earthquake ', G_power_dmg)
-
-    # Calculate all distances in the post-earthquake network 
-    shortest_distance = nx.shortest_path_length(G_power_dmg)
+    # Damaged power network: edges of the damaged nodes are masked
+    node_pos = topology.positions(gdf_nodes['node_id'])
+    node_damaged = np.zeros(topology.n_nodes, dtype=bool)
+    node_damaged[node_pos[(gdf_nodes['ds'] > threshold).to_numpy()]] = True
+    alive = topology.edges_between(node_damaged)
 
-    operating_nodes = set()
-    for source, targets in shortest_distance:
-        if source in operating_power_plants:
-            for target, hop in targets.items():
-                operating_nodes.add(target)
+    # Nodes reachable from an operating power plant in the post-earthquake network
+    plant_pos = node_pos[(gdf_nodes['pwr_plant'] == 1).to_numpy()]
+    node_operating = topology.reachable_from_any(alive, np.unique(plant_pos[~node_damaged[plant_pos]]),
+                                                 preserve_edge_directions)
+    operating_nodes = set(topology.node_index[node_operating])
 
     # Both alive (operating) and server
     operating_server_nodes = operating_nodes.intersection(server_nodes)
@@ -413,15 +978,15 @@ def compute_power_infra(buildings, household, nodes,edges,intensity,fragility,ha
     print('operating server nodes', operating_server_nodes)
     print('nonoperating server nodes', nonoperating_server_nodes)
 
-    is_damaged_mapper     = {id:id in damaged_nodes   for id in all_nodes}
-    is_operational_mapper = {id:id in operating_nodes for id in all_nodes}
-    gdf_nodes['is_damaged'] = gdf_nodes['node_id'].map(is_damaged_mapper)
-    gdf_nodes['is_operational'] = gdf_nodes['node_id'].map(is_operational_mapper)
+    is_operational_mapper = pd.Series(node_operating, index=topology.node_index)
+    gdf_nodes['is_damaged'] = node_damaged[node_pos]
+    gdf_nodes['is_operational'] = node_operating[node_pos]
 
     # Find nearest server nodes
     gdf_buildings = gdf_buildings.drop(columns=['node_id'])
-    gdf_buildings = gpd.sjoin_nearest(gdf_buildings,gdf_nodes[gdf_nodes['n_bldgs'] > 0], 
-                how='left', rsuffix='power_node',distance_col='power_node_distance')
+    gdf_buildings = cached_sjoin_nearest(gdf_buildings,gdf_nodes[gdf_nodes['n_bldgs'] > 0], 
+                how='left', rsuffix='power_node',distance_col='power_node_distance',
+                fingerprints=(projected.get('building'), None))
     
     print(gdf_buildings.loc[0,:])
     # If nearest server is operational, then building has power, othwerwise not
@@ -438,38 +1003,396 @@ def compute_power_infra(buildings, household, nodes,edges,intensity,fragility,ha
     return gdf_nodes['ds'], gdf_nodes['is_damaged'], gdf_nodes['is_operational'], \
            gdf_buildings['has_power'], household_w_node_id['has_power'],hospitals['has_power'] 
 
+COLUMN_NAMES = {'zoneID':'zoneid','bldID':'bldid','nHouse':'nhouse',
+                'specialFac':'specialfac','expStr':'expstr','repValue':'repvalue',
+                'xCoord':'xcoord','yCoord':'ycoord','hhID':'hhid','nInd':'nind',
+                'CommFacID':'commfacid','indivId':'individ','eduAttStat':'eduattstat',
+                'indivFacID':'indivfacid','VALUE':'im'}
+
+def building_intensity_join(gdf_landuse, gdf_buildings, gdf_intensity, draws=None, fingerprints=None):
+    # Policy-independent part of compute(): nearest intensity of every building,
+    # landuse attributes of its zone and the per-building random number.
+    # If draws (indexed by bldid) is given, its 'rnd' column is used instead
+    # of a fresh draw. fingerprints are those of compute().
+    epsg = 3857 
+
+    number_of_unique_buildings = len(pd.unique(gdf_buildings['bldid']))
+    print('number of unique building', number_of_unique_buildings)
+    print('number of records in building layer ', len(gdf_buildings['bldid']))
+
+    # Convert both to the same target coordinate system
+    fingerprints = dict() if fingerprints is None else fingerprints
+    gdf_buildings = project_layer(gdf_buildings, epsg, fingerprints.get('building'))
+    # Raster intensity layers are sampled in their own CRS
+    if not isinstance(gdf_intensity, RasterIntensity):
+        gdf_intensity = project_layer(gdf_intensity, epsg, fingerprints.get('intensity'))
+
+    gdf_building_intensity = join_intensity(gdf_buildings,gdf_intensity, 
+                rsuffix='intensity',distance_col='distance',
+                fingerprints=(projected_fingerprint(fingerprints.get('building'), epsg),
+                              projected_fingerprint(fingerprints.get('intensity'), epsg)))
+    gdf_building_intensity = gdf_building_intensity.drop_duplicates(subset=['bldid'], keep='first')
+
+    gdf_building_intensity = gdf_building_intensity.merge(gdf_landuse[['zoneid','avgincome']],on='zoneid',how='left')
+
+    if draws is None:
+        gdf_building_intensity['rnd'] = np.random.random((len(gdf_building_intensity),1))
+    else:
+        gdf_building_intensity['rnd'] = draws['rnd'].reindex(gdf_building_intensity['bldid']).to_numpy()
+
+    return gdf_building_intensity
+
 def compute(gdf_landuse, gdf_buildings, df_household, df_individual,gdf_intensity, df_hazard, hazard_type, policies=[],
             threshold_flood = 0.2, threshold_flood_distance = 10,
             earthquake_intensity_unit = 'm/s2',
             cdf_median_increase_in_percent = 0.20,
             flood_depth_reduction = 0.20,
             damage_curve_suppress_factor = 0.9,
+            n_realizations = None,
+            n_partitions = None,
+            max_workers = None,
+            fingerprints = None,
             ):
+    # If n_realizations is given, damage states are also sampled stochastically
+    # and (bld_hazard, ds_realizations) is returned, where ds_realizations is a
+    # uint8 array of shape (buildings, n_realizations) aligned with bld_hazard.
+    # If n_partitions > 1, buildings are split into that many spatial tiles
+    # which are processed in a pool of max_workers processes, see
+    # compute_partitioned().
+    # fingerprints maps app layer names ('building', 'intensity', 'road nodes',
+    # ...) to the geometry_fingerprint() of the layers passed in, which keys
+    # the cached projections and joins. The app stores them with the layers
+    # when they are imported; layers without one are hashed here.
 
     print('cdf_median_increase_in_percent',cdf_median_increase_in_percent)
     print('flood_depth_reduction', flood_depth_reduction)
     print('policies', policies)
-    earthquake_intensity_normalization_factor = 1
-    if earthquake_intensity_unit == 'm/s2':
-        earthquake_intensity_normalization_factor = 9.81
 
-    gem_fragility = True if isinstance(df_hazard, dict) else False
-    print('gem_fragility mode', gem_fragility)
     if hazard_type != "landslide":
         np.random.seed(seed=0)
+    if n_realizations is not None and hazard_type not in ["earthquake", "landslide"]:
+        raise ValueError(f'Stochastic damage sampling is not supported for {hazard_type}')
 
-    column_names = {'zoneID':'zoneid','bldID':'bldid','nHouse':'nhouse',
-                    'specialFac':'specialfac','expStr':'expstr','repValue':'repvalue',
-                    'xCoord':'xcoord','yCoord':'ycoord','hhID':'hhid','nInd':'nind',
-                    'CommFacID':'commfacid','indivId':'individ','eduAttStat':'eduattstat',
-                    'indivFacID':'indivfacid','VALUE':'im'}
+    gdf_landuse = gdf_landuse.rename(columns=COLUMN_NAMES)
+    gdf_buildings = gdf_buildings.rename(columns=COLUMN_NAMES)
+    df_household = df_household.rename(columns=COLUMN_NAMES)
+    df_individual = df_individual.rename(columns=COLUMN_NAMES)
+    gdf_intensity = gdf_intensity.rename(columns=COLUMN_NAMES)
 
+    # Replace strange TypeX LRS with RCi
+    if not isinstance(df_hazard, dict):
+        print('deneme',df_hazard.columns)
+        df_hazard['expstr'] = df_hazard['expstr'].str.replace('Type[0-9]+','RCi',regex=True)
 
-    gdf_landuse = gdf_landuse.rename(columns=column_names)
-    gdf_buildings = gdf_buildings.rename(columns=column_names)
-    df_household = df_household.rename(columns=column_names)
-    df_individual = df_individual.rename(columns=column_names)
-    gdf_intensity = gdf_intensity.rename(columns=column_names)
+    if n_partitions is not None and n_partitions > 1:
+        result = compute_partitioned(gdf_landuse, gdf_buildings, gdf_intensity, df_hazard, hazard_type, policies,
+                threshold_flood=threshold_flood, threshold_flood_distance=threshold_flood_distance,
+                earthquake_intensity_unit=earthquake_intensity_unit,
+                cdf_median_increase_in_percent=cdf_median_increase_in_percent,
+                flood_depth_reduction=flood_depth_reduction,
+                damage_curve_suppress_factor=damage_curve_suppress_factor,
+                n_realizations=n_realizations, n_partitions=n_partitions, max_workers=max_workers,
+                fingerprints=fingerprints)
+    else:
+        gdf_building_intensity = building_intensity_join(gdf_landuse, gdf_buildings, gdf_intensity,
+                                                         fingerprints=fingerprints)
+
+        result = compute_building_damage(gdf_building_intensity, df_hazard, hazard_type, policies=policies,
+                threshold_flood=threshold_flood, threshold_flood_distance=threshold_flood_distance,
+                earthquake_intensity_unit=earthquake_intensity_unit,
+                cdf_median_increase_in_percent=cdf_median_increase_in_percent,
+                flood_depth_reduction=flood_depth_reduction,
+                damage_curve_suppress_factor=damage_curve_suppress_factor,
+                n_realizations=n_realizations)
+
+    # Damage states and casualties in the dtypes of the building layer
+    dtypes = gdf_buildings.dtypes[[c for c in ['bldid','ds','casualty'] if c in gdf_buildings.columns]].to_dict()
+    if n_realizations is not None:
+        return restore_dtypes(result[0].copy(), dtypes), result[1]
+    return restore_dtypes(result.copy(), dtypes)
+
+def spatial_partitions(x, y, n_partitions):
+    # Partition label of every point: x is cut into equal-count strips and
+    # every strip into equal-count tiles along y, giving at least n_partitions
+    # labels in 0 .. n_strips * n_tiles - 1
+    n_strips = int(ceil(math.sqrt(n_partitions)))
+    n_tiles = int(ceil(n_partitions / n_strips))
+    labels = np.zeros(len(x), dtype=np.int64)
+    for i, strip in enumerate(np.array_split(np.argsort(x, kind='stable'), n_strips)):
+        for j, tile in enumerate(np.array_split(strip[np.argsort(y[strip], kind='stable')], n_tiles)):
+            labels[tile] = i * n_tiles + j
+    return labels
+
+def compute_partition(gdf_landuse, gdf_buildings, gdf_intensity, df_hazard, hazard_type, policies,
+                      draws, caps, halo, seed, positions, kwargs):
+    # Worker of compute_partitioned(). Returns None if a building is farther
+    # than halo from its nearest intensity, in which case the intensity
+    # selected for the tile may have missed the true nearest one. positions
+    # maps the bldids of the tile to their position in the whole layer.
+    gdf_building_intensity = building_intensity_join(gdf_landuse, gdf_buildings, gdf_intensity, draws=draws)
+    if halo is not None and not (gdf_building_intensity['distance'] <= halo).all():
+        return None
+    return compute_building_damage(gdf_building_intensity, df_hazard, hazard_type, policies=policies,
+                                   seed=seed, positions=positions.reindex(gdf_building_intensity['bldid']).to_numpy(),
+                                   draws=draws, caps=caps, **kwargs)
+
+def compute_partitioned(gdf_landuse, gdf_buildings, gdf_intensity, df_hazard, hazard_type, policies=[],
+            n_partitions=4, max_workers=None, n_realizations=None, fingerprints=None, **kwargs):
+    # Process-parallel compute() on spatial tiles of the building layer, on
+    # layers whose columns are already renamed. Every tile gets the intensity
+    # points within a halo around its extent, doubled until the nearest
+    # intensity of each building is closer than the halo (anything outside
+    # the halo is farther), so the joins are the same as on the whole layer.
+    # The per-building random numbers and the draws of random building
+    # policies are taken here in the order compute() takes them, so damage
+    # states and casualties equal those of compute() for the same seed. Damage
+    # state realizations of a building are drawn from the seed compute() would
+    # use and the position of the building, so they are those of compute()
+    # too and do not depend on n_partitions.
+    if hazard_type != "landslide":
+        np.random.seed(seed=0)
+    if n_realizations is not None and hazard_type not in ["earthquake", "landslide"]:
+        raise ValueError(f'Stochastic damage sampling is not supported for {hazard_type}')
+
+    epsg = 3857
+    fingerprints = dict() if fingerprints is None else fingerprints
+    bldids = pd.unique(gdf_buildings['bldid'])
+    draws = pd.DataFrame({'rnd': np.random.random(len(bldids))}, index=bldids)
+    building_positions = pd.Series(np.arange(len(bldids)), index=bldids)
+    caps = dict()
+    if hazard_type != "landslide":
+        policy_params = {'cdf_median_increase_in_percent': kwargs.get('cdf_median_increase_in_percent', 0.20),
+                         'flood_depth_reduction': kwargs.get('flood_depth_reduction', 0.20),
+                         'damage_curve_suppress_factor': kwargs.get('damage_curve_suppress_factor', 0.9)}
+        unique_buildings = gdf_buildings.drop_duplicates(subset=['bldid'])
+        unique_buildings = unique_buildings.assign(height=storeys_to_height(unique_buildings['storeys']))
+        for step in compile_policies(policies, 'building', hazard_type, policy_params):
+            for term in step['mask']:
+                if isinstance(term, tuple) and term[0] == 'random_below' and step['policy'] not in draws:
+                    draws[step['policy']] = np.random.random(len(bldids))
+            if step['operation'] == 'add_capped':
+                for col in step['columns']:
+                    caps[col] = unique_buildings[col].max()
+    seed = np.random.randint(2**31) if n_realizations is not None else None
+
+    # Tiles of the projected buildings; all records of a building go to the tile of its first record
+    buildings_geometry = np.asarray(project_layer(gdf_buildings, epsg, fingerprints.get('building')).geometry.values)
+    xy = shapely.get_coordinates(shapely.centroid(buildings_geometry))
+    labels = spatial_partitions(xy[:,0], xy[:,1], n_partitions)
+    labels = pd.Series(labels).groupby(gdf_buildings['bldid'].to_numpy()).transform('first').to_numpy()
+    bounds = shapely.bounds(buildings_geometry)
+
+    tiles = np.unique(labels).tolist()
+    halos = dict()
+    if not isinstance(gdf_intensity, RasterIntensity):
+        intensity_geometry = np.asarray(project_layer(gdf_intensity, epsg, fingerprints.get('intensity')).geometry.values)
+        # Start from twice the average spacing of the intensity points
+        extent = shapely.total_bounds(np.concatenate([intensity_geometry, buildings_geometry]))
+        area = (extent[2] - extent[0]) * (extent[3] - extent[1])
+        halos = {tile: max(2 * math.sqrt(area / max(len(gdf_intensity), 1)), 1.0) for tile in tiles}
+        tree = shapely.STRtree(intensity_geometry)
+
+    results = dict()
+    damage_kwargs = {**kwargs, 'n_realizations': n_realizations}
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        while len(results) < len(tiles):
+            futures = dict()
+            for tile in tiles:
+                if tile in results:
+                    continue
+                in_tile = labels == tile
+                tile_intensity, tile_halo = gdf_intensity, None
+                if tile in halos:
+                    tile_bounds = bounds[in_tile]
+                    extent = shapely.box(tile_bounds[:,0].min() - halos[tile], tile_bounds[:,1].min() - halos[tile],
+                                         tile_bounds[:,2].max() + halos[tile], tile_bounds[:,3].max() + halos[tile])
+                    positions = np.sort(tree.query(extent))
+                    # Once the halo covers every intensity point, nothing can be missed
+                    if len(positions) < len(gdf_intensity):
+                        tile_intensity, tile_halo = gdf_intensity.iloc[positions], halos[tile]
+                tile_buildings = gdf_buildings[in_tile]
+                tile_draws = draws.loc[pd.unique(tile_buildings['bldid'])]
+                futures[tile] = executor.submit(compute_partition, gdf_landuse, tile_buildings, tile_intensity,
+                        df_hazard, hazard_type, policies, tile_draws, caps, tile_halo, seed,
+                        building_positions.loc[tile_draws.index], damage_kwargs)
+            for tile, future in futures.items():
+                result = future.result()
+                if result is None:
+                    halos[tile] = 2 * halos[tile]
+                    print('partition', tile, 'halo increased to', halos[tile])
+                else:
+                    results[tile] = result
+
+    # Buildings in the order of compute()
+    if n_realizations is not None:
+        bld_hazard = pd.concat([results[tile][0] for tile in tiles])
+        ds_realizations = np.concatenate([results[tile][1] for tile in tiles])
+    else:
+        bld_hazard = pd.concat([results[tile] for tile in tiles])
+    order = np.argsort(pd.Index(bldids).get_indexer(bld_hazard['bldid']), kind='stable')
+    bld_hazard = bld_hazard.iloc[order].reset_index(drop=True)
+    if n_realizations is not None:
+        return bld_hazard, ds_realizations[order]
+    return bld_hazard
+
+def building_vulnerability(gdf_building_intensity, df_hazard, hazard_type, policies, policy_params,
+                           draws=None, caps=None):
+    # Intensity-independent part of compute_building_damage(): building policies,
+    # taxonomy keys and the join with fragility/vulnerability data, with the
+    # policies on fragility medians and damage curves applied. Policies acting
+    # on the intensity are returned as compiled steps for the caller to apply
+    # on whatever intensity it evaluates. Returns (frame, intensity_steps).
+    # draws and caps are the building policy draws (indexed by bldid, one
+    # column per policy) and column caps of a partitioned run.
+    gdf_building_intensity = building_policies(gdf_building_intensity, hazard_type, policies, policy_params,
+                                               draws=draws, caps=caps)
+    bld_vulnerability = vulnerability_join(gdf_building_intensity, df_hazard, hazard_type)
+    return vulnerability_policies(bld_vulnerability, df_hazard, hazard_type, policies, policy_params)
+
+def building_policies(gdf_building_intensity, hazard_type, policies, policy_params, draws=None, caps=None):
+    # First stage of building_vulnerability(): policies on the building
+    # attributes (code level, height, occupancy) and the height levels.
+    # gdf_building_intensity is modified in place.
+    gdf_building_intensity['height'] = storeys_to_height(gdf_building_intensity['storeys'])
+
+    building_steps = compile_policies(policies, 'building', hazard_type, policy_params)
+    random_draws = None
+    if draws is not None:
+        bldids = gdf_building_intensity['bldid']
+        random_draws = {policy: draws[policy].reindex(bldids).to_numpy() for policy in draws.columns if policy != 'rnd'}
+    gdf_building_intensity = apply_policies(gdf_building_intensity, building_steps,
+                                            random_draws=random_draws, caps=caps)
+    if any('height' in step['columns'] for step in building_steps):
+        gdf_building_intensity['storeys'] = height_to_storeys(gdf_building_intensity['height'])
+
+    lr = (gdf_building_intensity['height'] <= 4)
+    mr = (gdf_building_intensity['height'] >= 5) & (gdf_building_intensity['height'] <= 8)
+    hr = (gdf_building_intensity['height'] >= 9)
+    gdf_building_intensity.loc[lr, 'height_level'] = 'LR'
+    gdf_building_intensity.loc[mr, 'height_level'] = 'MR'
+    gdf_building_intensity.loc[hr, 'height_level'] = 'HR'
+    return gdf_building_intensity.reset_index(drop=True)
+
+# Building attributes the fragility/vulnerability join is keyed on.
+# Earthquake uses simplified taxonomy (material+code_level+height_level),
+# flood and GEM fragility use the full one (material+code_level+storeys+occupancy).
+VULNSTREQ_COMPONENTS = ['material','code_level','height_level']
+EXPSTR_COMPONENTS = ['material','code_level','storeys','occupancy']
+
+def vulnerability_join(gdf_building_intensity, df_hazard, hazard_type):
+    # Second stage of building_vulnerability(): one row of fragility or
+    # vulnerability parameters per building, joined on integer-coded
+    # taxonomy keys rather than concatenated strings, without policies.
+    gem_fragility = True if isinstance(df_hazard, dict) else False
+    gdf_building_intensity = gdf_building_intensity.reset_index(drop=True)
+    vulnstreq_keys = taxonomy_dictionary.composite_key([(c, gdf_building_intensity[c]) for c in VULNSTREQ_COMPONENTS])
+    expstr_keys = taxonomy_dictionary.composite_key([(c, gdf_building_intensity[c]) for c in EXPSTR_COMPONENTS])
+
+    if hazard_type == "earthquake":
+        if not gem_fragility:
+            med_cols = ['muds1_g','muds2_g','muds3_g','muds4_g']
+            hazard_keys = taxonomy_dictionary.composite_key_from_strings(df_hazard['expstr'], VULNSTREQ_COMPONENTS)
+            bld_eq = taxonomy_join(gdf_building_intensity, df_hazard, taxonomy_dictionary.lookup(hazard_keys, vulnstreq_keys))
+            nulls = bld_eq['muds1_g'].isna()
+            if nulls.any():
+                missing_vulnstreq = bld_eq.loc[nulls, VULNSTREQ_COMPONENTS].astype(str).agg('+'.join,axis=1)
+                print('no correspnding record in exposure', pd.unique(missing_vulnstreq))
+            bld_eq.loc[nulls, med_cols] = [0.048,0.203,0.313,0.314]
+            bld_eq.loc[nulls, ['sigmads1','sigmads2','sigmads3','sigmads4']] = [0.301,0.276,0.252,0.253]
+            bld_eq[med_cols] = bld_eq[med_cols].astype(float)
+            return bld_eq
+        # GEM vulnerability models are joined the same way as fragility models
+        if 'vulnerabilityFunctions' in df_hazard:
+            gem_df, id_col = pd.DataFrame(df_hazard['vulnerabilityFunctions']), 'vulnerability_id'
+        else:
+            gem_df, id_col = pd.DataFrame(df_hazard['fragilityFunctions']), 'fragility_id'
+        gem_df['imt_2'] = gem_df['imt'].str.replace('(', ' ').str.replace(')','').str.lower()
+        gem_df['imt_2'] = gem_df['imt_2'].apply(lambda x: f'sa {float(x.split()[-1]):.2f}' if x.startswith('sa ') else x)    
+        hazard_keys = taxonomy_dictionary.composite_key_from_strings(gem_df['id'], EXPSTR_COMPONENTS)
+        return taxonomy_join(gdf_building_intensity, gem_df[['id','imt_2']].rename(columns={'id':id_col}),
+                             taxonomy_dictionary.lookup(hazard_keys, expstr_keys))
+    elif hazard_type == "flood":
+        hazard_keys = taxonomy_dictionary.composite_key_from_strings(df_hazard['expstr'], EXPSTR_COMPONENTS)
+        return taxonomy_join(gdf_building_intensity, df_hazard, taxonomy_dictionary.lookup(hazard_keys, expstr_keys))
+    return gdf_building_intensity
+
+def vulnerability_policies(bld_vulnerability, df_hazard, hazard_type, policies, policy_params):
+    # Last stage of building_vulnerability(): policies on the joined
+    # fragility medians and damage curves. Returns (frame, intensity_steps).
+    gem_fragility = True if isinstance(df_hazard, dict) else False
+    intensity_steps = []
+    if hazard_type == "earthquake":
+        if not gem_fragility:
+            # Increase medians *cdf_median_increase_in_percent* percent (policies 1, 2, 6, 8)
+            # Special buildings are set to immune damage (policy 5)
+            bld_eq = apply_policies(bld_vulnerability, compile_policies(policies, 'fragility', hazard_type, policy_params),
+                                    column_groups={'median_columns': ['muds1_g','muds2_g','muds3_g','muds4_g']})
+            return bld_eq, intensity_steps
+        intensity_steps = compile_policies(policies, 'gem_fragility', hazard_type, policy_params)
+        return bld_vulnerability, intensity_steps
+    elif hazard_type == "flood":
+        # Masks only read building attributes, so the damage curve steps can
+        # run ahead of the water depth steps
+        steps = compile_policies(policies, 'flood_vulnerability', hazard_type, policy_params)
+        intensity_steps = [step for step in steps if step['columns'] == 'intensity_columns']
+        bld_flood = apply_policies(bld_vulnerability, [step for step in steps if step['columns'] != 'intensity_columns'],
+                                   column_groups={'damage_curve_columns': FLOOD_CURVE_COLS})
+        return bld_flood, intensity_steps
+    return bld_vulnerability, intensity_steps
+
+def flood_depth_probabilities(bld_flood, intensity_steps):
+    # Water depth policies (reduce flood depth *flood_depth_reduction* cm,
+    # effects are stacked), then the flood and casualty probabilities of the
+    # depth in fl_prob and casualty_prob. bld_flood is modified in place.
+    bld_flood = apply_policies(bld_flood, intensity_steps, column_groups={'intensity_columns': ['im']})
+    bld_flood.loc[bld_flood['im'] < 0, 'im'] = 0
+
+    y = bld_flood[FLOOD_CURVE_COLS].to_numpy(dtype=np.float64)
+    xnew = bld_flood['im'].to_numpy(dtype=np.float64)
+    bld_flood['fl_prob'] = interpolate_rowwise(FLOOD_CURVE_DEPTHS, y, xnew, fill_value=(0,1))
+    bld_flood['casualty_prob'] = interpolate_rowwise(FLOOD_CURVE_DEPTHS, FLOOD_CASUALTY_RATES, xnew, fill_value=(0,1))
+    return bld_flood
+
+def flood_distance_cutoff(gdf_building_intensity, threshold_flood_distance):
+    # No water at buildings farther than threshold_flood_distance from their
+    # nearest intensity. gdf_building_intensity is modified in place.
+    away_from_flood = gdf_building_intensity['distance'] > threshold_flood_distance
+    print('threshold_flood_distance',threshold_flood_distance)
+    print('number of distant buildings', len(gdf_building_intensity.loc[away_from_flood, 'im']))
+    gdf_building_intensity.loc[away_from_flood, 'im'] = 0
+    print('maximum water depth on buildings ',gdf_building_intensity['im'].max())
+
+def compute_building_damage(gdf_building_intensity, df_hazard, hazard_type, policies=[],
+            threshold_flood = 0.2, threshold_flood_distance = 10,
+            earthquake_intensity_unit = 'm/s2',
+            cdf_median_increase_in_percent = 0.20,
+            flood_depth_reduction = 0.20,
+            damage_curve_suppress_factor = 0.9,
+            n_realizations = None,
+            rng = None,
+            draws = None,
+            caps = None,
+            seed = None,
+            positions = None,
+            compiled_fragility = None,
+            vulnerability = None,
+            ):
+    # Policy-dependent part of compute(), on the output of building_intensity_join().
+    # gdf_building_intensity is modified in place. Damage state realizations
+    # are drawn from rng if given, otherwise from seed (drawn from np.random if
+    # not given) and the position of each building, its row number unless
+    # positions says otherwise, see sample_damage_states(). draws and caps are
+    # passed on to building_vulnerability(). compiled_fragility is the output
+    # of compile_gem_fragility() for GEM fragilities, compiled here if not given.
+    # vulnerability is the output of building_vulnerability() for the same
+    # buildings and policies, after flood_distance_cutoff() for flood,
+    # computed here if not given.
+    earthquake_intensity_normalization_factor = 1
+    if earthquake_intensity_unit == 'm/s2':
+        earthquake_intensity_normalization_factor = 9.81
+
+    gem_fragility = True if isinstance(df_hazard, dict) else False
+    print('gem_fragility mode', gem_fragility)
 
     # Damage States
     DS_NO = 0
@@ -483,52 +1406,14 @@ def compute(gdf_landuse, gdf_buildings, df_household, df_individual,gdf_intensit
     HAZARD_FLOOD = "flood"
     HAZARD_DEBRIS = "debris"
 
-    epsg = 3857 
-
-    # Replace strange TypeX LRS with RCi
-    if not gem_fragility:
-        print('deneme',df_hazard.columns)
-        df_hazard['expstr'] = df_hazard['expstr'].str.replace('Type[0-9]+','RCi',regex=True)
-
-    number_of_unique_buildings = len(pd.unique(gdf_buildings['bldid']))
-    print('number of unique building', number_of_unique_buildings)
-    print('number of records in building layer ', len(gdf_buildings['bldid']))
-
-    # Convert both to the same target coordinate system
-    gdf_buildings = gdf_buildings.set_crs("EPSG:4326",allow_override=True)
-    gdf_intensity = gdf_intensity.set_crs("EPSG:4326",allow_override=True)
-
-    gdf_buildings = gdf_buildings.to_crs(f"EPSG:{epsg}")
-    gdf_intensity = gdf_intensity.to_crs(f"EPSG:{epsg}")
-
-    gdf_building_intensity = gpd.sjoin_nearest(gdf_buildings,gdf_intensity, 
-                how='left', rsuffix='intensity',distance_col='distance')
-    gdf_building_intensity = gdf_building_intensity.drop_duplicates(subset=['bldid'], keep='first')
-
-    gdf_building_intensity = gdf_building_intensity.merge(gdf_landuse[['zoneid','avgincome']],on='zoneid',how='left')
-
-    gdf_building_intensity['rnd'] = np.random.random((len(gdf_building_intensity),1))
-
     if hazard_type == "landslide":
         print('----------up side down prev', gdf_building_intensity.shape)
         print(pd.unique(gdf_building_intensity['im']))
-        gdf_building_intensity['susceptibility'] = 'low'
-        gdf_building_intensity.loc[gdf_building_intensity['im'] == 2.0, 'susceptibility'] = 'medium'
-        gdf_building_intensity.loc[gdf_building_intensity['im'] == 3.0, 'susceptibility'] = 'high'
         print(gdf_building_intensity.loc[0])
         print(gdf_building_intensity.columns)
         print(df_hazard.loc[0])
-        df_hazard['landslide_expstr'] = df_hazard['expstr'].astype(str) +"+"+ df_hazard["susceptibility"].astype(str) 
-
-        gdf_building_intensity['landslide_expstr'] = gdf_building_intensity['material'].astype(str)  + "+" \
-                                                   + gdf_building_intensity['code_level'].astype(str)  + "+" \
-                                                   + gdf_building_intensity["susceptibility"].astype(str) 
-        print('x1', gdf_building_intensity.columns)
-        print('x2', df_hazard.columns)
-
         print(len(gdf_building_intensity))
-        gdf_building_collapse_prob = gdf_building_intensity.merge(df_hazard, 
-                                        on='landslide_expstr', how='left')
+        gdf_building_collapse_prob = building_landslide_fragility(gdf_building_intensity, df_hazard)
         print('----------up side down ', gdf_building_collapse_prob.shape)
         print(gdf_building_collapse_prob.loc[0])
         print(len(gdf_building_collapse_prob))
@@ -538,127 +1423,30 @@ def compute(gdf_landuse, gdf_buildings, df_household, df_individual,gdf_intensit
         gdf_building_collapse_prob.loc[collapsed_idx, 'ds'] = DS_COLLAPSED
         gdf_building_collapse_prob.loc[~collapsed_idx, 'casualty'] = 0
         bld_hazard = gdf_building_collapse_prob[['bldid','ds','casualty']]
+        if n_realizations is not None:
+            if rng is None and seed is None:
+                seed = np.random.randint(2**31)
+            ds_realizations = sample_damage_states(gdf_building_collapse_prob['collapse_probability'].to_numpy(),
+                                                   n_realizations, rng, seed=seed, positions=positions) * np.uint8(DS_COLLAPSED)
+            return bld_hazard, ds_realizations
         return bld_hazard
 
     # TODO: Check if the logic makes sense
-    if hazard_type == HAZARD_FLOOD:
-        away_from_flood = gdf_building_intensity['distance'] > threshold_flood_distance
-        print('threshold_flood_distance',threshold_flood_distance)
-        print('number of distant buildings', len(gdf_building_intensity.loc[away_from_flood, 'im']))
-        gdf_building_intensity.loc[away_from_flood, 'im'] = 0
-        print('maximum water depth on buildings ',gdf_building_intensity['im'].max())
-
-    gdf_building_intensity['height'] = gdf_building_intensity['storeys'].str.extract(r'([0-9]+)s').astype('int')
-
-    if 7 in policies:
-        if hazard_type == HAZARD_FLOOD or hazard_type == HAZARD_DEBRIS:
-            idx = (gdf_building_intensity['rnd'] < 0.70) & (gdf_building_intensity['occupancy'] == 'Res')
-            gdf_building_intensity.loc[idx,'occupancy'] = 'Agri'
-
-    if 10 in policies:
-        if hazard_type == HAZARD_FLOOD or hazard_type == HAZARD_DEBRIS:
-            idx = gdf_building_intensity['rnd'] < 0.80
-            gdf_building_intensity.loc[idx,'occupancy'] = 'Agri'
-
-    for pid in [11, 12, 19]:
-        if pid in policies:
-            gdf_building_intensity['temp_rand'] = np.random.random((len(gdf_building_intensity),1))
-            idx = gdf_building_intensity['temp_rand'] < 0.50
-            gdf_building_intensity.loc[idx & (gdf_building_intensity['code_level'] == 'MC'), 'code_level'] = 'HC'
-            gdf_building_intensity.loc[idx & (gdf_building_intensity['code_level'] == 'LC'), 'code_level'] = 'MC'
-            if hazard_type == HAZARD_FLOOD or hazard_type == HAZARD_DEBRIS:
-                max_height = gdf_building_intensity['height'].max()
-                gdf_building_intensity.loc[idx, 'height'] = gdf_building_intensity[idx]['height'].apply(lambda h: min(max_height, h+1))
-                gdf_building_intensity['storeys'] = gdf_building_intensity['height'].apply(lambda h: str(h)+'s') 
-
-    for pid in [14, 15, 20]:
-        if pid in policies:
-            gdf_building_intensity['temp_rand'] = np.random.random((len(gdf_building_intensity),1))
-            idx = gdf_building_intensity['temp_rand'] < 0.10
-            gdf_building_intensity.loc[idx & (gdf_building_intensity['code_level'] == 'MC'), 'code_level'] = 'HC'
-            gdf_building_intensity.loc[idx & (gdf_building_intensity['code_level'] == 'LC'), 'code_level'] = 'MC'
-            if hazard_type == HAZARD_FLOOD or hazard_type == HAZARD_DEBRIS:
-                max_height = gdf_building_intensity['height'].max()
-                gdf_building_intensity.loc[idx, 'height'] = gdf_building_intensity[idx]['height'].apply(lambda h: min(max_height, h+1))
-                gdf_building_intensity['storeys'] = gdf_building_intensity['height'].apply(lambda h: str(h)+'s') 
-
-    if 16 in policies:
-        idx = gdf_building_intensity['specialfac'] != 0
-        gdf_building_intensity.loc[idx, 'code_level'] == 'HC'
-        if hazard_type == HAZARD_FLOOD or hazard_type == HAZARD_DEBRIS:
-            max_height = gdf_building_intensity['height'].max()
-            gdf_building_intensity.loc[idx, 'height'] = gdf_building_intensity[idx]['height'].apply(lambda h: min(max_height, h+6))
-            gdf_building_intensity['storeys'] = gdf_building_intensity['height'].apply(lambda h: str(h)+'s')
-
-    if 17 in policies:
-        idx = (gdf_building_intensity['occupancy'] == 'Edu') | (gdf_building_intensity['occupancy'] == 'Hea') 
-        gdf_building_intensity.loc[idx, 'code_level'] == 'HC'
-        if hazard_type == HAZARD_FLOOD or hazard_type == HAZARD_DEBRIS:
-            max_height = gdf_building_intensity['height'].max()
-            gdf_building_intensity.loc[idx, 'height'] = gdf_building_intensity[idx]['height'].apply(lambda h: min(max_height, h+6))
-            gdf_building_intensity['storeys'] = gdf_building_intensity['height'].apply(lambda h: str(h)+'s')
-
-    if 18 in policies:
-        idx = ((gdf_building_intensity['avgincome'] == 'lowIncomeA') |\
-                (gdf_building_intensity['avgincome'] == 'lowIncomeA') &\
-                (gdf_building_intensity['rnd'] < 0.50))
-        gdf_building_intensity.loc[idx & (gdf_building_intensity['code_level'] == 'MC'), 'code_level'] = 'HC'
-        gdf_building_intensity.loc[idx & (gdf_building_intensity['code_level'] == 'LC'), 'code_level'] = 'MC'
-        if hazard_type == HAZARD_FLOOD or hazard_type == HAZARD_DEBRIS:
-            max_height = gdf_building_intensity['height'].max()
-            gdf_building_intensity.loc[idx, 'height'] = gdf_building_intensity[idx]['height'].apply(lambda h: min(max_height, h+1))
-            gdf_building_intensity['storeys'] = gdf_building_intensity['height'].apply(lambda h: str(h)+'s')
+    # Policies are compiled once per stage and applied in a single fused pass
+    policy_params = {'cdf_median_increase_in_percent': cdf_median_increase_in_percent,
+                     'flood_depth_reduction': flood_depth_reduction,
+                     'damage_curve_suppress_factor': damage_curve_suppress_factor}
+    if vulnerability is None:
+        if hazard_type == HAZARD_FLOOD:
+            flood_distance_cutoff(gdf_building_intensity, threshold_flood_distance)
+        vulnerability = building_vulnerability(gdf_building_intensity, df_hazard, hazard_type,
+                                               policies, policy_params, draws=draws, caps=caps)
+    bld_vulnerability, intensity_steps = vulnerability
 
-    lr = (gdf_building_intensity['height'] <= 4)
-    mr = (gdf_building_intensity['height'] >= 5) & (gdf_building_intensity['height'] <= 8)
-    hr = (gdf_building_intensity['height'] >= 9)
-    gdf_building_intensity.loc[lr, 'height_level'] = 'LR'
-    gdf_building_intensity.loc[mr, 'height_level'] = 'MR'
-    gdf_building_intensity.loc[hr, 'height_level'] = 'HR'
-
-    # Earthquake uses simplified taxonomy
-    gdf_building_intensity['vulnstreq'] = \
-        gdf_building_intensity[['material','code_level','height_level']] \
-            .agg('+'.join,axis=1)
-    
-    gdf_building_intensity['expstr'] = \
-        gdf_building_intensity[['material','code_level','storeys','occupancy']] \
-            .agg('+'.join,axis=1)
-    
-     
     if hazard_type == HAZARD_EARTHQUAKE:
         if not gem_fragility:
-            med_cols = ['muds1_g','muds2_g','muds3_g','muds4_g']
-            bld_eq = gdf_building_intensity.merge(df_hazard, left_on='vulnstreq',right_on='expstr', how='left')
-            nulls = bld_eq['muds1_g'].isna()
-            print('no correspnding record in exposure', pd.unique(bld_eq.loc[nulls, 'vulnstreq']))
-            bld_eq.loc[nulls, med_cols] = [0.048,0.203,0.313,0.314]
-            bld_eq.loc[nulls, ['sigmads1','sigmads2','sigmads3','sigmads4']] = [0.301,0.276,0.252,0.253]
-            bld_eq[med_cols] = bld_eq[med_cols].astype(float)
-            if 1 in policies:
-                # Increase medians *cdf_median_increase_in_percent* percent for residential buildings
-                applied_to = bld_eq['occupancy']=='Res'
-                bld_eq.loc[applied_to, med_cols] = bld_eq.loc[applied_to, med_cols] * \
-                        ( 1 + cdf_median_increase_in_percent )
-            if 2 in policies:
-                # Increase medians *cdf_median_increase_in_percent* percent for residential buildings
-                applied_to = (bld_eq['occupancy'] == 'Res') & ((bld_eq['freqincome'] == 'lowIncomeA') | (bld_eq['freqincome'] == 'lowIncomeB'))
-                bld_eq.loc[applied_to, med_cols] = bld_eq.loc[applied_to, med_cols] * \
-                        ( 1 + cdf_median_increase_in_percent ) 
-            if 5 in policies:
-                # Special building are set to immune damage
-                applied_to = bld_eq['occupancy'] != 'Res'
-                bld_eq.loc[applied_to, med_cols] = [99999,99999,99999,99999]
-            if 6 in policies:
-                # Increase medians *cdf_median_increase_in_percent* percent for residential buildings
-                applied_to = bld_eq['occupancy']=='Res'
-                bld_eq.loc[applied_to, med_cols] = bld_eq.loc[applied_to, med_cols] * \
-                        ( 1 + cdf_median_increase_in_percent )
-            if 8 in policies:
-                applied_to = bld_eq['occupancy'] == 'Res'
-                bld_eq.loc[applied_to, med_cols] = bld_eq.loc[applied_to, med_cols] * \
-                         ( 1 + cdf_median_increase_in_percent )
-                
+            bld_eq = bld_vulnerability
+
             # Intensity measure calculation
             sa_list = np.array([float(x.split()[-1]) for x in bld_eq.columns if x.startswith('sa ')])
             sa_cols = [x for x in bld_eq.columns  if x.startswith('sa ') or x == 'pga']
@@ -672,71 +1460,40 @@ def compute(gdf_landuse, gdf_buildings, df_household, df_individual,gdf_intensit
                     raise ValueError('No intensity measure found')
             else:
                 # Multi-channel density map
-                for i, row in bld_eq.iterrows():
-                    minp, maxp = row['minperiod'], row['maxperiod']
-                    if minp > 0 and maxp > 0 and maxp > minp:
-                        # 0.001 corresponds to pga
-                        x_interp = np.log(np.concatenate(([0.001],sa_list)))
-                        y_interp = np.log(row[sa_cols].to_numpy(dtype=np.float32))
-                        step = 0.01
-                        x_required = np.log(np.linspace(minp, maxp, int((maxp - minp) / step + 1)))
-                        sa_interp = np.exp(np.interp(x_required, x_interp, y_interp))
-                        sa_gmean = np.prod(sa_interp)**(1/len(sa_interp))
-                        bld_eq.at[i,'logim'] = np.log(sa_gmean/earthquake_intensity_normalization_factor)
-                    else:
-                        bld_eq.at[i,'logim'] = np.log(row['pga']/earthquake_intensity_normalization_factor)
+                bld_eq['logim'] = spectral_average_logim(bld_eq, sa_list, sa_cols,
+                                        normalization_factor=earthquake_intensity_normalization_factor)
 
             for m in ['muds1_g','muds2_g','muds3_g','muds4_g']:
                 # TODO: double check if we should apply g-normalization
                 bld_eq[m] = np.log(bld_eq[m])
 
-            for i in [1,2,3,4]:
-                bld_eq[f'prob_ds{i}'] = norm.cdf(bld_eq['logim'],bld_eq[f'muds{i}_g'],bld_eq[f'sigmads{i}'])
+            prob_ds, _ = lognormal_damage_probabilities(bld_eq['logim'], bld_eq[['muds1_g','muds2_g','muds3_g','muds4_g']],
+                                                        bld_eq[['sigmads1','sigmads2','sigmads3','sigmads4']])
+            bld_eq[['prob_ds1','prob_ds2','prob_ds3','prob_ds4']] = prob_ds
 
 
         else:
-            gem_df = pd.DataFrame(df_hazard['fragilityFunctions'])
-            gem_df['imt_2'] = gem_df['imt'].str.replace('(', ' ').str.replace(')','').str.lower()
-            gem_df['imt_2'] = gem_df['imt_2'].apply(lambda x: f'sa {float(x.split()[-1]):.2f}' if x.startswith('sa ') else x)    
-            bld_eq = gdf_building_intensity.merge(gem_df, how='left',left_on='expstr', right_on='id', validate="many_to_one")
+            bld_eq = bld_vulnerability
             imt_cols = pd.unique(bld_eq['imt_2']).tolist()
 
             # In GEM data we use, we have a discretized CDF so less means more robust to damage
-            if 1 in policies:
-                applied_to = bld_eq['occupancy'] == 'Res'
-                bld_eq.loc[applied_to, imt_cols] = bld_eq.loc[applied_to, imt_cols] * \
-                        ( 1 - cdf_median_increase_in_percent )
-            if 2 in policies:
-                applied_to = (bld_eq['occupancy'] == 'Res') & ((bld_eq['freqincome'] == 'lowIncomeA') | (bld_eq['freqincome'] == 'lowIncomeB'))
-                bld_eq.loc[applied_to, imt_cols] = bld_eq.loc[applied_to, imt_cols] * \
-                        ( 1 - cdf_median_increase_in_percent )
-            if 5 in policies:
-                # Special buildings are immune to damage
-                applied_to = bld_eq['occupancy'] != 'Res'
-                bld_eq.loc[applied_to, imt_cols] = 0
-            if 6 in policies:
-                applied_to = bld_eq['occupancy'] == 'Res'
-                bld_eq.loc[applied_to, imt_cols] = bld_eq.loc[applied_to, imt_cols] * \
-                        ( 1 - cdf_median_increase_in_percent )
-            if 8 in policies:
-                applied_to = bld_eq['occupancy'] == 'Res'
-                bld_eq.loc[applied_to, imt_cols] = bld_eq.loc[applied_to, imt_cols] * \
-                        ( 1 - cdf_median_increase_in_percent )
-                                
-            def computer_damage_state(row):
-                intensity_in_g = row[row['imt_2']] / earthquake_intensity_normalization_factor
-                prob_ds1 = np.interp(intensity_in_g, row['imls'], row['slight'])
-                prob_ds2 = np.interp(intensity_in_g, row['imls'], row['moderate'])
-                prob_ds3 = np.interp(intensity_in_g, row['imls'], row['extensive'])
-                prob_ds4 = np.interp(intensity_in_g, row['imls'], row['complete'])
-                return prob_ds1, prob_ds2, prob_ds3, prob_ds4
-            bld_eq[['prob_ds1','prob_ds2','prob_ds3','prob_ds4']] = bld_eq.apply(computer_damage_state, axis=1,result_type='expand')
-
-        bld_eq[['prob_ds0','prob_ds5']] = [1,0]
-        for i in [1,2,3,4,5]:
-            bld_eq[f'ds_{i}'] = np.abs(bld_eq[f'prob_ds{i-1}'] - bld_eq[f'prob_ds{i}'])
-        df_ds = bld_eq[['ds_1','ds_2','ds_3','ds_4','ds_5']]
-        bld_eq['eq_ds'] = df_ds.idxmax(axis='columns').str.extract(r'ds_([0-9]+)').astype('int') - 1
+            bld_eq = apply_policies(bld_eq, intensity_steps,
+                                    column_groups={'intensity_columns': [c for c in imt_cols if isinstance(c, str)]})
+
+            # Batched evaluation: one interpolation per (fragility id, imt) group
+            if compiled_fragility is None:
+                compiled_fragility = compile_gem_fragility(df_hazard['fragilityFunctions'])
+            bld_eq[['prob_ds1','prob_ds2','prob_ds3','prob_ds4']] = gem_damage_probabilities(bld_eq, compiled_fragility,
+                    id_col='fragility_id', imt_col='imt_2', normalization_factor=earthquake_intensity_normalization_factor)
+
+        if n_realizations is not None:
+            if rng is None and seed is None:
+                seed = np.random.randint(2**31)
+            ds_realizations = sample_damage_states(bld_eq[['prob_ds1','prob_ds2','prob_ds3','prob_ds4']].to_numpy(),
+                                                   n_realizations, rng, seed=seed, positions=positions)
+
+        prob_ds = bld_eq[['prob_ds1','prob_ds2','prob_ds3','prob_ds4']].to_numpy(dtype=np.float64)
+        bld_eq['eq_ds'] = modal_damage_states(prob_ds).astype(np.int64)
         casualty_rates = np.array([0, 0.05, 0.28, 1.152, 74.41]) # percent
         bld_eq['casualy'] = 0
         bld_eq = bld_eq.assign(casualty=lambda x: casualty_rates[x['eq_ds']] * x['residents'] / 100)
@@ -748,45 +1505,11 @@ def compute(gdf_landuse, gdf_buildings, df_household, df_individual,gdf_intensit
         ds_str = {0: 'No Damage',1:'Low',2:'Medium',3:'High',4:'Collapsed'}
 
     elif hazard_type == HAZARD_FLOOD:
-        bld_flood = gdf_building_intensity.merge(df_hazard, on='expstr', how='left')
-        damage_curve_cols = ['hw0','hw0_5','hw1','hw1_5','hw2','hw3','hw4','hw5','hw6']
-        # reduce flood depth *flood_depth_reduction* cm
-        # Effect of policies are stacked
-        if 1 in policies:
-            bld_flood['im'] = bld_flood['im'] - flood_depth_reduction
-        if 2 in policies:
-            applied_to = (bld_flood['occupancy'] == 'Res') & ((bld_flood['freqincome'] == 'lowIncomeA') | (bld_flood['freqincome'] == 'lowIncomeB'))
-            bld_flood.loc[applied_to, 'im'] = bld_flood.loc[applied_to, 'im'] - flood_depth_reduction
-        if 3 in policies:
-            bld_flood['im'] = bld_flood['im'] - flood_depth_reduction
-        if 5 in policies:
-            applied_to = bld_flood['occupancy'] != 'Res'
-            bld_flood.loc[applied_to, 'im'] = 0
-        if 6 in policies:
-            applied_to = bld_flood['occupancy'] == 'Res'
-            bld_flood.loc[applied_to, 'im'] = bld_flood.loc[applied_to, 'im'] - flood_depth_reduction
-        if 8 in policies:
-            applied_to = bld_flood['occupancy'] == 'Res'
-            bld_flood.loc[applied_to, damage_curve_cols] = bld_flood.loc[applied_to, damage_curve_cols] * damage_curve_suppress_factor
-        if 9 in policies:
-            bld_flood[damage_curve_cols] = bld_flood[damage_curve_cols] * damage_curve_suppress_factor
-        bld_flood.loc[bld_flood['im'] < 0, 'im'] = 0
-
-        x = np.array([0,0.5,1,1.5,2,3,4,5,6])
-        y = bld_flood[['hw0','hw0_5','hw1','hw1_5','hw2','hw3','hw4','hw5','hw6']].to_numpy()
-        xnew = bld_flood['im'].to_numpy(dtype=np.float64)
-        flood_mapping = interp1d(x,y,axis=1,kind='linear',bounds_error=False, fill_value=(0,1))
-        # TODO: find another way for vectorized interpolate
-        bld_flood['fl_prob'] = np.diag(flood_mapping(xnew))
+        bld_flood = flood_depth_probabilities(bld_vulnerability, intensity_steps)
         bld_flood['fl_ds'] = 0
         flooded_buildings = bld_flood['fl_prob'] > threshold_flood
         bld_flood.loc[flooded_buildings, 'fl_ds'] = 1
 
-        casualty_rates = np.array([[0,0,0,0.000976715,0.0105355,0.052184493,0.160744982,0.373769339,0.743830881]])
-        y_casualty = np.repeat(casualty_rates, len(bld_flood),axis=0)
-        casualty_mapping = interp1d(x,y_casualty,axis=1,kind='linear',bounds_error=False, fill_value=(0,1))
-        # TODO: find another way for vectorized interpolate
-        bld_flood['casualty_prob'] = np.diag(casualty_mapping(xnew))
         bld_flood['casualty_rates'] = bld_flood['casualty_prob'] * bld_flood['residents']
         bld_flood['casualty'] = 0
         bld_flood.loc[flooded_buildings, 'casualty'] = bld_flood.loc[flooded_buildings, 'casualty_rates']
@@ -799,8 +1522,207 @@ def compute(gdf_landuse, gdf_buildings, df_household, df_individual,gdf_intensit
 
         ds_str = {0: 'No Damage',1:'Flooded'}
     
+    if n_realizations is not None:
+        return bld_hazard, ds_realizations
     return bld_hazard
 
+def compute_event_set(gdf_landuse, gdf_buildings, gdf_sites, intensity_fields, df_hazard, hazard_type, policies=[],
+            threshold_flood = 0.2, threshold_flood_distance = 10,
+            earthquake_intensity_unit = 'm/s2',
+            cdf_median_increase_in_percent = 0.20,
+            flood_depth_reduction = 0.20,
+            damage_curve_suppress_factor = 0.9,
+            chunk_size = None,
+            return_damage_states = False,
+            event_rates = None,
+            aggregator = None,
+            ):
+    # Building damage for a stack of ground-motion or flood-depth fields that
+    # share the same sites. intensity_fields has one row per site of gdf_sites
+    # and one column per event (DataFrame indexed like gdf_sites, or array).
+    # Buildings are joined to the sites once and the fragility/vulnerability
+    # data and policies are resolved once; damage is then evaluated as a
+    # (buildings x events) computation, chunk_size events at a time to bound
+    # memory. For every event the result equals compute() with that field as
+    # the 'im' column of the intensity layer. A field is a single intensity
+    # measure; GEM fragilities are evaluated on it whatever their imt.
+    # Returns one row per event with the number of buildings in each damage
+    # state and the number of casualties. With return_damage_states, also a
+    # uint8 (buildings x events) frame of damage states indexed by bldid.
+    # If a LossAggregator is given, the casualties and damaged buildings of
+    # every event, in total and per zone, are fed to it with the annual
+    # occurrence rate of the event from event_rates, if given.
+    if hazard_type not in ["earthquake", "flood"]:
+        raise ValueError(f'Event sets are not supported for {hazard_type}')
+
+    earthquake_intensity_normalization_factor = 1
+    if earthquake_intensity_unit == 'm/s2':
+        earthquake_intensity_normalization_factor = 9.81
+    gem_fragility = True if isinstance(df_hazard, dict) else False
+
+    if isinstance(intensity_fields, pd.DataFrame):
+        events = list(intensity_fields.columns)
+        fields = intensity_fields.to_numpy(dtype=np.float64)
+    else:
+        fields = np.asarray(intensity_fields, dtype=np.float64)
+        if fields.ndim == 1:
+            fields = fields[:, None]
+        events = list(range(fields.shape[1]))
+    if len(fields) != len(gdf_sites):
+        raise ValueError(f'intensity_fields has {len(fields)} rows for {len(gdf_sites)} sites')
+
+    np.random.seed(seed=0)
+    gdf_landuse = gdf_landuse.rename(columns=COLUMN_NAMES)
+    gdf_buildings = gdf_buildings.rename(columns=COLUMN_NAMES)
+    if not isinstance(df_hazard, dict):
+        df_hazard = df_hazard.copy()
+        df_hazard['expstr'] = df_hazard['expstr'].str.replace('Type[0-9]+','RCi',regex=True)
+
+    gdf_sites = gdf_sites[['geometry']].reset_index(drop=True)
+    gdf_building_intensity = building_intensity_join(gdf_landuse, gdf_buildings, gdf_sites)
+    policy_params = {'cdf_median_increase_in_percent': cdf_median_increase_in_percent,
+                     'flood_depth_reduction': flood_depth_reduction,
+                     'damage_curve_suppress_factor': damage_curve_suppress_factor}
+    bld, intensity_steps = building_vulnerability(gdf_building_intensity, df_hazard, hazard_type,
+                                                  policies, policy_params)
+    site_pos = bld['index_intensity'].to_numpy()
+    residents = bld['residents'].to_numpy(dtype=np.float64)
+    n_buildings = len(bld)
+
+    # Everything that does not depend on the intensity, once for all events
+    if hazard_type == "earthquake":
+        n_states = 5
+        casualty_rates = np.array([0, 0.05, 0.28, 1.152, 74.41]) # percent
+        if not gem_fragility:
+            log_medians = np.log(bld[['muds1_g','muds2_g','muds3_g','muds4_g']].to_numpy(dtype=np.float64))
+            sigmas = bld[['sigmads1','sigmads2','sigmads3','sigmads4']].to_numpy(dtype=np.float64)
+        else:
+            compiled_fragility = compile_gem_fragility(df_hazard['fragilityFunctions'])
+            fragility_groups = bld.groupby('fragility_id', sort=False).indices
+    else:
+        n_states = 2
+        away_from_flood = bld['distance'].to_numpy() > threshold_flood_distance
+        damage_curves = bld[FLOOD_CURVE_COLS].to_numpy(dtype=np.float64)
+        casualty_curve = FLOOD_CASUALTY_RATES
+    zone_index, zone_codes = None, None
+    if aggregator is not None:
+        zone_codes, zone_index = pd.factorize(bld['zoneid'])
+    # Policy masks only read building attributes
+    mask_frame = bld[[c for c in bld.columns if c not in ['geometry', 'im']]]
+
+    if chunk_size is None:
+        # about 32 MB per (buildings x events x limit states) float64 array
+        chunk_size = max(1, 2**22 // max(1, 4 * n_buildings))
+    ds = np.zeros((n_buildings, len(events)), dtype=np.uint8)
+    rows = []
+    for start in range(0, len(events), chunk_size):
+        stop = min(start + chunk_size, len(events))
+        im = fields[site_pos, start:stop]
+        if hazard_type == "flood":
+            im[away_from_flood] = 0
+        if len(intensity_steps) > 0:
+            event_cols = [f'event {e}' for e in range(start, stop)]
+            im_frame = pd.concat([mask_frame.reset_index(drop=True),
+                                  pd.DataFrame(im, columns=event_cols)], axis=1)
+            im_frame = apply_policies(im_frame, intensity_steps, column_groups={'intensity_columns': event_cols})
+            im = im_frame[event_cols].to_numpy(dtype=np.float64)
+
+        if hazard_type == "earthquake":
+            if not gem_fragility:
+                logim = np.log(im / earthquake_intensity_normalization_factor)
+                prob_ds = norm.cdf(logim[:, :, None], log_medians[:, None, :], sigmas[:, None, :])
+            else:
+                prob_ds = np.full(im.shape + (len(GEM_LIMIT_STATES),), np.nan)
+                for frag_id, idx in fragility_groups.items():
+                    imls, poes = compiled_fragility[frag_id]
+                    intensity_in_g = im[idx] / earthquake_intensity_normalization_factor
+                    for k in range(len(poes)):
+                        prob_ds[idx, :, k] = np.interp(intensity_in_g, imls, poes[k])
+            chunk_ds = modal_damage_states(prob_ds)
+            casualty = (casualty_rates[chunk_ds] * residents[:, None] / 100).astype(int)
+        else:
+            im[im < 0] = 0
+            chunk_ds = np.zeros(im.shape, dtype=np.uint8)
+            casualty = np.zeros(im.shape, dtype=int)
+            for j in range(im.shape[1]):
+                fl_prob = interpolate_rowwise(FLOOD_CURVE_DEPTHS, damage_curves, im[:, j], fill_value=(0,1))
+                flooded_buildings = fl_prob > threshold_flood
+                chunk_ds[flooded_buildings, j] = 1
+                casualty_prob = interpolate_rowwise(FLOOD_CURVE_DEPTHS, casualty_curve, im[:, j], fill_value=(0,1))
+                casualty[flooded_buildings, j] = (casualty_prob * residents)[flooded_buildings].astype(int)
+
+        ds[:, start:stop] = chunk_ds
+        counts = np.stack([(chunk_ds == k).sum(axis=0) for k in range(n_states)], axis=1)
+        for j in range(stop - start):
+            rows.append({'event': events[start + j],
+                         **{f'ds{k}': counts[j, k] for k in range(n_states)},
+                         'casualty': casualty[:, j].sum()})
+            if aggregator is not None:
+                damaged = chunk_ds[:, j] > 0
+                zone_metrics = pd.DataFrame({
+                    'casualty': np.bincount(zone_codes, weights=casualty[:, j], minlength=len(zone_index)),
+                    'damaged': np.bincount(zone_codes, weights=damaged, minlength=len(zone_index))},
+                    index=zone_index)
+                aggregator.add({'casualty': casualty[:, j].sum(), 'damaged': damaged.sum()}, zone_metrics=zone_metrics,
+                               rate=None if event_rates is None else event_rates[start + j])
+
+    summary = pd.DataFrame(rows)
+    if return_damage_states:
+        return summary, pd.DataFrame(ds, index=bld['bldid'].to_numpy(), columns=events)
+    return summary
+
+def compute_economic_loss(gdf_landuse, gdf_buildings, gdf_intensity, gem_vulnerability, policies=[],
+            earthquake_intensity_unit = 'm/s2',
+            cdf_median_increase_in_percent = 0.20,
+            sample_uncertainty = False,
+            seed = None,
+            ):
+    # Economic loss of every building from a GEM vulnerability model (as read
+    # by read_gem_xml_vulnerability) and its replacement value. Buildings are
+    # matched to vulnerability functions by their full taxonomy, like GEM
+    # fragility functions, and evaluated in one interpolation per function.
+    # Building policies change the taxonomy and GEM fragility policies the
+    # intensity, as in compute(). With sample_uncertainty, loss ratios are
+    # drawn with the coefficient of variation of the functions.
+    # Returns the per-building losses and their totals per zone.
+    earthquake_intensity_normalization_factor = 1
+    if earthquake_intensity_unit == 'm/s2':
+        earthquake_intensity_normalization_factor = 9.81
+
+    np.random.seed(seed=0)
+    gdf_landuse = gdf_landuse.rename(columns=COLUMN_NAMES)
+    gdf_buildings = gdf_buildings.rename(columns=COLUMN_NAMES)
+    gdf_intensity = gdf_intensity.rename(columns=COLUMN_NAMES)
+
+    gdf_building_intensity = building_intensity_join(gdf_landuse, gdf_buildings, gdf_intensity)
+    policy_params = {'cdf_median_increase_in_percent': cdf_median_increase_in_percent}
+    bld_loss, intensity_steps = building_vulnerability(gdf_building_intensity, gem_vulnerability, 'earthquake',
+                                                       policies, policy_params)
+    imt_cols = [c for c in pd.unique(bld_loss['imt_2']).tolist() if isinstance(c, str)]
+    # Single-band intensity layers serve every intensity measure type
+    for c in imt_cols:
+        if c not in bld_loss.columns:
+            if 'im' not in bld_loss.columns:
+                raise ValueError(f'No intensity measure found for {c}')
+            bld_loss[c] = bld_loss['im']
+    bld_loss = apply_policies(bld_loss, intensity_steps, column_groups={'intensity_columns': imt_cols})
+
+    compiled_vulnerability = compile_gem_vulnerability(gem_vulnerability['vulnerabilityFunctions'])
+    rng = np.random.default_rng(seed) if sample_uncertainty else None
+    bld_loss['loss_ratio'] = gem_loss_ratios(bld_loss, compiled_vulnerability, id_col='vulnerability_id',
+            imt_col='imt_2', normalization_factor=earthquake_intensity_normalization_factor, rng=rng)
+    missing = bld_loss['loss_ratio'].isna()
+    if missing.any():
+        warnings.warn(f"No vulnerability function for {', '.join(map(str, pd.unique(bld_loss.loc[missing, 'expstr'])))}; "
+                      'their loss is taken as 0')
+    bld_loss['loss_ratio'] = bld_loss['loss_ratio'].fillna(0)
+    bld_loss['loss'] = bld_loss['loss_ratio'] * bld_loss['repvalue']
+
+    zone_loss = bld_loss.groupby('zoneid', as_index=False)[['repvalue','loss']].sum()
+    zone_loss['loss_ratio'] = zone_loss['loss'] / zone_loss['repvalue']
+
+    return bld_loss[['bldid','zoneid','repvalue','loss_ratio','loss']], zone_loss
+
 def create_tally(l, b, h, i):
     '''Create a tally dataframe from exposure'''
 
@@ -814,8 +1736,16 @@ def create_tally(l, b, h, i):
                 .rename(columns={'ds':'ds_hospital'}),
                 how='left',left_on='commfacid', right_on='bldid',validate='many_to_one',suffixes=(None,'_hospital'))
 
+    # Merges with missing rows widen integer columns; keep the dtypes of the
+    # input layers where they are narrower
+    dtypes = {**l.dtypes.to_dict(), **b.dtypes.to_dict(), **h.dtypes.to_dict(), **i.dtypes.to_dict()}
+    dtypes.update({'ds_facility': b['ds'].dtype, 'ds_hospital': b['ds'].dtype,
+                   'bldid_facility': b['bldid'].dtype, 'bldid_hospital': b['bldid'].dtype})
+    tally = restore_dtypes(tally, dtypes)
+
     tally = tally.rename(columns={'casualty': 'casualty_in_building'})
-    tally['casualty'] = 0
+    casualty_dtype = tally['casualty_in_building'].dtype
+    tally['casualty'] = np.zeros(len(tally), dtype=casualty_dtype if pd.api.types.is_integer_dtype(casualty_dtype) else np.int64)
 
     #tally.to_excel('/tmp/tally.xlsx')
     building_level_casualties = tally[tally['casualty_in_building'] > 0][['bldid','casualty_in_building']].drop_duplicates()
@@ -832,7 +1762,9 @@ def create_tally(l, b, h, i):
     return tally, tally_geo
 
 
-def generate_metrics(t, t_full, hazard_type, population_displacement_consensus):
+def metric_indicators(t, hazard_type, population_displacement_consensus):
+    # Rows of the tally counted by each metric, and the workers and students.
+    # Metrics in HOUSEHOLD_METRICS count the distinct households of their rows.
     DS_NO = 0
     DS_SLIGHT = 1
     DS_MODERATE = 2
@@ -957,15 +1889,23 @@ def generate_metrics(t, t_full, hazard_type, population_displacement_consensus):
             t['casualty'] == 1
         )
 
+    return {'metric1': is_unemployed, 'metric2': lost_school, 'metric3': household_lost_hospital,
+            'metric4': lost_hospital, 'metric5': lost_household, 'metric6': is_homeless,
+            'metric7': is_displaced, 'metric8': is_casualty, 'workers': is_worker, 'students': is_student}
 
-    metric1 = len(t[is_unemployed])
-    metric2 = len(t[lost_school])
-    metric3 = len(t[household_lost_hospital]['hhid'].unique())
-    metric4 = len(t[lost_hospital])
-    metric5 = len(t[lost_household]['hhid'].unique())
-    metric6 = len(t[is_homeless])
-    metric7 = len(t[is_displaced])
-    metric8 = len(t[is_casualty])
+HOUSEHOLD_METRICS = ['metric3', 'metric5']
+
+def generate_metrics(t, t_full, hazard_type, population_displacement_consensus):
+    indicators = metric_indicators(t, hazard_type, population_displacement_consensus)
+
+    metric1 = len(t[indicators['metric1']])
+    metric2 = len(t[indicators['metric2']])
+    metric3 = len(t[indicators['metric3']]['hhid'].unique())
+    metric4 = len(t[indicators['metric4']])
+    metric5 = len(t[indicators['metric5']]['hhid'].unique())
+    metric6 = len(t[indicators['metric6']])
+    metric7 = len(t[indicators['metric7']])
+    metric8 = len(t[indicators['metric8']])
 
 
     # I also need to find all workers and students to calculate
@@ -1008,6 +1948,847 @@ def generate_metrics(t, t_full, hazard_type, population_displacement_consensus):
 
     return new_metrics
 
+def exposure_tally(gdf_landuse, gdf_buildings, df_household, df_individual, bldids):
+    # Tally of the undamaged exposure for repeated metric evaluation. Returns
+    # the tally, the positions in bldids of every row's building, facility and
+    # hospital, and a fixed random order of individuals within their building
+    # used to pick casualties.
+    buildings = gdf_buildings.copy()
+    buildings['ds'] = 0
+    buildings['casualty'] = 0
+    tally, _ = create_tally(gdf_landuse, buildings, df_household, df_individual)
+    building_index = pd.Index(bldids)
+    tally_pos = {col: building_index.get_indexer(tally[bldid_col]) for col, bldid_col in
+                 [('ds', 'bldid'), ('ds_facility', 'bldid_facility'), ('ds_hospital', 'bldid_hospital')]}
+    shuffled = tally['bldid'].sample(frac=1)
+    casualty_rank = shuffled.groupby(shuffled).cumcount().reindex(tally.index).to_numpy()
+    return tally, tally_pos, casualty_rank
+
+def gather(values, positions, fill=np.nan):
+    # values[positions] with fill where the position is -1
+    values = np.asarray(values)
+    if len(values) == 0:
+        return np.full(len(positions), fill)
+    return np.where(positions > -1, values[positions], fill)
+
+def set_tally_damage(tally, tally_pos, casualty_rank, ds, casualty):
+    # Write building damage states and casualty counts into an exposure tally
+    ds = np.asarray(ds, dtype=np.float64)
+    for col, pos in tally_pos.items():
+        tally[col] = gather(ds, pos)
+    tally['casualty'] = (casualty_rank < gather(casualty, tally_pos['ds'], 0)).astype(int)
+
+def policy_subsets(policies):
+    # All combinations of the given policies, including the empty one
+    return [list(c) for n in range(len(policies) + 1) for c in combinations(policies, n)]
+
+def sweep_policies(gdf_landuse, gdf_buildings, df_household, df_individual, gdf_intensity, df_hazard, hazard_type,
+            portfolios, population_displacement_consensus = 2, **compute_kwargs):
+    # Evaluate many policy portfolios against the same hazard scenario.
+    # The spatial join, landuse merge, exposure tally and the fragility or
+    # vulnerability parameters of the buildings without policies are built
+    # once. Each portfolio joins again only the buildings whose taxonomy its
+    # building policies change, applies its policies on the parameters and
+    # intensity, and gathers the new damage states into the tally. Every
+    # portfolio starts from the same random state, so its damage states are
+    # those of compute() with the same policies. Infrastructure results
+    # (has_power, hospital_access, facility_access) are taken as they are in
+    # the input layers, so portfolios with policies on the road network are
+    # rejected. Returns one row of metrics per portfolio.
+    for policies in portfolios:
+        road_policies = sorted(set(spec['policy'] for spec in POLICY_SPECS
+                                   if spec['policy'] in policies and spec['stage'] in ['road_fragility', 'road_thresholds']
+                                   and (spec['hazards'] is None or hazard_type in spec['hazards'])))
+        if len(road_policies) > 0:
+            raise ValueError(f'Policies {road_policies} act on the road network, which sweep_policies does not '
+                             f'evaluate; run compute_road_infra for portfolio {list(policies)}')
+
+    if hazard_type != "landslide":
+        np.random.seed(seed=0)
+
+    gdf_landuse = gdf_landuse.rename(columns=COLUMN_NAMES)
+    gdf_buildings = gdf_buildings.rename(columns=COLUMN_NAMES)
+    df_household = df_household.rename(columns=COLUMN_NAMES)
+    df_individual = df_individual.rename(columns=COLUMN_NAMES)
+    gdf_intensity = gdf_intensity.rename(columns=COLUMN_NAMES)
+
+    if not isinstance(df_hazard, dict):
+        df_hazard = df_hazard.copy()
+        df_hazard['expstr'] = df_hazard['expstr'].str.replace('Type[0-9]+','RCi',regex=True)
+
+    gdf_building_intensity = building_intensity_join(gdf_landuse, gdf_buildings, gdf_intensity)
+    random_state = np.random.get_state()
+
+    tally, tally_pos, casualty_rank = exposure_tally(gdf_landuse, gdf_buildings, df_household, df_individual,
+                                                    gdf_building_intensity['bldid'])
+    # Policies do not change the fragility functions themselves
+    compiled_fragility = None
+    if hazard_type == "earthquake" and isinstance(df_hazard, dict):
+        compiled_fragility = compile_gem_fragility(df_hazard['fragilityFunctions'])
+
+    policy_params = {'cdf_median_increase_in_percent': compute_kwargs.get('cdf_median_increase_in_percent', 0.20),
+                     'flood_depth_reduction': compute_kwargs.get('flood_depth_reduction', 0.20),
+                     'damage_curve_suppress_factor': compute_kwargs.get('damage_curve_suppress_factor', 0.9)}
+    base = None
+    if hazard_type != "landslide":
+        # Damage states do not need the geometries
+        gdf_building_intensity = pd.DataFrame(gdf_building_intensity.drop(columns='geometry'))
+        if hazard_type == "flood":
+            flood_distance_cutoff(gdf_building_intensity, compute_kwargs.get('threshold_flood_distance', 10))
+        base_buildings = building_policies(gdf_building_intensity.copy(), hazard_type, [], policy_params)
+        base = (base_buildings, vulnerability_join(base_buildings, df_hazard, hazard_type),
+                taxonomy_keys(base_buildings))
+
+    rows = []
+    for policies in portfolios:
+        np.random.set_state(random_state)
+        if base is None:
+            bld_hazard = compute_building_damage(gdf_building_intensity.copy(), df_hazard, hazard_type,
+                                                 policies=list(policies), **compute_kwargs)
+        else:
+            # Only the vulnerability frame of the portfolio is modified
+            vulnerability = portfolio_vulnerability(base, gdf_building_intensity, df_hazard, hazard_type,
+                                                    list(policies), policy_params)
+            bld_hazard = compute_building_damage(gdf_building_intensity, df_hazard, hazard_type,
+                                                 policies=list(policies), compiled_fragility=compiled_fragility,
+                                                 vulnerability=vulnerability, **compute_kwargs)
+        set_tally_damage(tally, tally_pos, casualty_rank, bld_hazard['ds'].to_numpy(), bld_hazard['casualty'].to_numpy())
+        metrics = generate_metrics(tally, tally, hazard_type, population_displacement_consensus)
+        rows.append({'policies': list(policies), **{m: v['value'] for m, v in metrics.items()}})
+
+    return pd.DataFrame(rows)
+
+def taxonomy_keys(gdf_buildings):
+    # The keys vulnerability_join() joins on, one pair per building
+    return (taxonomy_dictionary.composite_key([(c, gdf_buildings[c]) for c in VULNSTREQ_COMPONENTS]),
+            taxonomy_dictionary.composite_key([(c, gdf_buildings[c]) for c in EXPSTR_COMPONENTS]))
+
+def portfolio_vulnerability(base, gdf_building_intensity, df_hazard, hazard_type, policies, policy_params):
+    # building_vulnerability() of a portfolio from that of the buildings
+    # without policies, base = (buildings, joined frame, taxonomy keys).
+    # Only buildings whose taxonomy keys the building policies change are
+    # joined again.
+    base_buildings, bld_vulnerability, base_keys = base
+    bld_vulnerability = bld_vulnerability.copy()
+    if len(compile_policies(policies, 'building', hazard_type, policy_params)) > 0:
+        buildings = building_policies(gdf_building_intensity.copy(), hazard_type, policies, policy_params)
+        for col in buildings.columns:
+            bld_vulnerability[col] = buildings[col].to_numpy()
+        keys = taxonomy_keys(buildings)
+        changed = (keys[0] != base_keys[0]) | (keys[1] != base_keys[1])
+        if changed.any():
+            joined = vulnerability_join(buildings[changed], df_hazard, hazard_type)
+            for col in bld_vulnerability.columns.difference(base_buildings.columns):
+                bld_vulnerability.loc[changed, col] = joined[col].to_numpy()
+    return vulnerability_policies(bld_vulnerability, df_hazard, hazard_type, policies, policy_params)
+
+def exceedance_counts(values, weights, thresholds):
+    # Number of values above each threshold and the sum of their weights,
+    # by binary search in the sorted values and cumulative sums of weights.
+    # Like values > threshold, NaN values never count.
+    values = np.asarray(values, dtype=np.float64)
+    valid = ~np.isnan(values)
+    order = np.argsort(values[valid], kind='stable')
+    sorted_values = values[valid][order]
+    weight_cumsum = np.concatenate([[0], np.cumsum(np.asarray(weights, dtype=np.float64)[valid][order])])
+    at_most = np.searchsorted(sorted_values, np.asarray(thresholds, dtype=np.float64), side='right')
+    return len(sorted_values) - at_most, weight_cumsum[-1] - weight_cumsum[at_most]
+
+class FloodThresholdSensitivity:
+    '''Flood damage of buildings as a function of threshold_flood and
+    threshold_flood_distance
+
+    Holds, for every building, the distance to its nearest intensity and the
+    flood probability and casualties it has when the water depth is that of
+    the nearest intensity (near) or zero (far, beyond threshold_flood_distance).
+    A building is flooded if its probability is above threshold_flood. Damage
+    states for any pair of thresholds, and flooded buildings and casualties
+    along a whole range of thresholds, are then obtained without running the
+    joins and fragility stage again.
+    '''
+    def __init__(self, bldid, distance, prob_near, prob_far, casualty_near, casualty_far):
+        self.bldid = np.asarray(bldid)
+        self.distance = np.asarray(distance, dtype=np.float64)
+        self.prob_near = np.asarray(prob_near, dtype=np.float64)
+        self.prob_far = np.asarray(prob_far, dtype=np.float64)
+        self.casualty_near = np.asarray(casualty_near, dtype=np.int64)
+        self.casualty_far = np.asarray(casualty_far, dtype=np.int64)
+
+    def probabilities(self, threshold_flood_distance):
+        near = self.distance <= threshold_flood_distance
+        return np.where(near, self.prob_near, self.prob_far), np.where(near, self.casualty_near, self.casualty_far)
+
+    def damage(self, threshold_flood=0.2, threshold_flood_distance=10):
+        # Same as the bldid, ds and casualty returned by compute()
+        prob, casualty = self.probabilities(threshold_flood_distance)
+        flooded = prob > threshold_flood
+        return pd.DataFrame({'bldid': self.bldid, 'ds': flooded.astype(np.int64),
+                             'casualty': np.where(flooded, casualty, 0)})
+
+    def flood_threshold_curve(self, thresholds=None, threshold_flood_distance=10):
+        # Flooded buildings and casualties against threshold_flood, at every
+        # probability where they change if thresholds is not given
+        prob, casualty = self.probabilities(threshold_flood_distance)
+        if thresholds is None:
+            thresholds = np.unique(np.concatenate([[0], prob]))
+        flooded, casualties = exceedance_counts(prob, casualty, thresholds)
+        return pd.DataFrame({'threshold_flood': thresholds, 'flooded_buildings': flooded,
+                             'casualty': casualties.astype(np.int64)})
+
+    def distance_threshold_curve(self, distances=None, threshold_flood=0.2):
+        # Flooded buildings and casualties against threshold_flood_distance, at
+        # every building distance if distances is not given. A building
+        # counts with its near outcome up to its distance and its far one beyond.
+        if distances is None:
+            distances = np.unique(np.concatenate([[0], self.distance[~np.isnan(self.distance)]]))
+        distances = np.asarray(distances, dtype=np.float64)
+        near = self.prob_near > threshold_flood
+        far = self.prob_far > threshold_flood
+        casualty_near = np.where(near, self.casualty_near, 0)
+        casualty_far = np.where(far, self.casualty_far, 0)
+        # Every building counts with its far outcome, plus the difference to
+        # its near one within the distance (distance <= threshold)
+        measured = ~np.isnan(self.distance)
+        flooded_change = near.astype(np.int64) - far
+        casualty_change = casualty_near - casualty_far
+        _, flooded_beyond = exceedance_counts(self.distance, flooded_change, distances)
+        _, casualty_beyond = exceedance_counts(self.distance, casualty_change, distances)
+        flooded = far.sum() + flooded_change[measured].sum() - flooded_beyond
+        casualties = casualty_far.sum() + casualty_change[measured].sum() - casualty_beyond
+        return pd.DataFrame({'threshold_flood_distance': distances, 'flooded_buildings': flooded.astype(np.int64),
+                             'casualty': casualties.astype(np.int64)})
+
+def compute_flood_sensitivity(gdf_landuse, gdf_buildings, gdf_intensity, df_hazard, policies=[],
+            flood_depth_reduction = 0.20,
+            damage_curve_suppress_factor = 0.9,
+            fingerprints = None,
+            ):
+    # One pass of compute() for flood, keeping the continuous quantities the
+    # thresholds are applied to. The random state is that of compute(), so
+    # FloodThresholdSensitivity.damage() equals compute() for the same
+    # policies and thresholds. fingerprints are those of compute().
+    np.random.seed(seed=0)
+
+    gdf_landuse = gdf_landuse.rename(columns=COLUMN_NAMES)
+    gdf_buildings = gdf_buildings.rename(columns=COLUMN_NAMES)
+    gdf_intensity = gdf_intensity.rename(columns=COLUMN_NAMES)
+    df_hazard = df_hazard.copy()
+    df_hazard['expstr'] = df_hazard['expstr'].str.replace('Type[0-9]+','RCi',regex=True)
+
+    gdf_building_intensity = building_intensity_join(gdf_landuse, gdf_buildings, gdf_intensity,
+                                                     fingerprints=fingerprints)
+    policy_params = {'cdf_median_increase_in_percent': 0.20,
+                     'flood_depth_reduction': flood_depth_reduction,
+                     'damage_curve_suppress_factor': damage_curve_suppress_factor}
+    bld_flood, intensity_steps = building_vulnerability(gdf_building_intensity, df_hazard, 'flood',
+                                                        policies, policy_params)
+    near = flood_depth_probabilities(bld_flood.copy(), intensity_steps)
+    far = flood_depth_probabilities(bld_flood.assign(im=0), intensity_steps)
+    residents = bld_flood['residents'].to_numpy()
+    return FloodThresholdSensitivity(bld_flood['bldid'], bld_flood['distance'],
+                                     near['fl_prob'], far['fl_prob'],
+                                     (near['casualty_prob'].to_numpy() * residents).astype(int),
+                                     (far['casualty_prob'].to_numpy() * residents).astype(int))
+
+class RoadThresholdSensitivity:
+    '''Flooded road edges as a function of the road and culvert water height
+    thresholds, from the water height of every edge
+
+    Roads (edges without bridge_type) and culverts are flooded if the water
+    height is above their threshold, after the threshold policies (policy 4).
+    If the compiled network and the source and target nodes of
+    road_access_pairs() are given, the hospital and facility access left
+    after removing the flooded edges is also available.
+    '''
+    def __init__(self, edge_id, im, bridge_type, threshold_steps=[], network=None, sources=None, targets=None,
+                 n_households=0, directed=False):
+        self.edge_id = np.asarray(edge_id)
+        self.im = np.asarray(im, dtype=np.float64)
+        self.roads = pd.isna(np.asarray(bridge_type, dtype=object))
+        self.culverts = np.asarray(bridge_type, dtype=object) == 'culvert'
+        self.threshold_steps = threshold_steps
+        self.network = network
+        self.sources = sources
+        self.targets = targets
+        self.n_households = n_households
+        self.directed = directed
+
+    def thresholds(self, road_water_height_threshold, culvert_water_height_threshold):
+        thresholds = apply_policies_to_values({'road_water_height_threshold': road_water_height_threshold,
+                                               'culvert_water_height_threshold': culvert_water_height_threshold},
+                                              self.threshold_steps)
+        return thresholds['road_water_height_threshold'], thresholds['culvert_water_height_threshold']
+
+    def damage(self, road_water_height_threshold=0.3, culvert_water_height_threshold=1.5):
+        # Edges flooded at the given thresholds, as in compute_road_infra()
+        road_threshold, culvert_threshold = self.thresholds(road_water_height_threshold, culvert_water_height_threshold)
+        return (self.roads & (self.im > road_threshold)) | (self.culverts & (self.im > culvert_threshold))
+
+    def access(self, road_water_height_threshold=0.3, culvert_water_height_threshold=1.5):
+        # Hospital access of every household and facility access of every
+        # individual at the given thresholds, as in compute_road_infra()
+        alive = self.network.alive_edges(self.damage(road_water_height_threshold, culvert_water_height_threshold),
+                                         self.directed)
+        access = self.network.reachability(alive, self.directed).reachable(self.sources, self.targets)
+        return access[:self.n_households], access[self.n_households:]
+
+    def threshold_curve(self, road_thresholds=None, culvert_thresholds=None):
+        # Flooded roads and flooded culverts against their thresholds, at every
+        # water height where they change if the thresholds are not given.
+        # Returns one frame per edge type.
+        offsets = self.thresholds(0, 0)
+        curves = []
+        for k, (edges, given, name) in enumerate([(self.roads, road_thresholds, 'road_water_height_threshold'),
+                                                  (self.culverts, culvert_thresholds, 'culvert_water_height_threshold')]):
+            im = self.im[edges]
+            if given is None:
+                # Threshold policies only add to the thresholds
+                given = np.unique(np.concatenate([[0], im[~np.isnan(im)]])) - offsets[k]
+            given = np.asarray(given, dtype=np.float64)
+            effective = np.array([self.thresholds(t, t)[k] for t in given])
+            flooded, _ = exceedance_counts(im, np.ones(len(im)), effective)
+            curves.append(pd.DataFrame({name: given, 'flooded_edges': flooded}))
+        return curves[0], curves[1]
+
+def compute_road_sensitivity(edges, intensity, policies=[],
+            threshold_increase_culvert_water_height = 0.2,
+            threshold_increase_road_water_height = 0.2,
+            threshold_flood_distance = 10,
+            edge_intensity_sampling = 'max',
+            nodes = None,
+            buildings = None,
+            household = None,
+            individual = None,
+            preserve_edge_directions = False,
+            fingerprints = None,
+            ):
+    # Water height of every road edge as in compute_road_infra() for flood.
+    # If the road nodes and the buildings, households and individuals are
+    # given, the network and the nearest road node of every building are
+    # kept too, so that the sensitivity also answers the hospital and
+    # facility access at other thresholds.
+    policy_params = {'threshold_increase_culvert_water_height': threshold_increase_culvert_water_height,
+                     'threshold_increase_road_water_height': threshold_increase_road_water_height}
+    epsg = 3857
+    fingerprints = dict() if fingerprints is None else fingerprints
+    gdf_intensity = intensity if isinstance(intensity, RasterIntensity) else \
+        project_layer(intensity, epsg, fingerprints.get('intensity'))
+    gdf_edges = road_edge_intensity(project_layer(edges, epsg, fingerprints.get('road edges')), gdf_intensity,
+                                    threshold_flood_distance, edge_intensity_sampling,
+                                    fingerprints=(projected_fingerprint(fingerprints.get('road edges'), epsg),
+                                                  projected_fingerprint(fingerprints.get('intensity'), epsg)))
+    threshold_steps = compile_policies(policies, 'road_thresholds', 'flood', policy_params)
+    if nodes is None:
+        return RoadThresholdSensitivity(gdf_edges['edge_id'], gdf_edges['im'], gdf_edges['bridge_type'], threshold_steps)
+
+    buildings = buildings.rename(columns=COLUMN_NAMES)
+    household = household.rename(columns=COLUMN_NAMES)
+    individual = individual.rename(columns=COLUMN_NAMES)
+    gdf_nodes = project_layer(nodes, epsg, fingerprints.get('road nodes'))
+    gdf_buildings = project_layer(buildings, epsg, fingerprints.get('building')).drop(columns=['node_id'], errors='ignore')
+    network = network_topology(gdf_nodes['node_id'], gdf_edges['from_node'], gdf_edges['to_node'])
+    nearest = cached_sjoin_nearest(gdf_buildings, gdf_nodes, how='left',
+                                   rsuffix='road_node', distance_col='road_node_distance',
+                                   fingerprints=(projected_fingerprint(fingerprints.get('building'), epsg),
+                                                 projected_fingerprint(fingerprints.get('road nodes'), epsg)))
+    nearest = nearest.drop_duplicates(subset=['bldid'], keep='first')
+    building_index = pd.Index(nearest['bldid'])
+    sources, targets = road_access_pairs(network.positions(nearest['node_id']), nearest['occupancy'].astype(str).to_numpy(),
+                                         building_index, household, individual)
+    return RoadThresholdSensitivity(gdf_edges['edge_id'], gdf_edges['im'], gdf_edges['bridge_type'], threshold_steps,
+                                    network=network, sources=sources, targets=targets,
+                                    n_households=len(household), directed=preserve_edge_directions)
+
+def threshold_metrics(sensitivity, gdf_landuse, gdf_buildings, df_household, df_individual, thresholds,
+                      population_displacement_consensus = 2, road_sensitivity = None):
+    # Metrics against flood thresholds: one row per (threshold_flood,
+    # threshold_flood_distance) pair, or per (threshold_flood,
+    # threshold_flood_distance, road_water_height_threshold,
+    # culvert_water_height_threshold) if a RoadThresholdSensitivity with its
+    # network is given. Building damage comes from the
+    # FloodThresholdSensitivity (or the building layer if it is None) and
+    # hospital and facility access from the road sensitivity; both are
+    # gathered into an exposure tally built once, and thresholds with the
+    # same outcome share one metric evaluation. Other infrastructure results
+    # are taken as they are in the input layers.
+    gdf_landuse = gdf_landuse.rename(columns=COLUMN_NAMES)
+    gdf_buildings = gdf_buildings.rename(columns=COLUMN_NAMES)
+    df_household = df_household.rename(columns=COLUMN_NAMES)
+    df_individual = df_individual.rename(columns=COLUMN_NAMES)
+    bldids = gdf_buildings['bldid'] if sensitivity is None else sensitivity.bldid
+    tally, tally_pos, casualty_rank = exposure_tally(gdf_landuse, gdf_buildings, df_household, df_individual, bldids)
+    tally_household = pd.Index(df_household['hhid']).get_indexer(tally['hhid'])
+    rows = []
+    evaluated = dict()
+    for threshold in thresholds:
+        threshold_flood, threshold_flood_distance = threshold[:2]
+        if sensitivity is None:
+            ds, casualty = gdf_buildings['ds'].to_numpy(), gdf_buildings['casualty'].to_numpy()
+        else:
+            damage = sensitivity.damage(threshold_flood, threshold_flood_distance)
+            ds, casualty = damage['ds'].to_numpy(), damage['casualty'].to_numpy()
+        key = ds.tobytes() + casualty.tobytes()
+        row = {'threshold_flood': threshold_flood, 'threshold_flood_distance': threshold_flood_distance}
+        if road_sensitivity is not None:
+            row['road_water_height_threshold'], row['culvert_water_height_threshold'] = threshold[2:]
+            household_access, individual_access = road_sensitivity.access(*threshold[2:])
+            key += household_access.tobytes() + individual_access.tobytes()
+        if key not in evaluated:
+            set_tally_damage(tally, tally_pos, casualty_rank, ds, casualty)
+            if road_sensitivity is not None:
+                set_tally_access(tally, tally_household, household_access, individual_access)
+            metrics = generate_metrics(tally, tally, 'flood', population_displacement_consensus)
+            evaluated[key] = {m: v['value'] for m, v in metrics.items()}
+        rows.append({**row, **evaluated[key]})
+    return pd.DataFrame(rows)
+
+def stratified_building_sample(gdf_buildings, df_household, df_individual, fraction=0.1,
+            strata=['zoneid','occupancy','expstr'], seed=0):
+    # Stratified random sample of buildings for approximate metrics. Every
+    # stratum (zone, occupancy and taxonomy by default) keeps ceil(fraction)
+    # of its buildings, and buildings serving as hospitals, workplaces or
+    # schools are all kept so that the facility of every sampled individual
+    # is known. Returns bldid, stratum, stratum_size, sample_size and weight
+    # (stratum_size / sample_size) of the sampled buildings; kept facilities
+    # form stratum -1 of weight 1.
+    gdf_buildings = gdf_buildings.rename(columns=COLUMN_NAMES)
+    df_household = df_household.rename(columns=COLUMN_NAMES)
+    df_individual = df_individual.rename(columns=COLUMN_NAMES)
+    buildings = gdf_buildings.drop_duplicates(subset=['bldid'])
+
+    facilities = buildings['bldid'].isin(df_household['commfacid']) | buildings['bldid'].isin(df_individual['indivfacid'])
+    stratum = buildings.groupby([buildings[c].astype(str) for c in strata], sort=False).ngroup().to_numpy()
+    stratum = np.where(facilities, -1, stratum)
+
+    frame = pd.DataFrame({'bldid': buildings['bldid'].to_numpy(), 'stratum': stratum,
+                          'key': np.random.default_rng(seed).random(len(buildings))})
+    frame['stratum_size'] = frame.groupby('stratum')['bldid'].transform('count')
+    frame['sample_size'] = np.ceil(fraction * frame['stratum_size']).astype(np.int64)
+    frame.loc[frame['stratum'] == -1, 'sample_size'] = frame['stratum_size']
+    frame = frame.sort_values(['stratum', 'key'], kind='stable')
+    frame = frame[frame.groupby('stratum').cumcount() < frame['sample_size']]
+    frame['weight'] = frame['stratum_size'] / frame['sample_size']
+    return frame.drop(columns='key').sort_index().reset_index(drop=True)
+
+def estimate_metrics(gdf_landuse, gdf_buildings, df_household, df_individual, sample, hazard_type,
+            population_displacement_consensus = 2, confidence = 0.95):
+    # Metrics of the whole exposure estimated from a stratified_building_sample().
+    # gdf_buildings holds ds and casualty of (at least) the sampled buildings.
+    # Every metric is summed per building over the residents of the sampled
+    # buildings and expanded with the stratified estimator of a total, with a
+    # normal confidence interval from the within-stratum variances. Strata
+    # with a single sampled building use the pooled variance of the others.
+    # Returns the output of generate_metrics() with estimated values, and
+    # lower and upper bounds of every value.
+    gdf_landuse = gdf_landuse.rename(columns=COLUMN_NAMES)
+    gdf_buildings = gdf_buildings.rename(columns=COLUMN_NAMES)
+    df_household = df_household.rename(columns=COLUMN_NAMES)
+    df_individual = df_individual.rename(columns=COLUMN_NAMES)
+
+    buildings = gdf_buildings[gdf_buildings['bldid'].isin(sample['bldid'])]
+    household = df_household[df_household['bldid'].isin(sample['bldid'])]
+    individual = df_individual[df_individual['hhid'].isin(household['hhid'])]
+    tally, _ = create_tally(gdf_landuse, buildings, household, individual)
+    metrics = generate_metrics(tally, tally, hazard_type, population_displacement_consensus)
+    indicators = metric_indicators(tally, hazard_type, population_displacement_consensus)
+
+    # Per-building totals of every metric and of its maximum
+    indicators['individuals'] = np.ones(len(tally), dtype=bool)
+    indicators['households'] = indicators['individuals']
+    totals = pd.DataFrame(index=pd.Index(sample['bldid'], name='bldid'))
+    for name, mask in indicators.items():
+        rows = tally.loc[np.asarray(mask, dtype=bool), ['bldid', 'hhid']]
+        if name in HOUSEHOLD_METRICS or name == 'households':
+            per_building = rows.drop_duplicates('hhid').groupby('bldid').size()
+        else:
+            per_building = rows.groupby('bldid').size()
+        totals[name] = per_building.reindex(totals.index, fill_value=0).to_numpy()
+
+    strata = sample.set_index('bldid')[['stratum', 'stratum_size', 'sample_size']]
+    totals = totals.join(strata)
+    grouped = totals.groupby('stratum')
+    columns = list(indicators.keys())
+    sums = grouped[columns].sum()
+    variances = grouped[columns].var(ddof=1)
+    sizes = grouped[['stratum_size', 'sample_size']].first()
+    estimates = sums.mul(sizes['stratum_size'] / sizes['sample_size'], axis=0).sum()
+
+    single = sizes['sample_size'] < 2
+    if (~single).any():
+        degrees = sizes.loc[~single, 'sample_size'] - 1
+        pooled = variances[~single].mul(degrees, axis=0).sum() / degrees.sum()
+    else:
+        pooled = pd.Series(0.0, index=columns)
+    variances[single] = pooled.to_numpy()
+    finite_population = 1 - sizes['sample_size'] / sizes['stratum_size']
+    factor = sizes['stratum_size']**2 * finite_population / sizes['sample_size']
+    std = np.sqrt(variances.mul(factor, axis=0).sum())
+    z = norm.ppf(0.5 + confidence / 2)
+
+    maximums = {'metric1': 'workers', 'metric2': 'students', 'metric3': 'households', 'metric5': 'households'}
+    for name, metric in metrics.items():
+        maximum = maximums.get(name, 'individuals')
+        metric['value'] = int(round(estimates[name]))
+        metric['max_value'] = int(round(estimates[maximum]))
+        metric['lower'] = int(round(max(estimates[name] - z * std[name], 0)))
+        metric['upper'] = int(round(estimates[name] + z * std[name]))
+    return metrics
+
+def road_access_pairs(building_road_node, occupancy, building_index, df_household, df_individual):
+    # Source and target road node positions of the connectivity checks of
+    # compute_road_infra(): every household to its community hospital, then
+    # the household of every individual to the facility of the individual.
+    # building_road_node and occupancy are aligned with building_index.
+    household_index = pd.Index(df_household['hhid'])
+    household_building = building_index.get_indexer(df_household['bldid'])
+    household_hospital = building_index.get_indexer(df_household['commfacid'])
+    individual_household = household_index.get_indexer(df_individual['hhid'])
+    individual_facility = building_index.get_indexer(df_individual['indivfacid'])
+    # The community hospital must be a hospital to be reachable
+    household_hospital_node = np.where(gather(occupancy, household_hospital, '') == 'Hea',
+                                       gather(building_road_node, household_hospital, -1), -1).astype(np.int64)
+    household_road_node = gather(building_road_node, household_building, -1).astype(np.int64)
+    sources = np.concatenate([household_road_node, gather(household_road_node, individual_household, -1)]).astype(np.int64)
+    targets = np.concatenate([household_hospital_node, gather(building_road_node, individual_facility, -1)]).astype(np.int64)
+    return sources, targets
+
+def set_tally_access(tally, tally_household, household_access, individual_access):
+    # Write the hospital access of households and the facility access of
+    # individuals (in the order of the individual layer) into an exposure tally
+    tally['hospital_access'] = gather(household_access, tally_household, False).astype(bool)
+    tally['facility_access'] = np.asarray(individual_access, dtype=bool)
+    tally['lost_facility_access'] = tally['has_facility'] & ~tally['facility_access']
+
+def network_positions(node_ids, from_nodes, to_nodes):
+    # Integer positions of network nodes. Edge endpoints missing from the
+    # node layer become nodes too, as in nx.DiGraph.add_edge.
+    node_index = pd.Index(pd.unique(pd.concat([pd.Series(node_ids), pd.Series(from_nodes), pd.Series(to_nodes)],
+                                              ignore_index=True)))
+    return node_index, node_index.get_indexer(from_nodes), node_index.get_indexer(to_nodes)
+
+def adjacency_matrix(n_nodes, from_pos, to_pos):
+    return csr_matrix((np.ones(len(from_pos), dtype=np.int8), (from_pos, to_pos)), shape=(n_nodes, n_nodes))
+
+def edge_keys(n_nodes, from_pos, to_pos, directed):
+    # Edges between the same nodes share a key; without directions the
+    # order of the nodes does not matter
+    if directed:
+        edge_key = from_pos * n_nodes + to_pos
+    else:
+        edge_key = np.minimum(from_pos, to_pos) * n_nodes + np.maximum(from_pos, to_pos)
+    return pd.factorize(edge_key)[0]
+
+def alive_edges(edge_key, damaged):
+    # An edge is removed if any road/bridge between the same nodes is damaged
+    damaged_key = np.zeros(edge_key.max() + 1 if len(edge_key) > 0 else 0, dtype=bool)
+    damaged_key[edge_key[damaged]] = True
+    return ~damaged_key[edge_key]
+
+def reachable_from_any(n_nodes, from_pos, to_pos, sources, directed):
+    # Nodes that can be reached from at least one of the source nodes
+    reachable = np.zeros(n_nodes, dtype=bool)
+    if len(sources) == 0:
+        return reachable
+    if not directed:
+        _, labels = connected_components(adjacency_matrix(n_nodes, from_pos, to_pos), directed=False)
+        return np.isin(labels, labels[sources])
+    # a virtual node linked to all sources turns this into a single traversal
+    graph = adjacency_matrix(n_nodes + 1, np.concatenate([from_pos, np.full(len(sources), n_nodes)]),
+                             np.concatenate([to_pos, sources]))
+    reachable[breadth_first_order(graph, n_nodes, directed=True, return_predecessors=False)[1:]] = True
+    return reachable
+
+class ReachabilityIndex:
+    '''Answers whether one node of a network can be reached from another
+
+    Without directions, nodes reach each other if they are in the same
+    connected component. With directions, nodes are grouped into strongly
+    connected components, inside which every node reaches every other.
+    Pairs in different components are answered on the condensation (the
+    acyclic graph of components) with one traversal per distinct source or
+    target component, whichever are fewer.
+    '''
+    def __init__(self, n_nodes, from_pos, to_pos, directed):
+        self.directed = directed
+        graph = adjacency_matrix(n_nodes, from_pos, to_pos)
+        self.n_components, self.labels = connected_components(graph, directed=directed, connection='strong')
+        if directed:
+            from_component, to_component = self.labels[from_pos], self.labels[to_pos]
+            between = from_component != to_component
+            self.condensation = adjacency_matrix(self.n_components, from_component[between], to_component[between])
+
+    def reachable(self, sources, targets):
+        # Whether targets[k] can be reached from sources[k]; -1 is never reachable
+        sources, targets = np.asarray(sources), np.asarray(targets)
+        valid = (sources > -1) & (targets > -1)
+        reachable = np.zeros(len(sources), dtype=bool)
+        source_component = np.where(valid, self.labels[np.where(valid, sources, 0)], -1)
+        target_component = np.where(valid, self.labels[np.where(valid, targets, 0)], -1)
+        reachable[valid] = source_component[valid] == target_component[valid]
+        if not self.directed:
+            return reachable
+
+        pairs = np.flatnonzero(valid & ~reachable)
+        if len(pairs) == 0:
+            return reachable
+        # Traverse from the side with fewer distinct components: forward from
+        # sources, or backward from targets
+        if len(np.unique(source_component[pairs])) <= len(np.unique(target_component[pairs])):
+            graph, start, end = self.condensation, source_component, target_component
+        else:
+            graph, start, end = self.condensation.T.tocsr(), target_component, source_component
+        pairs = pairs[np.argsort(start[pairs], kind='stable')]
+        unique_starts, splits = np.unique(start[pairs], return_index=True)
+        for component, group in zip(unique_starts, np.split(pairs, splits[1:])):
+            visited = np.zeros(self.n_components, dtype=bool)
+            visited[breadth_first_order(graph, component, directed=True, return_predecessors=False)] = True
+            reachable[group] = visited[end[group]]
+        return reachable
+
+class NetworkTopology:
+    '''Compiled topology of a road or power network
+
+    Node ids are mapped to dense integer positions once and the edges are
+    kept as arrays of node positions. Damage is applied by masking the edge
+    arrays, so one topology serves every damage scenario, Monte Carlo trial
+    and policy run on the same network. Edge keys are computed on demand for
+    each direction setting.
+    '''
+    def __init__(self, node_ids, from_nodes, to_nodes):
+        self.node_index, self.from_pos, self.to_pos = network_positions(node_ids, from_nodes, to_nodes)
+        self.n_nodes = len(self.node_index)
+        self.n_edges = len(self.from_pos)
+        self.keys = dict()
+
+    @property
+    def nbytes(self):
+        return self.node_index.memory_usage(deep=True) + self.from_pos.nbytes + self.to_pos.nbytes + 2 * 8 * self.n_edges
+
+    def positions(self, node_ids):
+        # Dense positions of node ids, -1 for ids not in the network
+        return self.node_index.get_indexer(node_ids)
+
+    def edge_keys(self, directed):
+        if directed not in self.keys:
+            self.keys[directed] = edge_keys(self.n_nodes, self.from_pos, self.to_pos, directed)
+        return self.keys[directed]
+
+    def alive_edges(self, damaged_edges, directed):
+        # Edges left after removing the damaged edges
+        return alive_edges(self.edge_keys(directed), damaged_edges)
+
+    def edges_between(self, damaged_nodes):
+        # Edges left after removing the damaged nodes
+        return ~damaged_nodes[self.from_pos] & ~damaged_nodes[self.to_pos]
+
+    def reachable_from_any(self, alive, sources, directed, reverse=False):
+        # reverse=True gives the nodes that can reach at least one source
+        if reverse:
+            return reachable_from_any(self.n_nodes, self.to_pos[alive], self.from_pos[alive], sources, directed)
+        return reachable_from_any(self.n_nodes, self.from_pos[alive], self.to_pos[alive], sources, directed)
+
+    def reachability(self, alive, directed):
+        return ReachabilityIndex(self.n_nodes, self.from_pos[alive], self.to_pos[alive], directed)
+
+    def distances_from_any(self, alive, weights, sources, directed, reverse=False):
+        # Shortest weighted distance from the nearest source to every node,
+        # inf if unreachable: one multi-source Dijkstra. reverse=True gives
+        # the distance from every node to its nearest source.
+        distances = np.full(self.n_nodes, np.inf)
+        if len(sources) == 0:
+            return distances
+        edges = np.flatnonzero(alive)
+        # Parallel edges between the same nodes count once, with their shortest weight
+        edges = edges[np.argsort(weights[edges], kind='stable')]
+        edges = edges[np.unique(self.edge_keys(directed)[edges], return_index=True)[1]]
+        from_pos, to_pos = (self.to_pos, self.from_pos) if reverse else (self.from_pos, self.to_pos)
+        graph = csr_matrix((weights[edges], (from_pos[edges], to_pos[edges])), shape=(self.n_nodes, self.n_nodes))
+        return dijkstra(graph, directed=directed, indices=np.unique(sources), min_only=True)
+
+def network_topology(node_ids, from_nodes, to_nodes, cache=network_topology_cache):
+    # Compiled topologies are cached until the node ids or the edge
+    # endpoints of the network change
+    key = ('network', network_fingerprint(node_ids, from_nodes, to_nodes))
+    cached = cache.get(key)
+    if cached is None:
+        topology = NetworkTopology(node_ids, from_nodes, to_nodes)
+        cache.put(key, (topology,), nbytes=topology.nbytes)
+        return topology
+    return cached[0]
+
+def landslide_monte_carlo(gdf_landuse, gdf_buildings, df_household, df_individual, gdf_intensity, fragility,
+            n_trials, road_nodes = None, road_edges = None, power_nodes = None, power_edges = None,
+            preserve_edge_directions = False, population_displacement_consensus = 2, seed = None,
+            aggregator = None, threshold_flood_distance = 10, edge_intensity_sampling = 'nearest',
+            fingerprints = None, representative = False):
+    # Batched landslide Monte Carlo. Every building, road edge and power node
+    # collapses independently with its collapse probability (fragility has
+    # expstr, susceptibility and collapse_probability columns). Joins,
+    # fragility lookups, nearest road/power nodes and the exposure tally are
+    # computed once and the collapses of all trials are drawn at once as
+    # (elements x trials) matrices. Per trial, only the connectivity of the
+    # integer-coded road/power graphs and the metrics are evaluated.
+    # Road and power are included when their nodes and edges are given;
+    # otherwise the accessibility and power columns of the layers are used.
+    # Returns one row of metrics per trial. If a LossAggregator is given, the
+    # metrics and the casualties per zone of every trial are also fed to it.
+    # fingerprints are those of compute().
+    # If representative is True, (trials, realization) is returned, where
+    # realization holds the trial whose metrics are closest to the mean of
+    # the trials (in standard deviations, summed over the metrics): its
+    # number under 'trial' and, under the layer names, frames with the
+    # columns compute(), compute_road_infra() and compute_power_infra() set
+    # on 'building', 'household', 'individual', 'road edges' and
+    # 'power nodes', aligned with the rows of those layers.
+    DS_NO = 0
+    DS_COLLAPSED = 4
+    epsg = 3857
+    rng = np.random.default_rng(seed)
+    fingerprints = dict() if fingerprints is None else fingerprints
+    projected = {name: projected_fingerprint(f, epsg) for name, f in fingerprints.items()}
+
+    gdf_landuse = gdf_landuse.rename(columns=COLUMN_NAMES)
+    gdf_buildings = gdf_buildings.rename(columns=COLUMN_NAMES)
+    df_household = df_household.rename(columns=COLUMN_NAMES)
+    df_individual = df_individual.rename(columns=COLUMN_NAMES)
+    gdf_intensity = gdf_intensity.rename(columns=COLUMN_NAMES)
+
+    gdf_building_intensity = building_intensity_join(gdf_landuse, gdf_buildings, gdf_intensity,
+                                                     fingerprints=fingerprints)
+    gdf_building_intensity = building_landslide_fragility(gdf_building_intensity, fragility)
+    building_collapsed = sample_damage_states(gdf_building_intensity['collapse_probability'].to_numpy(), n_trials, rng) > 0
+    residents = gdf_building_intensity['residents'].to_numpy()
+    occupancy = gdf_building_intensity['occupancy'].astype(str).to_numpy()
+    building_index = pd.Index(gdf_building_intensity['bldid'])
+
+    tally, tally_pos, casualty_rank = exposure_tally(gdf_landuse, gdf_buildings, df_household, df_individual,
+                                                    gdf_building_intensity['bldid'])
+    household_index = pd.Index(df_household['hhid'])
+    household_building = building_index.get_indexer(df_household['bldid'])
+    household_hospital = building_index.get_indexer(df_household['commfacid'])
+    tally_household = household_index.get_indexer(tally['hhid'])
+
+    if road_nodes is not None or power_nodes is not None:
+        gdf_buildings_projected = project_layer(gdf_buildings, epsg, fingerprints.get('building'))
+        gdf_buildings_projected = gdf_buildings_projected.drop(columns=['node_id'], errors='ignore')
+        if not isinstance(gdf_intensity, RasterIntensity):
+            gdf_intensity = project_layer(gdf_intensity, epsg, fingerprints.get('intensity'))
+
+    if road_nodes is not None:
+        gdf_nodes = project_layer(road_nodes, epsg, fingerprints.get('road nodes'))
+        gdf_edges = project_layer(road_edges, epsg, fingerprints.get('road edges'))
+        gdf_edges = road_edge_intensity(gdf_edges, gdf_intensity, threshold_flood_distance, edge_intensity_sampling,
+                                        fingerprints=(projected.get('road edges'), projected.get('intensity')))
+        gdf_edges = road_landslide_fragility(gdf_edges, fragility)
+        edge_collapsed = sample_damage_states(gdf_edges['collapse_probability'].to_numpy(), n_trials, rng) > 0
+
+        road_network = network_topology(gdf_nodes['node_id'], gdf_edges['from_node'], gdf_edges['to_node'])
+
+        nearest = cached_sjoin_nearest(gdf_buildings_projected, gdf_nodes, how='left',
+                                       rsuffix='road_node', distance_col='road_node_distance',
+                                       fingerprints=(projected.get('building'), projected.get('road nodes')))
+        nearest = nearest.drop_duplicates(subset=['bldid'], keep='first')
+        building_road_node_id = pd.Series(nearest['node_id'].to_numpy(), index=nearest['bldid']).reindex(building_index)
+        building_road_node = road_network.positions(building_road_node_id)
+        sources, targets = road_access_pairs(building_road_node, occupancy, building_index, df_household, df_individual)
+
+    if power_nodes is not None:
+        gdf_power_nodes = project_layer(power_nodes, epsg, fingerprints.get('power nodes'))
+        gdf_power_nodes = join_intensity(gdf_power_nodes, gdf_intensity, rsuffix='intensity', distance_col='distance',
+                                         fingerprints=(projected.get('power nodes'), projected.get('intensity')))
+        gdf_power_nodes = power_landslide_fragility(gdf_power_nodes, fragility)
+        node_collapsed = sample_damage_states(gdf_power_nodes['collapse_probability'].to_numpy(), n_trials, rng) > 0
+
+        power_network = network_topology(gdf_power_nodes['node_id'], power_edges['from_node'], power_edges['to_node'])
+        power_node_pos = power_network.positions(gdf_power_nodes['node_id'])
+        power_plants = np.unique(power_node_pos[(gdf_power_nodes['pwr_plant'] == 1).to_numpy()])
+        server_nodes = gdf_power_nodes[gdf_power_nodes['n_bldgs'] > 0]
+        nearest = cached_sjoin_nearest(gdf_buildings_projected, server_nodes, how='left',
+                                       rsuffix='power_node', distance_col='power_node_distance',
+                                       fingerprints=(projected.get('building'), None))
+        nearest = nearest.drop_duplicates(subset=['bldid'], keep='first')
+        building_power_node = power_network.positions(pd.Series(nearest['node_id'].to_numpy(),
+                                                      index=nearest['bldid']).reindex(building_index))
+
+    def evaluate(trial):
+        # Writes the damage, access and power of a trial into the tally and
+        # returns the network states of the trial
+        state = dict()
+        collapsed = building_collapsed[:, trial]
+        set_tally_damage(tally, tally_pos, casualty_rank, np.where(collapsed, DS_COLLAPSED, DS_NO),
+                         np.where(collapsed, residents, 0))
+
+        if road_nodes is not None:
+            state['road_alive'] = road_network.alive_edges(edge_collapsed[:, trial], preserve_edge_directions)
+            state['access'] = road_network.reachability(state['road_alive'], preserve_edge_directions)\
+                .reachable(sources, targets)
+            set_tally_access(tally, tally_household, state['access'][:len(df_household)],
+                             state['access'][len(df_household):])
+
+        if power_nodes is not None:
+            damaged = np.zeros(power_network.n_nodes, dtype=bool)
+            damaged[power_node_pos[node_collapsed[:, trial]]] = True
+            alive = power_network.edges_between(damaged)
+            operating = power_network.reachable_from_any(alive, power_plants[~damaged[power_plants]],
+                                                         preserve_edge_directions)
+            building_has_power = gather(operating.astype(np.float64), building_power_node)
+            household_has_power = gather(building_has_power, household_building)
+            hospital_has_power = gather(building_has_power, household_hospital)
+            tally['has_power'] = gather(household_has_power, tally_household)
+            tally['hospital_has_power'] = gather(hospital_has_power, tally_household)
+            tally['has_power_facility'] = gather(building_has_power, tally_pos['ds_facility'])
+            state.update({'power_damaged': damaged, 'power_operating': operating,
+                          'building_has_power': building_has_power, 'household_has_power': household_has_power,
+                          'hospital_has_power': hospital_has_power})
+        return state
+
+    rows = []
+    for trial in range(n_trials):
+        evaluate(trial)
+        metrics = generate_metrics(tally, tally, 'landslide', population_displacement_consensus)
+        rows.append({'trial': trial + 1, **{m: v['value'] for m, v in metrics.items()}})
+        if aggregator is not None:
+            aggregator.add({m: v['value'] for m, v in metrics.items()},
+                           zone_metrics=tally.groupby('zoneid')[['casualty']].sum())
+
+    trials = pd.DataFrame(rows)
+    if not representative:
+        return trials
+
+    metric_values = trials.drop(columns='trial')
+    scale = metric_values.std(ddof=0).replace(0, 1)
+    trial = int(((metric_values - metric_values.mean()).abs() / scale).sum(axis=1).idxmin())
+    state = evaluate(trial)
+    collapsed = building_collapsed[:, trial]
+    realization = {'trial': trial + 1,
+                   'building': pd.DataFrame({'bldid': building_index, 'ds': np.where(collapsed, DS_COLLAPSED, DS_NO),
+                                             'casualty': np.where(collapsed, residents, 0)}),
+                   'household': pd.DataFrame({'hhid': df_household['hhid'].to_numpy()}),
+                   'individual': pd.DataFrame({'individ': df_individual['individ'].to_numpy()})}
+    if road_nodes is not None:
+        collapsed = edge_collapsed[:, trial]
+        realization['road edges'] = pd.DataFrame({'edge_id': gdf_edges['edge_id'].to_numpy(),
+                                                  'ds': np.where(collapsed, DS_COLLAPSED, DS_NO),
+                                                  'is_damaged': collapsed})
+        # Buildings whose node can reach any hospital node, as in compute_road_infra()
+        hospital_nodes = np.unique(building_road_node[(occupancy == 'Hea') & (building_road_node > -1)])
+        reaches_hospital = road_network.reachable_from_any(state['road_alive'], hospital_nodes,
+                                                           preserve_edge_directions, reverse=True)
+        realization['building']['node_id'] = building_road_node_id.to_numpy()
+        realization['building']['hospital_access'] = gather(reaches_hospital, building_road_node, False).astype(bool)
+        realization['household']['node_id'] = gather(building_road_node_id.to_numpy(), household_building)
+        realization['household']['hospital_access'] = state['access'][:len(df_household)]
+        realization['individual']['facility_access'] = state['access'][len(df_household):]
+    if power_nodes is not None:
+        realization['power nodes'] = pd.DataFrame({'node_id': gdf_power_nodes['node_id'].to_numpy(),
+                                                   'ds': np.where(node_collapsed[:, trial], DS_COLLAPSED, DS_NO),
+                                                   'is_damaged': state['power_damaged'][power_node_pos],
+                                                   'is_operational': state['power_operating'][power_node_pos]})
+        realization['building']['has_power'] = state['building_has_power']
+        realization['household']['has_power'] = state['household_has_power']
+        realization['household']['hospital_has_power'] = state['hospital_has_power']
+    return trials, realization
+
 def calculate_metrics(gdf_buildings, df_household, df_individual, infra, hazard_type, population_displacement_consensus, policies=[],capacity=1.0):
     # Very handy temporary attributes showin if an individual is associated with a facility 
     # and lost access to facility
@@ -2,6 +2,10 @@ import pandas as pd
 import geopandas as gpd
 import xml
 import numpy as np
+import threading
+import hashlib
+import shapely
+from collections import OrderedDict
 
 def inject_columns(df, extra_cols):
     if  isinstance(df, gpd.GeoDataFrame) or isinstance(df, pd.DataFrame):
@@ -9,11 +13,514 @@ def inject_columns(df, extra_cols):
             df[col] = val
     return df
 
+def split_taxonomy(expstr, components):
+    # Split '+'-joined taxonomy strings into named component columns. The last
+    # len(components)-1 parts are the trailing components and whatever is left
+    # belongs to the first one (material may itself contain '+').
+    # Each distinct string is split only once.
+    expstr = pd.Series(expstr).astype(str)
+    codes, uniques = pd.factorize(expstr)
+    parts = pd.Series(uniques).str.rsplit('+', n=len(components)-1, expand=True)
+    parts = parts.reindex(columns=range(len(components)))
+    parts.columns = components
+    parts = parts.iloc[codes].reset_index(drop=True)
+    parts.index = expstr.index
+    return parts
+
+TAXONOMY_COMPONENTS = ['material','code_level','storeys','occupancy']
+
+def storeys_to_height(storeys):
+    # Number of storeys from '<n>s' strings, parsed once per distinct value
+    codes, uniques = pd.factorize(pd.Series(storeys).astype(object))
+    heights = pd.Series(uniques, dtype=object).astype(str).str.extract(r'([0-9]+)s', expand=False)
+    heights = np.append(pd.to_numeric(heights).to_numpy(dtype=float), np.nan)[codes]
+    if np.isnan(heights).any():
+        return heights
+    return heights.astype(np.int64)
+
+def height_to_storeys(height):
+    # Inverse of storeys_to_height, formatted once per distinct height
+    codes, uniques = pd.factorize(pd.Series(height))
+    return np.array([f'{h}s' for h in uniques], dtype=object)[codes]
+
+def parse_taxonomy(expstr):
+    # Taxonomy components of expstr ('material+code_level+storeys+occupancy')
+    # as categoricals, plus height as the integer number of storeys. Each
+    # distinct string is split once and the results are mapped back by code.
+    expstr = pd.Series(expstr)
+    codes, uniques = pd.factorize(expstr.astype(str))
+    parts = split_taxonomy(pd.Series(uniques, dtype=object), TAXONOMY_COMPONENTS)
+    taxonomy = pd.DataFrame(index=expstr.index)
+    for component in TAXONOMY_COMPONENTS:
+        categories = pd.Categorical(parts[component])
+        taxonomy[component] = pd.Categorical.from_codes(categories.codes[codes], categories=categories.categories)
+    taxonomy['height'] = storeys_to_height(parts['storeys'])[codes]
+    return taxonomy
+
+class TaxonomyDictionary:
+    '''Interns taxonomy components (material, code_level, storeys, ...) as integer codes
+
+    Each component has its own append-only vocabulary, so a code never changes
+    once assigned. Components are packed into a composite integer key with
+    KEY_BITS bits per component, which makes fragility/vulnerability lookups
+    an integer searchsorted instead of string concatenation and hash merges.
+    '''
+    KEY_BITS = 15
+    MAX_COMPONENTS = 4
+
+    def __init__(self):
+        self.vocabulary = dict()
+        self.lock = threading.Lock()
+
+    def intern(self, component, values):
+        values = pd.Index(pd.unique(np.asarray(values, dtype=object)))
+        with self.lock:
+            known = self.vocabulary.get(component, pd.Index([], dtype=object))
+            new_values = values[known.get_indexer(values) < 0]
+            if len(new_values) > 0:
+                known = known.append(new_values)
+                if len(known) >= 2 ** self.KEY_BITS:
+                    raise ValueError(f'Too many distinct values for taxonomy component {component}')
+                self.vocabulary[component] = known
+        return known.get_indexer(values), values
+
+    def codes(self, component, values):
+        # Categoricals are interned through their (small) categories and
+        # mapped back by category code; anything else is factorized first.
+        if isinstance(values, pd.Series) and isinstance(values.dtype, pd.CategoricalDtype):
+            local_codes = values.cat.codes.to_numpy()
+            uniques = values.cat.categories.astype(str)
+        else:
+            local_codes, uniques = pd.factorize(pd.Series(values), use_na_sentinel=True)
+            uniques = pd.Index(uniques).astype(str)
+        if len(uniques) == 0:
+            return np.full(len(local_codes), -1, dtype=np.int64)
+        unique_codes, _ = self.intern(component, uniques)
+        return np.where(local_codes >= 0, unique_codes[local_codes], -1).astype(np.int64)
+
+    def composite_key(self, components):
+        # components: list of (component name, values) pairs, all of the same length.
+        # Rows with a missing component get key -1.
+        if len(components) > self.MAX_COMPONENTS:
+            raise ValueError(f'At most {self.MAX_COMPONENTS} taxonomy components can be combined')
+        key = None
+        missing = None
+        for component, values in components:
+            c = self.codes(component, values)
+            key = c if key is None else (key << self.KEY_BITS) | np.maximum(c, 0)
+            missing = (c < 0) if missing is None else (missing | (c < 0))
+        key[missing] = -1
+        return key
+
+    def composite_key_from_strings(self, expstr, components, extra_components=[]):
+        # Composite key of '+'-joined taxonomy strings such as fragility expstr,
+        # optionally followed by extra (name, values) components
+        parts = split_taxonomy(expstr, components)
+        return self.composite_key([(c, parts[c]) for c in components] + list(extra_components))
+
+    def lookup(self, table_keys, keys):
+        # Row position in the table for every key, -1 if not found.
+        # For duplicate keys in the table the first record wins.
+        table_keys = np.asarray(table_keys, dtype=np.int64)
+        keys = np.asarray(keys, dtype=np.int64)
+        order = np.argsort(table_keys, kind='stable')
+        sorted_keys = table_keys[order]
+        if len(sorted_keys) == 0:
+            return np.full(len(keys), -1, dtype=np.int64)
+        pos = np.clip(np.searchsorted(sorted_keys, keys, side='left'), 0, len(sorted_keys) - 1)
+        found = (sorted_keys[pos] == keys) & (keys >= 0)
+        return np.where(found, order[pos], -1)
+
+taxonomy_dictionary = TaxonomyDictionary()
+
+def taxonomy_join(df, table, positions):
+    # Left-join table rows onto df by precomputed row positions (-1 means no
+    # match). Columns already present in df are kept from df.
+    cols = [c for c in table.columns if c not in df.columns]
+    matched = table[cols].reset_index(drop=True).reindex(positions)
+    matched.index = df.index
+    return pd.concat([df, matched], axis=1)
+
+def geometry_fingerprint(gdf):
+    # Content hash of a layer's geometries and CRS. Attribute columns are not
+    # part of it, so layers whose damage or policy columns change between runs
+    # keep the same fingerprint. The app computes it once when a layer is
+    # imported or replaced and passes it to the engines (see fingerprints in
+    # compute()); layers given without one are hashed on every call.
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str(gdf.crs).encode())
+    h.update(np.int64(len(gdf)).tobytes())
+    geometries = np.asarray(gdf.geometry.values)
+    if len(geometries) > 0 and (shapely.get_type_id(geometries) == 0).all() and not shapely.is_empty(geometries).any():
+        # Point layers hash their coordinate array, much cheaper than WKB
+        h.update(b'points')
+        h.update(shapely.get_coordinates(geometries, include_z=True).tobytes())
+    else:
+        h.update(b''.join(shapely.to_wkb(geometries)))
+    return h.hexdigest()
+
+def projected_fingerprint(fingerprint, epsg):
+    # Fingerprint of the output of project_layer(), from that of its input
+    if fingerprint is None:
+        return None
+    return hashlib.blake2b(f'{fingerprint} projected to {epsg}'.encode(), digest_size=16).hexdigest()
+
+def network_fingerprint(node_ids, from_nodes, to_nodes):
+    # Content hash of a network's topology: its node ids and the endpoints
+    # of its edges, in order. Geometries and damage columns are not part of it.
+    h = hashlib.blake2b(digest_size=16)
+    for values in [node_ids, from_nodes, to_nodes]:
+        values = pd.Series(np.asarray(values))
+        h.update(np.int64(len(values)).tobytes())
+        h.update(pd.util.hash_pandas_object(values, index=False).to_numpy().tobytes())
+    return h.hexdigest()
+
+class SpatialJoinCache:
+    '''Size-bounded LRU cache of nearest-neighbour matches
+
+    Entries are keyed by the fingerprints of the participating layers and
+    hold the matched row positions and distances, not the joined frames,
+    so they can be combined with the current attributes of the layers.
+    The same structure caches projected geometries (see project_layer)
+    and compiled network topologies (see engine.network_topology).
+    Least recently used entries are evicted once max_bytes is exceeded.
+    '''
+    def __init__(self, max_bytes=256 * 2**20):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.sizes = dict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, arrays, nbytes=None):
+        # nbytes overrides the size of entries whose arrays hold references
+        size = sum(a.nbytes for a in arrays) if nbytes is None else nbytes
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.nbytes -= self.sizes.pop(key)
+                del self.entries[key]
+            self.entries[key] = arrays
+            self.sizes[key] = size
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                evicted, _ = self.entries.popitem(last=False)
+                self.nbytes -= self.sizes.pop(evicted)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.sizes.clear()
+            self.nbytes = 0
+
+spatial_join_cache = SpatialJoinCache()
+
+projected_geometry_cache = SpatialJoinCache()
+
+network_topology_cache = SpatialJoinCache()
+
+def project_layer(gdf, epsg=3857, fingerprint=None, cache=projected_geometry_cache):
+    # Same as gdf.set_crs("EPSG:4326", allow_override=True).to_crs(f"EPSG:{epsg}").
+    # The projected geometries are cached by geometry fingerprint, so a layer
+    # is reprojected once for as long as its geometries do not change,
+    # whatever happens to its attribute columns between runs. fingerprint is
+    # the geometry_fingerprint() of gdf if known; the projected layer has
+    # projected_fingerprint(fingerprint, epsg).
+    source = geometry_fingerprint(gdf) if fingerprint is None else fingerprint
+    key = ('projection', source, epsg)
+    gdf = gdf.set_crs("EPSG:4326", allow_override=True)
+    cached = cache.get(key)
+    if cached is None:
+        projected = gdf.to_crs(f"EPSG:{epsg}")
+        geometries = projected.geometry.values
+        nbytes = geometries.nbytes + 24 * int(shapely.get_num_coordinates(np.asarray(geometries)).sum())
+        cache.put(key, (geometries.copy(),), nbytes=nbytes)
+    else:
+        # shapely geometries are immutable, copying the array is enough
+        projected = gdf.set_geometry(cached[0].copy())
+    return projected
+
+def known_fingerprints(layers, fingerprints):
+    # The given fingerprints, hashing the layers whose fingerprint is None
+    return tuple(geometry_fingerprint(gdf) if f is None else f for gdf, f in zip(layers, fingerprints))
+
+def nearest_positions(left, right):
+    # Row positions of the nearest right geometry for every left row, ties
+    # included, in the order used by gpd.sjoin_nearest. Left rows without a
+    # match get right position -1 and distance NaN.
+    if len(right) == 0:
+        return np.arange(len(left)), np.full(len(left), -1), np.full(len(left), np.nan)
+    (left_pos, right_pos), distances = right.sindex.nearest(left.geometry, return_all=True, return_distance=True)
+    unmatched = np.setdiff1d(np.arange(len(left)), left_pos)
+    if len(unmatched) > 0:
+        order = np.argsort(np.concatenate([left_pos, unmatched]), kind='stable')
+        left_pos = np.concatenate([left_pos, unmatched])[order]
+        right_pos = np.concatenate([right_pos, np.full(len(unmatched), -1)])[order]
+        distances = np.concatenate([distances, np.full(len(unmatched), np.nan)])[order]
+    return left_pos, right_pos, distances
+
+def cached_sjoin_nearest(left, right, how='left', rsuffix='right', distance_col=None, fingerprints=(None, None),
+                         cache=spatial_join_cache):
+    # Drop-in replacement for gpd.sjoin_nearest(left, right, how='left', ...)
+    # that reuses the matches of earlier calls on the same geometries.
+    # fingerprints are the geometry fingerprints of left and right if known.
+    if how != 'left':
+        return gpd.sjoin_nearest(left, right, how=how, rsuffix=rsuffix, distance_col=distance_col)
+
+    key = ('nearest',) + known_fingerprints([left, right], fingerprints)
+    matches = cache.get(key)
+    if matches is None:
+        matches = nearest_positions(left, right)
+        cache.put(key, matches)
+    left_pos, right_pos, distances = matches
+
+    index_right = f'index_{rsuffix}'
+    right_df = right.drop(columns=right.geometry.name)
+    right_df.index = right_df.index.rename(index_right)
+    right_df = right_df.reset_index().reindex(right_pos)
+
+    left_df = left.iloc[left_pos]
+    overlap = set(left_df.columns) & set(right_df.columns)
+    left_df = left_df.rename(columns={c: f'{c}_left' for c in overlap})
+    right_df = right_df.rename(columns={c: f'{c}_{rsuffix}' for c in overlap})
+    right_df.index = left_df.index
+
+    joined = pd.concat([left_df, right_df], axis=1)
+    if distance_col is not None:
+        joined[distance_col] = distances
+    return joined
+
+class RasterIntensity:
+    '''Gridded intensity measure kept as band arrays and an affine transform
+
+    Instead of expanding every pixel into a point and running a
+    nearest-neighbour join, engines sample the bands at building centroids,
+    road edge centroids and power nodes by inverse-transforming coordinates
+    to pixel row/col. transform holds the first six affine coefficients
+    (a, b, c, d, e, f) so that x = a*col + b*row + c, y = d*col + e*row + f.
+    resampling is 'nearest' or 'bilinear'. Locations outside the raster
+    read as zero.
+    '''
+    def __init__(self, bands, band_names, transform, crs='EPSG:4326', resampling='nearest'):
+        bands = np.asarray(bands)
+        self.bands = bands[np.newaxis] if bands.ndim == 2 else bands
+        self.band_names = list(band_names)
+        self.transform = tuple(float(t) for t in tuple(transform)[:6])
+        self.crs = crs
+        self.resampling = resampling
+
+    def rename(self, columns):
+        # Same as DataFrame.rename(columns=...) on the band names
+        return RasterIntensity(self.bands, [columns.get(n, n) for n in self.band_names],
+                               self.transform, self.crs, self.resampling)
+
+    def nonzero_pixels(self, band):
+        # Map coordinates of the centers of the pixels where the band is
+        # nonzero, with the band values
+        values = self.bands[self.band_names.index(band)]
+        row, col = np.nonzero(values)
+        a, b, c, d, e, f = self.transform
+        return a * (col + 0.5) + b * (row + 0.5) + c, d * (col + 0.5) + e * (row + 0.5) + f, values[row, col]
+
+    def pixel_coordinates(self, x, y):
+        # Continuous (row, col) of map coordinates; pixel (i, j) covers [i, i+1) x [j, j+1)
+        a, b, c, d, e, f = self.transform
+        det = a * e - b * d
+        dx, dy = np.asarray(x) - c, np.asarray(y) - f
+        return (a * dy - d * dx) / det, (e * dx - b * dy) / det
+
+    def sample(self, x, y):
+        # Band values (bands x points), inside-raster mask and flat pixel index
+        row, col = self.pixel_coordinates(x, y)
+        _, height, width = self.bands.shape
+        inside = (row >= 0) & (row < height) & (col >= 0) & (col < width)
+        r = np.clip(np.floor(row), 0, height - 1).astype(np.int64)
+        c = np.clip(np.floor(col), 0, width - 1).astype(np.int64)
+        if self.resampling == 'bilinear':
+            # interpolate between the four surrounding pixel centers, clamped at the edges
+            rf, cf = row - 0.5, col - 0.5
+            r0, c0 = np.floor(rf), np.floor(cf)
+            wr, wc = rf - r0, cf - c0
+            r0 = r0.astype(np.int64)
+            c0 = c0.astype(np.int64)
+            r0c, r1c = np.clip(r0, 0, height - 1), np.clip(r0 + 1, 0, height - 1)
+            c0c, c1c = np.clip(c0, 0, width - 1), np.clip(c0 + 1, 0, width - 1)
+            values = self.bands[:, r0c, c0c] * (1 - wr) * (1 - wc) + self.bands[:, r0c, c1c] * (1 - wr) * wc + \
+                     self.bands[:, r1c, c0c] * wr * (1 - wc) + self.bands[:, r1c, c1c] * wr * wc
+        else:
+            values = self.bands[:, r, c].astype(np.float64)
+        values[:, ~inside] = 0
+        return values, inside, np.where(inside, r * width + c, -1)
+
+def sample_raster_intensity(left, raster, rsuffix='right', distance_col=None):
+    # Raster counterpart of sjoin_nearest(left, intensity, how='left', ...):
+    # one row per left row, with the pixel index as index_<rsuffix>, the band
+    # values, and distance 0 inside the raster and NaN outside it.
+    points = gpd.GeoSeries(left.geometry.centroid, crs=left.crs).to_crs(raster.crs)
+    values, inside, pixel = raster.sample(points.x.to_numpy(), points.y.to_numpy())
+
+    right_df = pd.DataFrame({f'index_{rsuffix}': pixel}, index=left.index)
+    for name, band in zip(raster.band_names, values):
+        right_df[name] = band
+    overlap = set(left.columns) & set(right_df.columns)
+    left_df = left.rename(columns={c: f'{c}_left' for c in overlap})
+    right_df = right_df.rename(columns={c: f'{c}_{rsuffix}' for c in overlap})
+
+    joined = pd.concat([left_df, right_df], axis=1)
+    if distance_col is not None:
+        joined[distance_col] = np.where(inside, 0.0, np.nan)
+    return joined
+
+def join_intensity(left, intensity, rsuffix='intensity', distance_col=None, fingerprints=(None, None)):
+    # Attach intensity measures to every row of left, from either a point
+    # layer (nearest point) or a RasterIntensity (pixel lookup)
+    if isinstance(intensity, RasterIntensity):
+        return sample_raster_intensity(left, intensity, rsuffix=rsuffix, distance_col=distance_col)
+    return cached_sjoin_nearest(left, intensity, how='left', rsuffix=rsuffix, distance_col=distance_col,
+                                fingerprints=fingerprints)
+
+def edge_sample_positions(edges, intensity, distance, fingerprints=(None, None), cache=spatial_join_cache):
+    # (edge, intensity point) row position pairs of every point within
+    # distance of an edge: one bulk STRtree query, cached by geometry
+    key = ('dwithin',) + known_fingerprints([edges, intensity], fingerprints) + (float(distance),)
+    pairs = cache.get(key)
+    if pairs is None:
+        tree = shapely.STRtree(np.asarray(intensity.geometry.values))
+        pairs = tuple(tree.query(np.asarray(edges.geometry.values), predicate='dwithin', distance=distance))
+        cache.put(key, pairs)
+    return pairs
+
+def raster_line_samples(edges, raster):
+    # Points every half pixel along every edge, in the raster CRS.
+    # Returns the edge position of every point with its band values and
+    # inside-raster mask.
+    lines = np.asarray(gpd.GeoSeries(edges.geometry.values, crs=edges.crs).to_crs(raster.crs).values)
+    a, b, _, d, e, _ = raster.transform
+    step = 0.5 * min(np.hypot(a, d), np.hypot(b, e))
+    n_points = np.ceil(np.nan_to_num(shapely.length(lines)) / step).astype(np.int64) + 1
+    edge_pos = np.repeat(np.arange(len(lines)), n_points)
+    starts = np.repeat(np.cumsum(n_points) - n_points, n_points)
+    fractions = (np.arange(len(edge_pos)) - starts) / np.maximum(np.repeat(n_points, n_points) - 1, 1)
+    points = shapely.line_interpolate_point(lines[edge_pos], fractions, normalized=True)
+    coordinates = shapely.get_coordinates(points)
+    values, inside, _ = raster.sample(coordinates[:, 0], coordinates[:, 1])
+    return edge_pos, values, inside
+
+def aggregate_edge_samples(n_edges, edge_pos, values):
+    # Per-edge max, mean and count of the sampled values; NaN samples are
+    # ignored and edges without samples get max and mean 0
+    valid = ~np.isnan(values)
+    edge_pos, values = edge_pos[valid], values[valid]
+    count = np.bincount(edge_pos, minlength=n_edges)
+    mean = np.bincount(edge_pos, weights=values, minlength=n_edges) / np.maximum(count, 1)
+    maximum = np.zeros(n_edges)
+    order = np.lexsort((values, edge_pos))
+    edge_pos, values = edge_pos[order], values[order]
+    last = np.flatnonzero(np.append(edge_pos[1:] != edge_pos[:-1], True)) if len(edge_pos) > 0 else []
+    maximum[edge_pos[last]] = values[last]
+    return maximum, mean, count
+
+def sample_edge_intensity(edges, intensity, distance, column='im', fingerprints=(None, None)):
+    # Intensity along every edge instead of at the single nearest point:
+    # the max, mean and count of the intensity points within distance of
+    # the edge, or of the raster pixels crossed by the edge. Returns a frame
+    # with columns <column>, <column>_mean and <column>_count aligned with
+    # edges, where <column> holds the max.
+    if isinstance(intensity, RasterIntensity):
+        edge_pos, values, inside = raster_line_samples(edges, intensity)
+        values = np.where(inside, values[intensity.band_names.index(column)], np.nan)
+    else:
+        edge_pos, point_pos = edge_sample_positions(edges, intensity, distance, fingerprints)
+        values = intensity[column].to_numpy(dtype=np.float64)[point_pos]
+    maximum, mean, count = aggregate_edge_samples(len(edges), edge_pos, values)
+    return pd.DataFrame({column: maximum, f'{column}_mean': mean, f'{column}_count': count}, index=edges.index)
+
+# Compact engine mode: dtypes applied to exposure layers when they are loaded.
+# Probabilities and intensities become float32, ids int32, damage states and
+# small codes int8, and the taxonomy strings below categoricals. The engines
+# keep the dtypes of their input layers, see restore_dtypes().
+COMPACT_INT8_COLUMNS = ['ds','ds_facility','ds_hospital','eq_ds','fl_ds','gender','head','eduattstat','age',
+                        'specialfac','is_damaged','is_operational']
+COMPACT_CATEGORY_COLUMNS = ['expstr','material','code_level','storeys','occupancy','height_level',
+                            'freqincome','income','avgincome','luf','lrstype','susceptibility']
+
+def is_compact_float_column(col):
+    return col in ['im','pga','fl_prob','collapse_probability'] or \
+        col.startswith('prob_') or col.startswith('sa ')
+
+def compact_dtypes(df):
+    # Downcast the columns of a layer in place of 64-bit and object dtypes.
+    # Integer columns only shrink as far as their values allow.
+    for col in df.columns:
+        if col == 'geometry' or not isinstance(col, str):
+            continue
+        values = df[col]
+        dtype = values.dtype
+        if isinstance(dtype, pd.CategoricalDtype) or pd.api.types.is_bool_dtype(dtype):
+            continue
+        if pd.api.types.is_integer_dtype(dtype):
+            lowest = 'int8' if col in COMPACT_INT8_COLUMNS else 'int32'
+            if len(values) == 0:
+                df[col] = values.astype(lowest)
+                continue
+            for candidate in ['int8','int16','int32']:
+                if np.dtype(candidate).itemsize < np.dtype(lowest).itemsize:
+                    continue
+                info = np.iinfo(candidate)
+                if values.min() >= info.min and values.max() <= info.max:
+                    df[col] = values.astype(candidate)
+                    break
+        elif pd.api.types.is_float_dtype(dtype):
+            # float damage states come from merges with missing rows
+            if is_compact_float_column(col) or col in COMPACT_INT8_COLUMNS:
+                df[col] = values.astype(np.float32)
+        elif dtype == object:
+            non_null = values.dropna()
+            if len(non_null) > 0 and non_null.map(type).isin([bool, np.bool_]).all():
+                if len(non_null) == len(values):
+                    df[col] = values.astype(bool)
+            elif col in COMPACT_CATEGORY_COLUMNS:
+                df[col] = values.astype('category')
+    return df
+
+def restore_dtypes(df, dtypes):
+    # Columns widened by merges or recomputation back to the narrower dtypes
+    # they had in the input layers (dtypes maps column to dtype). Integer
+    # columns with missing values from left merges become float32 instead.
+    # 64-bit and other dtypes are left as they are, so layers that are not
+    # compact are unaffected.
+    for col, dtype in dtypes.items():
+        if col not in df.columns or df[col].dtype == dtype:
+            continue
+        if not (pd.api.types.is_integer_dtype(dtype) or pd.api.types.is_float_dtype(dtype)) or \
+                np.dtype(dtype).itemsize >= 8 or not pd.api.types.is_numeric_dtype(df[col].dtype) or \
+                pd.api.types.is_bool_dtype(df[col].dtype):
+            continue
+        if pd.api.types.is_integer_dtype(dtype) and df[col].isna().any():
+            dtype = np.float32
+        df[col] = df[col].astype(dtype, copy=False)
+    return df
+
 def building_preprocess(df, extra_cols):
-    df['occupancy'] = df['expstr'].apply(lambda x: x.split('+')[-1]).astype('category')
-    df['storeys'] = df['expstr'].apply(lambda x: x.split('+')[-2])
-    df['code_level'] = df['expstr'].apply(lambda x: x.split('+')[-3]).astype('category')
-    df['material'] = df['expstr'].apply(lambda x: "+".join(x.split('+')[:-3])).astype('category')
+    taxonomy = parse_taxonomy(df['expstr'])
+    for col in taxonomy.columns:
+        df[col] = taxonomy[col].values
+
+    # Intern taxonomy components once at import time
+    for component in TAXONOMY_COMPONENTS:
+        taxonomy_dictionary.codes(component, df[component])
 
     df = inject_columns(df, extra_cols)
 
@@ -23,6 +530,165 @@ def identity_preprocess(df, extra_cols):
     df = inject_columns(df, extra_cols)
     return df
 
+class StreamingDistribution:
+    '''Bounded-memory summary of a stream of weighted non-negative values
+
+    Keeps weighted running moments, a histogram of n_bins bins whose width
+    doubles (merging neighbouring bins) whenever a value falls beyond its
+    range, and a quantile sketch of weighted centroids in the manner of a
+    t-digest, compacted after every sketch_size new values. Values with
+    zero weight, such as events with a zero occurrence rate, are ignored.
+    '''
+    def __init__(self, n_bins=128, sketch_size=200):
+        self.n_bins = n_bins
+        self.sketch_size = sketch_size
+        self.count = 0
+        self.total_weight = 0.0
+        self.weighted_sum = 0.0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self.zero_weight = 0.0
+        self.bin_width = None
+        self.bins = np.zeros(n_bins)
+        self.sketch_values = []
+        self.sketch_weights = []
+        self.n_centroids = 0
+
+    def add(self, value, weight=1.0):
+        value = max(float(value), 0.0)
+        weight = float(weight)
+        if weight == 0:
+            return
+        self.count += 1
+        self.total_weight += weight
+        self.weighted_sum += weight * value
+        delta = value - self.mean
+        self.mean += weight / self.total_weight * delta
+        self.m2 += weight * delta * (value - self.mean)
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+        if value == 0:
+            self.zero_weight += weight
+        else:
+            if self.bin_width is None:
+                # the first positive value lands in the middle of the range
+                self.bin_width = 2 * value / self.n_bins
+            while value >= self.bin_width * self.n_bins:
+                merged = self.bins.reshape(-1, 2).sum(axis=1)
+                self.bins = np.concatenate([merged, np.zeros(self.n_bins - len(merged))])
+                self.bin_width *= 2
+            self.bins[min(int(value // self.bin_width), self.n_bins - 1)] += weight
+
+        self.sketch_values.append(value)
+        self.sketch_weights.append(weight)
+        if len(self.sketch_values) >= self.n_centroids + self.sketch_size:
+            self.compact()
+
+    def compact(self):
+        # Merge neighbouring centroids while the merged weight stays below a
+        # bound that shrinks towards both tails, so extreme quantiles keep
+        # their resolution
+        order = np.argsort(self.sketch_values, kind='stable')
+        values = np.asarray(self.sketch_values)[order]
+        weights = np.asarray(self.sketch_weights)[order]
+        total = weights.sum()
+        merged_values, merged_weights = [values[0]], [weights[0]]
+        cumulative = 0.0
+        for v, w in zip(values[1:], weights[1:]):
+            q = (cumulative + merged_weights[-1] + w / 2) / total
+            if merged_weights[-1] + w <= 4 * total * q * (1 - q) / self.sketch_size:
+                merged_values[-1] += (v - merged_values[-1]) * w / (merged_weights[-1] + w)
+                merged_weights[-1] += w
+            else:
+                cumulative += merged_weights[-1]
+                merged_values.append(v)
+                merged_weights.append(w)
+        self.sketch_values = merged_values
+        self.sketch_weights = merged_weights
+        self.n_centroids = len(merged_values)
+
+    def quantile(self, q):
+        if self.count == 0:
+            return np.full(np.shape(q), np.nan) if np.ndim(q) > 0 else np.nan
+        order = np.argsort(self.sketch_values, kind='stable')
+        values = np.asarray(self.sketch_values)[order]
+        weights = np.asarray(self.sketch_weights)[order]
+        # centroids sit at the middle of their cumulative weight
+        middle = np.cumsum(weights) - weights / 2
+        return np.interp(np.asarray(q) * weights.sum(), np.concatenate(([0], middle, [weights.sum()])),
+                         np.concatenate(([self.min], values, [self.max])))
+
+    def std(self):
+        return np.sqrt(self.m2 / self.total_weight) if self.total_weight > 0 else np.nan
+
+    def exceedance(self):
+        # Lower bin edges and the total weight of values at or above each
+        # edge; the first point is the weight of values above zero.
+        if self.bin_width is None:
+            return np.array([0.0]), np.array([0.0])
+        edges = np.arange(self.n_bins) * self.bin_width
+        weight_above = np.cumsum(self.bins[::-1])[::-1]
+        used = max(1, np.nonzero(self.bins)[0].max() + 1)
+        return edges[:used], weight_above[:used]
+
+class LossAggregator:
+    '''Streaming exceedance curves and average annual figures of metrics
+
+    Fed one event or Monte Carlo trial at a time with a dict of metric values
+    and, optionally, a frame of per-zone values (index zone, one column per
+    metric). Every (metric, zone) pair is summarized by a
+    StreamingDistribution, so memory does not grow with the number of
+    events. Monte Carlo trials are one year each: the average annual value
+    is the mean and exceedance curves are probabilities. Events of an event
+    set are added with their annual occurrence rate: the average annual
+    value is the rate-weighted sum and exceedance curves are annual
+    frequencies.
+    '''
+    def __init__(self, n_bins=128, sketch_size=200):
+        self.n_bins = n_bins
+        self.sketch_size = sketch_size
+        self.distributions = OrderedDict()
+        self.rated = None
+
+    def distribution(self, metric, zone=None):
+        key = (metric, zone)
+        if key not in self.distributions:
+            self.distributions[key] = StreamingDistribution(self.n_bins, self.sketch_size)
+        return self.distributions[key]
+
+    def add(self, metrics, zone_metrics=None, rate=None):
+        if self.rated is None:
+            self.rated = rate is not None
+        elif self.rated != (rate is not None):
+            raise ValueError('Either all or none of the added events must have an occurrence rate')
+        weight = 1.0 if rate is None else rate
+        for metric, value in metrics.items():
+            self.distribution(metric).add(value, weight)
+        if zone_metrics is not None:
+            for zone, row in zone_metrics.iterrows():
+                for metric, value in row.items():
+                    self.distribution(metric, zone).add(value, weight)
+
+    def average_annual(self, d):
+        return d.weighted_sum if self.rated else d.mean
+
+    def summary(self, quantiles=[0.5, 0.9, 0.99]):
+        rows = []
+        for (metric, zone), d in self.distributions.items():
+            rows.append({'metric': metric, 'zone': zone, 'count': d.count, 'mean': d.mean, 'std': d.std(),
+                         'min': d.min, 'max': d.max, 'average_annual': self.average_annual(d),
+                         **{f'q{q:g}': v for q, v in zip(quantiles, d.quantile(quantiles))}})
+        return pd.DataFrame(rows)
+
+    def exceedance_curve(self, metric, zone=None):
+        d = self.distributions[(metric, zone)]
+        values, weight_above = d.exceedance()
+        exceedance = weight_above if self.rated else weight_above / d.total_weight
+        return pd.DataFrame({'value': values, 'exceedance': exceedance})
+
 class ParameterFile:
     def __init__(self, content: bytes):
         self.df_nc = pd.read_excel(content,sheet_name=1,header=None)
@@ -24,10 +24,13 @@ import datetime
 from . import storage, user, session_storage, store_in_session_storage, read_from_session_storage
 from .settings import landslide_max_trials
 from .settings import threshold_flood, threshold_flood_distance, threshold_road_water_height, threshold_culvert_water_height, preserve_edge_directions,\
-                      population_displacement_consensus
+                      population_displacement_consensus, compact_engine_mode, compute_partitions,\
+                      progressive_analysis, progressive_sample_fraction, hospital_travel_distance
 from ..backend.engine import compute, compute_power_infra, compute_road_infra, calculate_metrics, generate_exposure, \
-    create_tally, generate_metrics
-from ..backend.utils import building_preprocess, identity_preprocess, ParameterFile, read_gem_xml, read_gem_xml_fragility, read_gem_xml_vulnerability, getText
+    create_tally, generate_metrics, stratified_building_sample, estimate_metrics, compute_hospital_distance, \
+    landslide_monte_carlo, compute_flood_sensitivity, compute_road_sensitivity, threshold_metrics
+from ..backend.utils import building_preprocess, identity_preprocess, ParameterFile, read_gem_xml, read_gem_xml_fragility, read_gem_xml_vulnerability, getText, \
+    RasterIntensity, compact_dtypes, geometry_fingerprint, restore_dtypes
 from .utilities import S3FileBrowser, extension_list, extension_list_w_dots, PowerFragilityDisplayer, FragilityFunctionDisplayer, \
                         convert_data_for_filter_view, lbl_2_str
 from ..components.file_drop import FileDropMultiple
@@ -38,11 +41,19 @@ import tempfile
 
 tally_counter = solara.reactive(0)
 tally_filter = solara.reactive(None)
+# Metrics estimated on a building sample, shown until the full analysis finishes
+metric_estimates = solara.reactive(None)
+metric_trials = solara.reactive(None)
+# Building damage, and road edge water heights and connectivity, of the last
+# flood run, and the metrics at flood thresholds chosen after that run
+flood_sensitivity = solara.reactive(None)
+road_sensitivity = solara.reactive(None)
+metric_thresholds = solara.reactive(None)
 building_filter = solara.reactive(None)
 landuse_filter = solara.reactive(None)
 center_default = (41.01,28.98)
 def create_new_app_state():
-    return solara.reactive({
+    state = {
     'infra': solara.reactive(["building"]),
     'hazard': solara.reactive("flood"),
     'hazard_list': ["earthquake","flood"],
@@ -280,10 +291,29 @@ def create_new_app_state():
         "metric5": {"desc": "Number of households displaced", "value": 0, "max_value": 100},
         "metric6": {"desc": "Number of homeless individuals", "value": 0, "max_value": 100},
         "metric7": {"desc": "Population displacement", "value": 0, "max_value":100},
-        "metric8": {"desc": "Number of casualties", "value": 0, "max_value":100},}})
+        "metric8": {"desc": "Number of casualties", "value": 0, "max_value":100},}}
+    # Geometry fingerprint of every layer, set with its data by set_layer_data()
+    for layer in state['layers'].values():
+        layer['fingerprint'] = solara.reactive(None)
+    return solara.reactive(state)
 
 layers = create_new_app_state()
 
+def data_fingerprint(data):
+    # Geometry fingerprint of layer data, None for layers without geometries
+    return geometry_fingerprint(data) if isinstance(data, gpd.GeoDataFrame) else None
+
+def set_layer_data(name, data):
+    # Replaces the data of a layer together with its geometry fingerprint,
+    # which keys the projections and joins cached by the engines. Engine runs
+    # only change attribute columns, so they set the data directly.
+    layers.value['layers'][name]['fingerprint'].set(data_fingerprint(data))
+    layers.value['layers'][name]['data'].set(data)
+
+def layer_fingerprints():
+    # Geometry fingerprints of all layers, passed to the engines
+    return {name: layer['fingerprint'].value for name, layer in layers.value['layers'].items()}
+
 metric_icon1 = 'tomorrowcities/content/icons/metric1.png'
 metric_icon2 = 'tomorrowcities/content/icons/metric2.png'
 metric_icon3 = 'tomorrowcities/content/icons/metric3.png'
@@ -340,11 +370,16 @@ def load_from_state(source_dict):
                 stack.append((path + (key,), value))
             else:
                 keys = list(path + (key,))
+                if key == 'fingerprint':
+                    # not trusted from the saved state, see below
+                    continue
                 src_value = get_nested_value(source_dict, keys)
                 if isinstance(value,solara.toestand.Reactive):
                     assign_nested_value(layers.value, keys, solara.reactive(src_value))
                 else:
                     assign_nested_value(layers.value, keys, src_value)
+    for layer in layers.value['layers'].values():
+        layer['fingerprint'] = solara.reactive(data_fingerprint(layer['data'].value))
 
 def store_info_to_session():
     store_in_session_storage('population_displacement_consensus', population_displacement_consensus.value)
@@ -368,7 +403,7 @@ def reload_info_from_session():
         session_data = read_from_session_storage(layer_name)
         if session_data is not None:
             if layers.value['layers'][layer_name]['data'].value is None:
-                layers.value['layers'][layer_name]['data'].set(session_data['data'])
+                set_layer_data(layer_name, session_data['data'])
             if layers.value['layers'][layer_name]['df'].value is None:
                 layers.value['layers'][layer_name]['df'].set(session_data['df'])
        
@@ -396,6 +431,10 @@ def reset_session():
     building_filter.set(None)
     landuse_filter.set(None)
     tally_counter.set(0)
+    metric_trials.set(None)
+    flood_sensitivity.set(None)
+    road_sensitivity.set(None)
+    metric_thresholds.set(None)
 
 def create_metadata(data):
     m = dict()
@@ -516,15 +555,26 @@ def landuse_colors(feature):
         luf_color = {'color': 'black','fillColor': 'orange'} 
     return luf_color
 
+def intensity_heatmap_locations(data, max_points=500_000):
+    # Sample of at most max_points (lat, lon, normalized im) of the nonzero
+    # intensity, from a point layer or the pixels of a raster
+    if isinstance(data, RasterIntensity):
+        im_col = 'pga' if 'pga' in data.band_names else 'im'
+        x, y, im = data.nonzero_pixels(im_col)
+    else:
+        im_col = 'pga' if 'pga' in data.columns else 'im'
+        df_non_zero = data[data[im_col] > 0]
+        x, y, im = df_non_zero.geometry.x.to_numpy(), df_non_zero.geometry.y.to_numpy(), df_non_zero[im_col].to_numpy()
+    if len(im) > max_points:
+        selected = np.random.choice(len(im), max_points, replace=False)
+        x, y, im = x[selected], y[selected], im[selected]
+    if len(im) > 0:
+        im = im / im.max()
+    return np.array([y, x, im]).transpose().tolist()
+
 def create_map_layer(df, name):
     if name == "intensity":
-        # Take the largest 500_000 values to display
-        im_col = 'pga' if 'pga' in df.columns else 'im'
-        df_non_zero = df[df[im_col] > 0]
-        df_limited = df_non_zero.sample(min(len(df_non_zero),500_000))
-        df_limited[im_col] = df_limited[im_col] / df_limited[im_col].max()
-        #df_limited = df.sort_values(by=im_col,ascending=False).head(500_000)
-        locs = np.array([df_limited.geometry.y.to_list(), df_limited.geometry.x.to_list(), df_limited[im_col].to_list()]).transpose().tolist()
+        locs = intensity_heatmap_locations(df)
         map_layer = ipyleaflet.Heatmap(locations=locs, radius = 5, blur = 1, name = name) 
     elif name == "landuse":
         map_layer = ipyleaflet.GeoJSON(data = json.loads(df.to_json()), name = name,
@@ -590,20 +640,8 @@ def create_map_layer(df, name):
         map_layer.on_click(generic_layer_click_handler)
     return map_layer
 
-def fast_transform_xy(T,x,y):
-    TI = rasterio.transform.IDENTITY.translation(0.5, 0.5)
-    TI_mat = np.array([[TI[0],TI[1],TI[2]],[TI[3],TI[4],TI[5]]])
-    T_mat = np.array([[T[0],T[1],T[2]],[T[3],T[4],T[5]]])
-    n = len(x)
-    first_input = np.ones((3,n))
-    first_input[0,:] = x
-    first_input[1,:] = y
-    first_pass = np.dot(TI_mat, first_input)
-    second_inp = np.concatenate([first_pass[[1]],first_pass[[0]],first_input[[2]]])    
-    second_pass = np.dot(T_mat, second_inp)
-    return second_pass[0], second_pass[1]
-
-def read_tiff(file_bytes):
+def read_tiff_raster(file_bytes, resampling='nearest'):
+    # Intensity raster reprojected to EPSG:4326, kept as band arrays
     byte_io = io.BytesIO(file_bytes)
     with rasterio.open(byte_io) as src:
         if src.nodata == None:
@@ -641,18 +679,7 @@ def read_tiff(file_bytes):
             dst_crs=target_crs,
             resampling=Resampling.nearest)
 
-    lon_pos, lat_pos = np.meshgrid(range(width),range(height))
-    print('start transform ..........')
-    #lon, lat = rasterio.transform.xy(transform,lat_pos.flatten(),lon_pos.flatten())
-    lon, lat = fast_transform_xy(transform,lat_pos.flatten(),lon_pos.flatten())
-    print('start dataframe ..........')
-    gdf = gpd.GeoDataFrame({band_names[i]:ims_transformed[i].flatten() for i in range(n_bands)},
-            geometry = gpd.points_from_xy(lon, lat, crs="EPSG:4326"))
-    #gdf = gdf.rename(columns={0:'im'})
-    # return only the non-zero intensity measures
-    return gdf[(gdf.drop(columns='geometry')>0).any(axis=1)]
-    #return gdf.sort_values(by='im',ascending=False).head(10000)
-
+    return RasterIntensity(ims_transformed, band_names, transform, crs=target_crs, resampling=resampling)
 
 @solara.component
 def ParameterFileWidget(parameter_file: ParameterFile):
@@ -834,13 +861,23 @@ def MetricWidget(name, description, value, max_value, render_count):
         with solara.GridFixed(columns=1):
             solara.FigureEcharts(option=options, attributes={"style": "height:100%; width:100%"})
 
+def preprocess_layer(name, data):
+    # Preprocessing of imported and generated layers. In compact engine mode
+    # the exposure and intensity layers enter the engine with compact dtypes,
+    # which compute() and create_tally() keep.
+    data = layers.value['layers'][name]['pre_processing'](data, layers.value['layers'][name]['extra_cols'])
+    if compact_engine_mode.value and name in ['landuse','building','household','individual','intensity'] \
+            and isinstance(data, pd.DataFrame):
+        data = compact_dtypes(data)
+    return data
+
 def import_data(fileinfo: solara.components.file_drop.FileInfo):
     data_array = fileinfo['data']
     extension = fileinfo['name'].split('.')[-1]
     if extension == 'xlsx':
         data = pd.read_excel(data_array)
     elif extension in ['tiff','tif']:
-        data = read_tiff(data_array)
+        data = read_tiff_raster(data_array)
     elif extension.lower() in ['xml']:
         data = read_gem_xml(data_array)
     else:
@@ -856,6 +893,9 @@ def import_data(fileinfo: solara.components.file_drop.FileInfo):
         data = data.reset_index(drop=True)
         data.columns = data.columns.str.lower()
         attributes = set(data.columns)
+    elif isinstance(data, RasterIntensity):
+        data = data.rename({name: name.lower() for name in data.band_names})
+        attributes = set(data.band_names) | {'geometry'}
     elif isinstance(data, dict):
         attributes = set(data.keys())
     else:
@@ -888,7 +928,7 @@ def import_data(fileinfo: solara.components.file_drop.FileInfo):
                 #raise Exception(f'edge_id column is not unique')
                           
     # Preprocess
-    data = layers.value['layers'][name]['pre_processing'](data, layers.value['layers'][name]['extra_cols'])
+    data = preprocess_layer(name, data)
 
     if name == "parameter":
         data = ParameterFile(content=data_array)
@@ -1086,6 +1126,20 @@ def MetricPanel():
                      tally_filter.value], debug_name="generate_metrics_loca")
     if generate_metrics_local.finished:
         filtered_metrics = generate_metrics_local.value
+    if metric_estimates.value is not None:
+        filtered_metrics = {name: {**metric, 'desc': f"{metric['desc']} (estimate, {metric['lower']}-{metric['upper']})"}
+                            for name, metric in metric_estimates.value.items()}
+    elif metric_thresholds.value is not None:
+        def threshold_desc(metric):
+            desc = f"threshold {metric['threshold_flood']}, {metric['threshold_flood_distance']} m"
+            if 'road_water_height_threshold' in metric:
+                desc += f", roads {metric['road_water_height_threshold']} m, culverts {metric['culvert_water_height_threshold']} m"
+            return f"{metric['desc']} ({desc})"
+        filtered_metrics = {name: {**metric, 'desc': threshold_desc(metric)}
+                            for name, metric in metric_thresholds.value.items()}
+    elif metric_trials.value is not None:
+        filtered_metrics = {name: {**metric, 'desc': f"{metric['desc']} (mean of {metric['n_trials']} trials, {metric['lower']}-{metric['upper']}; map shows trial {metric['trial']})"}
+                            for name, metric in metric_trials.value.items()}
 
 
     metric_icons = [metric_icon1,metric_icon2,metric_icon3,metric_icon4,metric_icon5,metric_icon6,metric_icon7,metric_icon8]
@@ -1133,7 +1187,7 @@ def MapViewer():
         map_layers = []
         for l in layers.value['layers'].keys():
             df = layers.value['layers'][l]['data'].value
-            if df is not None and isinstance(df, gpd.GeoDataFrame):
+            if df is not None and (isinstance(df, gpd.GeoDataFrame) or isinstance(df, RasterIntensity)):
                 df_filtered = df
                 if l == 'building':
                     if building_filter.value is not None:
@@ -1273,14 +1327,15 @@ def ExecutePanel():
                     return False, f"Unsupported GEM fragility format detected: {unsupported_formats}. Only 'discrete' is supported"
 
                 # Check for missing bands
-                sa_list = np.array([float(x.split()[-1]) for x in intensity.columns if x.startswith('sa ')])
-                sa_cols = [x for x in intensity.columns  if x.startswith('sa ') or x == 'pga']
+                intensity_columns = intensity.band_names if isinstance(intensity, RasterIntensity) else intensity.columns
+                sa_list = np.array([float(x.split()[-1]) for x in intensity_columns if x.startswith('sa ')])
+                sa_cols = [x for x in intensity_columns  if x.startswith('sa ') or x == 'pga']
                 imtypes = set([f['imt'].lower().replace('(',' ').replace(')','') for f in gem_fragility['fragilityFunctions']])
                 sa_list_in_fragility = np.array([float(x.split()[-1]) for x in imtypes if x.startswith('sa ')])
                 missing_bands = set(sa_list_in_fragility) - set(sa_list) 
 
                 non_sa_bands_in_fragility = set([x for x in imtypes if not x.startswith('sa ')])
-                non_sa_bands_in_intensity = set([x for x in intensity.columns if not x.startswith('sa ')])
+                non_sa_bands_in_intensity = set([x for x in intensity_columns if not x.startswith('sa ')])
                 missing_bands = missing_bands.union(non_sa_bands_in_fragility - non_sa_bands_in_intensity)
                 if len(missing_bands) > 0:
                     return False, f"{missing_bands} band(s) should be in the intensity map"
@@ -1325,6 +1380,7 @@ def ExecutePanel():
                 cdf_median_increase_in_percent=cdf_median_increase_in_percent,
                 threshold_increase_culvert_water_height=threshold_increase_culvert_water_height,
                 threshold_increase_road_water_height=threshold_increase_road_water_height,
+                fingerprints=layer_fingerprints(),
                 )
             
             edges['ds'] = list(ds)
@@ -1368,6 +1424,7 @@ def ExecutePanel():
                                     hazard, threshold_flood.value, threshold_flood_distance.value,
                                     preserve_edge_directions.value,
                                     earthquake_intensity_unit=earthquake_intensity_unit,
+                                    fingerprints=layer_fingerprints(),
                                     )
             
             #power_node_df =  dfs['Power Nodes'].copy()                         
@@ -1379,9 +1436,14 @@ def ExecutePanel():
             household['hospital_has_power'] = hospital_has_power
             return nodes, buildings, household
 
-        def execute_building():
+        def execute_building(bldids=None, sensitivity=None):
             landuse = layers.value['layers']['landuse']['data'].value
             buildings = layers.value['layers']['building']['data'].value
+            fingerprints = layer_fingerprints()
+            if bldids is not None:
+                buildings = buildings[buildings['bldid'].isin(bldids)].copy()
+                # the sample is hashed by the engine
+                fingerprints.pop('building')
             household = layers.value['layers']['household']['data'].value
             individual = layers.value['layers']['individual']['data'].value
             intensity = layers.value['layers']['intensity']['data'].value
@@ -1421,8 +1483,16 @@ def ExecutePanel():
                     earthquake_intensity_unit=earthquake_intensity_unit,
                     cdf_median_increase_in_percent=cdf_median_increase_in_percent,
                     flood_depth_reduction=flood_depth_reduction,
-                    damage_curve_suppress_factor=damage_curve_suppress_factor
+                    damage_curve_suppress_factor=damage_curve_suppress_factor,
+                    n_partitions=compute_partitions.value,
+                    fingerprints=fingerprints,
                     )
+            elif sensitivity is not None:
+                # Flood damage at the current thresholds from the sensitivity
+                # of this run, which equals compute()
+                df_bld_hazard = sensitivity.damage(threshold_flood.value, threshold_flood_distance.value)
+                df_bld_hazard = restore_dtypes(df_bld_hazard,
+                    buildings.dtypes[[c for c in ['bldid','ds','casualty'] if c in buildings.columns]].to_dict())
             else:
                 if fragility is None:
                     fragility = layers.value['layers']['gem_fragility']['data'].value
@@ -1440,12 +1510,100 @@ def ExecutePanel():
                     cdf_median_increase_in_percent=cdf_median_increase_in_percent,
                     flood_depth_reduction=flood_depth_reduction,
                     damage_curve_suppress_factor=damage_curve_suppress_factor,
+                    n_partitions=compute_partitions.value,
+                    fingerprints=fingerprints,
                     )
-            buildings['ds'] = list(df_bld_hazard['ds'])
-            buildings['casualty'] = list(df_bld_hazard['casualty'])
+            # compute() keeps the dtypes of the building layer
+            buildings['ds'] = df_bld_hazard['ds'].to_numpy()
+            buildings['casualty'] = df_bld_hazard['casualty'].to_numpy()
 
             return buildings
 
+        def execute_hospital_distance():
+            # Runs after the building damage of the current event, which
+            # decides the operational hospitals
+            buildings = layers.value['layers']['building']['data'].value
+            household = layers.value['layers']['household']['data'].value
+            nodes = layers.value['layers']['road nodes']['data'].value
+            edges = layers.value['layers']['road edges']['data'].value
+            hazard = layers.value['hazard'].value
+
+            building_distance, building_distance_increase, household_distance, household_distance_increase = \
+                compute_hospital_distance(buildings, household, nodes, edges, hazard, preserve_edge_directions.value,
+                                          fingerprints=layer_fingerprints())
+            buildings['hospital_distance'] = list(building_distance)
+            buildings['hospital_distance_increase'] = list(building_distance_increase)
+            household['hospital_distance'] = list(household_distance)
+            household['hospital_distance_increase'] = list(household_distance_increase)
+
+            return buildings, household
+
+        def execute_landslide_trials():
+            # Runs all trials at once and writes the trial closest to their
+            # mean into the layers, in place of a separate single realization
+            landuse = layers.value['layers']['landuse']['data'].value
+            buildings = layers.value['layers']['building']['data'].value
+            household = layers.value['layers']['household']['data'].value
+            individual = layers.value['layers']['individual']['data'].value
+            intensity = layers.value['layers']['intensity']['data'].value
+            fragility = layers.value['layers']['landslide fragility']['data'].value
+            trigger_level = layers.value['landslide_trigger_level'].value
+            fragility = fragility[['expstr','susceptibility',trigger_level]].rename(columns={trigger_level:'collapse_probability'})
+            road = 'road' in layers.value['infra'].value
+            power = 'power' in layers.value['infra'].value
+
+            trials, realization = landslide_monte_carlo(landuse, buildings, household, individual, intensity, fragility,
+                landslide_max_trials.value,
+                road_nodes=layers.value['layers']['road nodes']['data'].value if road else None,
+                road_edges=layers.value['layers']['road edges']['data'].value if road else None,
+                power_nodes=layers.value['layers']['power nodes']['data'].value if power else None,
+                power_edges=layers.value['layers']['power edges']['data'].value if power else None,
+                preserve_edge_directions=preserve_edge_directions.value,
+                population_displacement_consensus=population_displacement_consensus.value,
+                threshold_flood_distance=threshold_flood_distance.value,
+                fingerprints=layer_fingerprints(),
+                representative=True)
+
+            for name, frame in realization.items():
+                if name == 'trial':
+                    continue
+                data = layers.value['layers'][name]['data'].value
+                frame = restore_dtypes(frame, data.dtypes.to_dict())
+                for col in frame.columns[1:]:
+                    data[col] = frame[col].to_numpy()
+                layers.value['layers'][name]['data'].set(data)
+                layers.value['layers'][name]['df'].set(data.drop(columns=['geometry']) if 'geometry' in data.columns else data)
+            return trials, realization['trial']
+
+        def execute_flood_sensitivity():
+            landuse = layers.value['layers']['landuse']['data'].value
+            buildings = layers.value['layers']['building']['data'].value
+            intensity = layers.value['layers']['intensity']['data'].value
+            vulnerability = layers.value['layers']['vulnerability']['data'].value
+            policies = [p['id'] for _, p in layers.value['policies'].items() if f"{p['description']} ({p['label']})" in layers.value['selected_policies'].value]
+
+            return compute_flood_sensitivity(landuse, buildings, intensity, vulnerability, policies=policies,
+                flood_depth_reduction=layers.value['flood_depth_reduction'].value,
+                damage_curve_suppress_factor=layers.value['damage_curve_suppress_factor'].value,
+                fingerprints=layer_fingerprints())
+
+        def execute_road_sensitivity():
+            buildings = layers.value['layers']['building']['data'].value
+            household = layers.value['layers']['household']['data'].value
+            individual = layers.value['layers']['individual']['data'].value
+            nodes = layers.value['layers']['road nodes']['data'].value
+            edges = layers.value['layers']['road edges']['data'].value
+            intensity = layers.value['layers']['intensity']['data'].value
+            policies = [p['id'] for _, p in layers.value['policies'].items() if f"{p['description']} ({p['label']})" in layers.value['selected_policies'].value]
+
+            return compute_road_sensitivity(edges, intensity, policies=policies,
+                threshold_increase_culvert_water_height=layers.value['threshold_increase_culvert_water_height'].value,
+                threshold_increase_road_water_height=layers.value['threshold_increase_road_water_height'].value,
+                threshold_flood_distance=threshold_flood_distance.value,
+                nodes=nodes, buildings=buildings, household=household, individual=individual,
+                preserve_edge_directions=preserve_edge_directions.value,
+                fingerprints=layer_fingerprints())
+
         def execute_metric():
             landuse = layers.value['layers']['landuse']['data'].value
             buildings = layers.value['layers']['building']['data'].value
@@ -1462,13 +1620,21 @@ def ExecutePanel():
             is_ready, message = pre_compute_checks()
             if not is_ready:
                 raise Exception(message)
-            max_trials = landslide_max_trials.value  if layers.value['hazard'].value == "landslide" else 1
-            for trial in range(1,max_trials+1):
-                if trial == 1:
+            metric_trials.set(None)
+            flood_sensitivity.set(None)
+            road_sensitivity.set(None)
+            metric_thresholds.set(None)
+            try:
+                set_progress_message('Running...')
+                # Landslide Monte-Carlo trials run as one batched computation,
+                # which also gives the layers, instead of the steps below
+                monte_carlo = layers.value['hazard'].value == 'landslide' and landslide_max_trials.value > 1 and \
+                    'building' in layers.value['infra'].value
+                if monte_carlo:
+                    set_progress_message(f'Monte-Carlo trials ({landslide_max_trials.value})...')
+                    trials, representative_trial = execute_landslide_trials()
                     set_progress_message('Running...')
-                else:
-                    set_progress_message(f'Monte-Carlo trial {trial}/{max_trials}...')
-                if 'power' in layers.value['infra'].value:
+                if 'power' in layers.value['infra'].value and not monte_carlo:
                     nodes, buildings, household = execute_power()
                     layers.value['layers']['power nodes']['data'].set(nodes)
                     layers.value['layers']['building']['data'].set(buildings)
@@ -1476,7 +1642,7 @@ def ExecutePanel():
                     layers.value['layers']['power nodes']['df'].set(nodes.drop(columns=['geometry']))
                     layers.value['layers']['building']['df'].set(buildings.drop(columns=['geometry']))
                     layers.value['layers']['household']['df'].set(household)
-                if 'road' in layers.value['infra'].value:
+                if 'road' in layers.value['infra'].value and not monte_carlo:
                     edges, buildings, household, individual = execute_road()
                     layers.value['layers']['road edges']['data'].set(edges)
                     layers.value['layers']['building']['data'].set(buildings)
@@ -1486,10 +1652,33 @@ def ExecutePanel():
                     layers.value['layers']['building']['df'].set(buildings.drop(columns=['geometry']))
                     layers.value['layers']['household']['df'].set(household)
                     layers.value['layers']['individual']['df'].set(individual)
-                if 'building' in layers.value['infra'].value:
-                    buildings = execute_building()
+                if progressive_analysis.value and 'building' in layers.value['infra'].value and not monte_carlo:
+                    # Buildings read the power and road columns of this trial,
+                    # so the estimate runs after the infra steps
+                    set_progress_message('Estimating on a sample...')
+                    landuse = layers.value['layers']['landuse']['data'].value
+                    household = layers.value['layers']['household']['data'].value
+                    individual = layers.value['layers']['individual']['data'].value
+                    sample = stratified_building_sample(layers.value['layers']['building']['data'].value, household, individual,
+                                                        fraction=progressive_sample_fraction.value)
+                    metric_estimates.set(estimate_metrics(landuse, execute_building(sample['bldid']), household, individual, sample,
+                                                          layers.value['hazard'].value, population_displacement_consensus.value))
+                    set_progress_message('Running...')
+                # Flood damage is taken from the threshold sensitivity, which
+                # the sliders of FloodThresholdPanel reuse after the run
+                sensitivity = None
+                if 'building' in layers.value['infra'].value and not monte_carlo:
+                    if layers.value['hazard'].value == 'flood':
+                        sensitivity = execute_flood_sensitivity()
+                    buildings = execute_building(sensitivity=sensitivity)
                     layers.value['layers']['building']['data'].set(buildings)
                     layers.value['layers']['building']['df'].set(buildings.drop(columns=['geometry']))
+                if 'road' in layers.value['infra'].value and hospital_travel_distance.value:
+                    buildings, household = execute_hospital_distance()
+                    layers.value['layers']['building']['data'].set(buildings)
+                    layers.value['layers']['household']['data'].set(household)
+                    layers.value['layers']['building']['df'].set(buildings.drop(columns=['geometry']))
+                    layers.value['layers']['household']['df'].set(household)
 
                 tally, tally_geo = execute_metric()
 
@@ -1499,10 +1688,27 @@ def ExecutePanel():
                 store_info_to_session()
                 layers.value['tally_is_available'].value = True
                 tally_counter.value += 1
-            set_progress_message('')
-            # trigger render event
-            layers.value['render_count'].set(layers.value['render_count'].value + 1)
 
+                # Mean over the trials, with the range of the trials; the
+                # tally above holds the representative trial
+                if monte_carlo:
+                    metrics = generate_metrics(tally, tally, 'landslide', population_displacement_consensus.value)
+                    metric_trials.set({name: {**metric, 'value': int(round(trials[name].mean())),
+                                              'lower': int(trials[name].min()), 'upper': int(trials[name].max()),
+                                              'n_trials': len(trials), 'trial': representative_trial}
+                                       for name, metric in metrics.items()})
+                # Lets the threshold sliders update the results without a new run
+                if layers.value['hazard'].value == 'flood':
+                    flood_sensitivity.set(sensitivity)
+                    if 'road' in layers.value['infra'].value:
+                        set_progress_message('Road threshold sensitivity...')
+                        road_sensitivity.set(execute_road_sensitivity())
+                set_progress_message('')
+                # trigger render event
+                layers.value['render_count'].set(layers.value['render_count'].value + 1)
+            finally:
+                # the estimates are only shown while the analysis runs
+                metric_estimates.set(None)
             layers.value['datetime_analysis'] =  datetime.datetime.utcnow()
 
     # Execute the thread only when the depencency is changed
@@ -1570,6 +1776,9 @@ def ExecutePanel():
                 with solara.Tooltip('Effects policies 8, 9. Suppress damage curves via multiplying this factor'):
                     solara.InputFloat(label='damage_curve_suppress_factor',  value=layers.value['damage_curve_suppress_factor'],
                                     continuous_update=True)
+    if layers.value['hazard'].value == 'flood' and \
+            (flood_sensitivity.value is not None or road_sensitivity.value is not None):
+        FloodThresholdPanel()
     # The statements in this block are passed several times during thread execution
     if result.error is not None:
         execute_error.set(execute_error.value + str(result.error))
@@ -1588,6 +1797,52 @@ def ExecutePanel():
         set_execute_btn_disabled(False)
         solara.ProgressLinear(value=False)
         
+@solara.component
+def FloodThresholdPanel():
+    # Metrics at other flood thresholds, evaluated on the sensitivities of
+    # the last run instead of running the analysis again. The thresholds are
+    # local to the panel and start at those of the run; the settings of the
+    # next run are not changed. Road thresholds change the hospital and
+    # facility access, other infrastructure metrics stay those of the run.
+    flood = solara.use_reactive(threshold_flood.value)
+    distance = solara.use_reactive(threshold_flood_distance.value)
+    road = solara.use_reactive(threshold_road_water_height.value)
+    culvert = solara.use_reactive(threshold_culvert_water_height.value)
+
+    def update_metrics():
+        landuse = layers.value['layers']['landuse']['data'].value
+        buildings = layers.value['layers']['building']['data'].value
+        household = layers.value['layers']['household']['data'].value
+        individual = layers.value['layers']['individual']['data'].value
+        thresholds = {'threshold_flood': flood.value, 'threshold_flood_distance': distance.value}
+        if road_sensitivity.value is not None:
+            thresholds.update({'road_water_height_threshold': road.value, 'culvert_water_height_threshold': culvert.value})
+        row = threshold_metrics(flood_sensitivity.value, landuse, buildings, household, individual,
+                                [tuple(thresholds.values())], population_displacement_consensus.value,
+                                road_sensitivity=road_sensitivity.value).iloc[0]
+        tally = read_from_session_storage('tally')
+        metrics = generate_metrics(tally, tally, 'flood', population_displacement_consensus.value)
+        metric_thresholds.set({name: {**metric, 'value': int(row[name]), **thresholds}
+                               for name, metric in metrics.items()})
+
+    def set_threshold(threshold, value):
+        threshold.set(value)
+        update_metrics()
+
+    with solara.Card(title='Flood Thresholds', subtitle='Results at other thresholds without a new run'):
+        if flood_sensitivity.value is not None:
+            solara.SliderFloat(label='Flood Threshold (relative damage)', value=flood.value,
+                               on_value=lambda v: set_threshold(flood, v), min=0, max=1, step=0.05)
+            solara.SliderInt(label='Minimum Flood Distance Threshold (meters)', value=distance.value,
+                             on_value=lambda v: set_threshold(distance, v), min=0, max=100)
+        if road_sensitivity.value is not None:
+            solara.SliderFloat(label='Minimum Water Level Threshold for Roads (meters)', value=road.value,
+                               on_value=lambda v: set_threshold(road, v), min=0, max=1)
+            solara.SliderFloat(label='Minimum Water Level Threshold for Culverts (meters)', value=culvert.value,
+                               on_value=lambda v: set_threshold(culvert, v), min=0, max=3)
+            flooded = road_sensitivity.value.damage(road.value, culvert.value)
+            solara.Text(f'Flooded road edges: {flooded.sum()} of {len(flooded)}')
+
 @solara.component
 def PolicyPanel():
     all_policies = [f"{p['description']} ({p['label']})" for _, p in layers.value['policies'].items()]
@@ -1618,6 +1873,8 @@ def MapInfo():
                     else:
                         if isinstance(data, gpd.GeoDataFrame) or isinstance(data, pd.DataFrame):
                             solara.Text(f"{len(data)}")
+                        elif isinstance(data, RasterIntensity):
+                            solara.Text(f"{np.count_nonzero(data.bands.any(axis=0))}")
                         elif isinstance(data, dict) and layer_name == 'gem_vulnerability':
                             solara.Text(f"{len(data['vulnerabilityFunctions'])}")
                         elif isinstance(data, dict) and layer_name == 'gem_fragility':
@@ -1686,7 +1943,7 @@ def ImportDataZone1():
                     if isinstance(data, gpd.GeoDataFrame):
                         data = data.set_crs("epsg:4326",allow_override=True)
                         layers.value['layers'][name]['df'].set(data.drop(columns=['geometry']))
-                        layers.value['layers'][name]['data'].set(data)
+                        set_layer_data(name, data)
                         # centroids in geometric coordinates (3857: Pseuod-Mercator in meters)
                         # Geographic --> geometric --> calculate centroid --> geographic
                         centroids = data.to_crs('epsg:3857').centroid.to_crs('epsg:4326')
@@ -1696,11 +1953,17 @@ def ImportDataZone1():
                         updated_center = (center_y, center_x)
                     elif isinstance(data, pd.DataFrame):
                         layers.value['layers'][name]['df'].set(data)
-                        layers.value['layers'][name]['data'].set(data)
+                        set_layer_data(name, data)
+                    elif isinstance(data, RasterIntensity):
+                        layers.value['layers'][name]['df'].set(None)
+                        set_layer_data(name, data)
+                        x, y, _ = data.nonzero_pixels(data.band_names[0])
+                        if len(x) > 0:
+                            updated_center = (y.mean(), x.mean())
                     elif isinstance(data, ParameterFile):
-                        layers.value['layers'][name]['data'].set(data)
+                        set_layer_data(name, data)
                     elif isinstance(data, dict):
-                        layers.value['layers'][name]['data'].set(data)
+                        set_layer_data(name, data)
                 else:
                     unrecognized_file_exists = True
             if updated_center:
@@ -1728,10 +1991,10 @@ def ImportDataZone1():
                                                                 population_calculate=False, seed=seed)
 
             for name, data in zip(['building','household','individual'],[building, household, individual]):
-                data = layers.value['layers'][name]['pre_processing'](data, layers.value['layers'][name]['extra_cols'])
+                data = preprocess_layer(name, data)
                 print('hkaya',name)
                 #print(data)
-                layers.value['layers'][name]['data'].set(data)
+                set_layer_data(name, data)
                 if  "geometry" in list(data.columns):
                     center = (data.geometry.centroid.y.mean(), data.geometry.centroid.x.mean())
                     layers.value['center'].set(center)
@@ -1842,7 +2105,7 @@ def ImportDataZone2():
                     if isinstance(data, gpd.GeoDataFrame):
                         data = data.set_crs("epsg:4326",allow_override=True)
                         layers.value['layers'][name]['df'].set(data.drop(columns=['geometry']))
-                        layers.value['layers'][name]['data'].set(data)
+                        set_layer_data(name, data)
                         # centroids in geometric coordinates (3857: Pseuod-Mercator in meters)
                         # Geographic --> geometric --> calculate centroid --> geographic
                         centroids = data.to_crs('epsg:3857').centroid.to_crs('epsg:4326')
@@ -1852,11 +2115,17 @@ def ImportDataZone2():
                         updated_center = (center_y, center_x)
                     elif isinstance(data, pd.DataFrame):
                         layers.value['layers'][name]['df'].set(data)
-                        layers.value['layers'][name]['data'].set(data)
+                        set_layer_data(name, data)
+                    elif isinstance(data, RasterIntensity):
+                        layers.value['layers'][name]['df'].set(None)
+                        set_layer_data(name, data)
+                        x, y, _ = data.nonzero_pixels(data.band_names[0])
+                        if len(x) > 0:
+                            updated_center = (y.mean(), x.mean())
                     elif isinstance(data, ParameterFile):
-                        layers.value['layers'][name]['data'].set(data)
+                        set_layer_data(name, data)
                     elif isinstance(data, dict):
-                        layers.value['layers'][name]['data'].set(data)
+                        set_layer_data(name, data)
                 else:
                     unrecognized_file_exists = True
             if updated_center:
@@ -1884,10 +2153,10 @@ def ImportDataZone2():
                                                                 population_calculate=False, seed=seed)
 
             for name, data in zip(['building','household','individual'],[building, household, individual]):
-                data = layers.value['layers'][name]['pre_processing'](data, layers.value['layers'][name]['extra_cols'])
+                data = preprocess_layer(name, data)
                 print('hkaya',name)
                 #print(data)
-                layers.value['layers'][name]['data'].set(data)
+                set_layer_data(name, data)
                 if  "geometry" in list(data.columns):
                     center = (data.geometry.centroid.y.mean(), data.geometry.centroid.x.mean())
                     layers.value['center'].set(center)
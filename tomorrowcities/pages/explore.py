@@ -27,10 +27,10 @@ import secrets
 import tempfile
 
 from . import storage, connect_storage, read_from_session_storage, store_in_session_storage
-from ..backend.utils import building_preprocess, identity_preprocess, ParameterFile
+from ..backend.utils import building_preprocess, identity_preprocess, ParameterFile, RasterIntensity
 from .engine import landuse_colors, generic_layer_colors, building_colors, road_edge_colors,\
-                    power_edge_colors, ds_to_color, ds_to_color_approx, create_tally
-from .engine import MetricWidget, create_new_app_state
+                    power_edge_colors, ds_to_color, ds_to_color_approx, create_tally, intensity_heatmap_locations
+from .engine import MetricWidget, create_new_app_state, data_fingerprint
 from ..backend.engine import generate_metrics
 from .settings import population_displacement_consensus
 
@@ -54,13 +54,7 @@ layers = create_new_app_state()
 
 def create_map_layer(df, name):
     if name == "intensity":
-        # Take the largest 500_000 values to display
-        im_col = 'pga' if 'pga' in df.columns else 'im'
-        df_non_zero = df[df[im_col] > 0]
-        df_limited = df_non_zero.sample(min(len(df_non_zero),500_000))
-        df_limited[im_col] = df_limited[im_col] / df_limited[im_col].max()
-        #df_limited = df.sort_values(by=im_col,ascending=False).head(500_000)
-        locs = np.array([df_limited.geometry.y.to_list(), df_limited.geometry.x.to_list(), df_limited[im_col].to_list()]).transpose().tolist()
+        locs = intensity_heatmap_locations(df)
         map_layer = ipyleaflet.Heatmap(locations=locs, radius = 3, blur = 2, name = name) 
     elif name == "landuse":
         map_layer = ipyleaflet.GeoJSON(data = json.loads(df.to_json()), name = name,
@@ -196,11 +190,16 @@ def load_from_state(source_dict):
                 stack.append((path + (key,), value))
             else:
                 keys = list(path + (key,))
+                if key == 'fingerprint':
+                    # not trusted from the saved state, see below
+                    continue
                 src_value = get_nested_value(source_dict, keys)
                 if isinstance(value,solara.toestand.Reactive):
                     assign_nested_value(layers.value, keys, solara.reactive(src_value))
                 else:
                     assign_nested_value(layers.value, keys, src_value)
+    for layer in layers.value['layers'].values():
+        layer['fingerprint'] = solara.reactive(data_fingerprint(layer['data'].value))
 
 
 
@@ -322,7 +321,7 @@ def MapViewer():
         map_layers = []
         for l in layers.value['layers'].keys():
             df = layers.value['layers'][l]['data'].value
-            if df is not None and isinstance(df, gpd.GeoDataFrame):
+            if df is not None and (isinstance(df, gpd.GeoDataFrame) or isinstance(df, RasterIntensity)):
                 df_filtered = df
                 if l == 'building':
                     if building_filter.value is not None:
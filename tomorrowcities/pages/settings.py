@@ -11,7 +11,12 @@ threshold_flood_distance = solara.reactive(10)
 threshold_road_water_height = solara.reactive(0.3) 
 threshold_culvert_water_height = solara.reactive(1.5)
 preserve_edge_directions = solara.reactive(False)
+hospital_travel_distance = solara.reactive(False)
 population_displacement_consensus = solara.reactive(2)
+compact_engine_mode = solara.reactive(False)
+compute_partitions = solara.reactive(1)
+progressive_analysis = solara.reactive(False)
+progressive_sample_fraction = solara.reactive(0.1)
 
 @solara.component
 def Page(name: Optional[str] = None, page: int = 0, page_size=100):
@@ -22,6 +27,28 @@ def Page(name: Optional[str] = None, page: int = 0, page_size=100):
 
     with solara.Card(title='Connectivity Parameters',subtitle='Parameters effecting connectivity analysis in road/power networks'):
         solara.Checkbox(label='Preserve directions in graph edges', value=preserve_edge_directions)
+        solara.Checkbox(label='Travel distance to hospitals (uses road edge lengths)', value=hospital_travel_distance)
+
+    with solara.Card(title='Memory Parameters',subtitle='Data types used for the exposure layers'):
+        solara.Markdown(md_text='''
+                        In compact mode, probabilities and intensities are stored as float32,
+                        identifiers as int32, damage states as int8 and taxonomy strings as
+                        categoricals. Applies to layers loaded or generated afterwards.''')
+        solara.Checkbox(label='Compact engine mode', value=compact_engine_mode)
+
+    with solara.Card(title='Parallel Computation',subtitle='Process-parallel building damage computation'):
+        solara.Markdown(md_text='''
+                        Buildings are split into this many spatial partitions, each processed
+                        in a separate process. Results are the same as with a single partition.''')
+        solara.SliderInt(label='Number of Partitions', value=compute_partitions, min=1,max=32)
+
+    with solara.Card(title='Progressive Analysis',subtitle='Approximate metrics before the full analysis'):
+        solara.Markdown(md_text='''
+                        Metrics are first estimated, with confidence intervals, on a stratified
+                        sample of buildings (by zone, occupancy and taxonomy) and replaced
+                        by the exact values when the full analysis finishes.''')
+        solara.Checkbox(label='Progressive analysis', value=progressive_analysis)
+        solara.SliderFloat(label='Sample fraction', value=progressive_sample_fraction, min=0.01,max=1, step=0.01)
 
     with solara.Card(title='Landslide Parameters',subtitle='Choose the parameters for the landslide simulation'):
         solara.SliderInt(label='Number of Monte-Carlo Trials', value=landslide_max_trials, min=1,max=100)